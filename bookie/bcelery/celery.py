@@ -30,6 +30,9 @@ def load_ini():
 
 INI = load_ini()
 
+# Bookmarks someone just saved can have workers of their own, started with -Q
+# set to this queue, so their fetch isn't stuck behind the imports.
+INTERACTIVE_QUEUE = INI.get('fetch.interactive_queue')
 
 celery = Celery(
     'bookie.bcelery',
@@ -40,6 +43,11 @@ celery = Celery(
 celery.conf.update(
     CELERY_TASK_RESULT_EXPIRES=3600,
     CELERY_RESULT_BACKEND=INI.get('celery_broker'),
+    CELERY_ROUTES={
+        'bookie.bcelery.tasks.fetch_bmark_content': {
+            'queue': INTERACTIVE_QUEUE,
+        },
+    } if INTERACTIVE_QUEUE else {},
     CELERYBEAT_SCHEDULE={
         'daily_jobs': {
             'task': 'bookie.bcelery.tasks.daily_jobs',
@@ -57,10 +65,34 @@ celery.conf.update(
             'task': 'bookie.bcelery.tasks.fetch_unfetched_bmark_content',
             'schedule': timedelta(seconds=60*60),
         },
+        'fetch_queue': {
+            'task': 'bookie.bcelery.tasks.fetch_queued_content',
+            'schedule': timedelta(seconds=60),
+        },
+        'fetch_cache_prune': {
+            'task': 'bookie.bcelery.tasks.prune_fetch_cache',
+            'schedule': timedelta(seconds=60*60),
+        },
+        'blob_store_compact': {
+            'task': 'bookie.bcelery.tasks.compact_blob_store',
+            'schedule': timedelta(seconds=24*60*60),
+        },
+        'fetch_refresh': {
+            'task': 'bookie.bcelery.tasks.refresh_bmark_content',
+            'schedule': timedelta(seconds=60*60),
+        },
         'fulltext_missing': {
             'task': 'bookie.bcelery.tasks.missing_fulltext_index',
             'schedule': timedelta(seconds=60),
         },
+        'tag_suggestions': {
+            'task': 'bookie.bcelery.tasks.suggest_content_tags',
+            'schedule': timedelta(seconds=60*60),
+        },
+        'fulltext_optimize': {
+            'task': 'bookie.bcelery.tasks.optimize_fulltext_index',
+            'schedule': timedelta(seconds=60*60),
+        },
     }
 )
 
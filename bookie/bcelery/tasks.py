@@ -1,29 +1,50 @@
 from __future__ import absolute_import
 
+import os
+import socket
+import uuid
+
+from datetime import datetime
+from datetime import timedelta
+
 import tweepy
 from celery.utils.log import get_task_logger
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 
 from bookie.bcelery.celery import celery
 
 
 import transaction
-try:
-    from whoosh.store import LockError
-except ImportError:
-    from whoosh.index import LockError
-from whoosh.writing import IndexingError
 
+from bookie.lib.applog import FulltextLog
+from bookie.lib.blobstore import get_store
+from bookie.lib.fetcher import ContentFetcher
+from bookie.lib.fetcher import host_down
+from bookie.lib.httpcache import get_cache
 from bookie.lib.importer import Importer
-from bookie.lib.readable import ReadUrl
+from bookie.lib.readable import STATUS_CODES
 from bookie.lib.social_utils import get_url_title
+from bookie.lib.utils import content_tags
+from bookie.lib.utils import suggest_tags_batch
 from bookie.models import initialize_sql
 from bookie.models import Bmark
 from bookie.models import BmarkMgr
+from bookie.models import DBSession
+from bookie.models import Hashed
 from bookie.models import Readable
+from bookie.models import ReadableMgr
+from bookie.models import TagMgr
 from bookie.models.auth import UserMgr
 from bookie.models.fulltext import get_fulltext_handler
 from bookie.models.social import SocialMgr
 from bookie.models.stats import StatBookmarkMgr
+from bookie.models.queue import FETCH_BULK
+from bookie.models.queue import FETCH_INTERACTIVE
+from bookie.models.queue import FETCH_LANES
+from bookie.models.queue import FetchQueueMgr
+from bookie.models.queue import HostHealthMgr
+from bookie.models.queue import fetch_status_class
 from bookie.models.queue import ImportQueueMgr
 
 from .celery import load_ini
@@ -237,78 +258,91 @@ def email_signup_user(email, msg, settings, message_data):
         trans.commit()
 
 
-class BookmarkNotFoundException(Exception):
-    pass
-
-
-@celery.task(ignore_result=True, default_retry_delay=30)
+@celery.task(ignore_result=True)
 def fulltext_index_bookmark(bid, content):
-    """Insert bookmark data into the fulltext index."""
-    b = Bmark.query.get(bid)
+    """Get bookmark data into the fulltext index.
 
-    if not b:
-        logger.error('Could not load bookmark to fulltext index: ' + str(bid))
-        fulltext_index_bookmark.retry(exc=BookmarkNotFoundException())
-    else:
-        from bookie.models.fulltext import get_writer
-        logger.debug('getting writer')
-        writer = get_writer()
-
-        if content:
-            found_content = content
-        elif b.readable:
-            found_content = b.readable.clean_content
-        else:
-            found_content = ""
+    With whoosh the index writer process is the only one that writes to the
+    index, so all we do here is leave a note for it in the fulltext_queue.
+    The database engines store it right away.
 
-        try:
-            writer.update_document(
-                bid=str(b.bid),
-                description=b.description if b.description else "",
-                extended=b.extended if b.extended else "",
-                tags=b.tag_str if b.tag_str else "",
-                readable=found_content,
-                username=b.username,
-                is_private=b.is_private,
-            )
-            writer.commit()
-            logger.debug('writer commit')
-        except (IndexingError, LockError) as exc:
-            # There was an issue saving into the index.
-            logger.error(exc)
-            logger.warning('sending back to the queue')
-            # This should send the work over to a celery task that will try
-            # again in that space.
-            writer.cancel()
-            fulltext_index_bookmark.retry(exc=exc, countdown=60)
+    """
+    trans = transaction.begin()
+    bmark = Bmark.query.get(bid)
+    if bmark:
+        get_fulltext_handler(None).index_bookmark(
+            DBSession.connection(), bmark, content)
+    else:
+        logger.error('Could not load bookmark to fulltext index: ' + str(bid))
+    trans.commit()
 
 
 @celery.task(ignore_result=True)
 def reindex_fulltext_allbookmarks(sync=False):
-    """Rebuild the fulltext index with all bookmarks."""
+    """Rebuild the fulltext index with all bookmarks.
+
+    :param sync: with whoosh, process the queue right here vs waiting on the
+        index writer
+
+    """
     logger.debug("Starting freshen of fulltext index.")
+    get_fulltext_handler(None).reindex(sync=sync)
 
-    bookmarks = Bmark.query.all()
 
-    for b in bookmarks:
-        if sync:
-            fulltext_index_bookmark(b.bid, None)
-        else:
-            fulltext_index_bookmark.delay(b.bid, None)
+@celery.task(ignore_result=True)
+def missing_fulltext_index():
+    """Queue the bookmarks that are missing or stale in the fulltext index.
+
+    Only what's changed is queued, see the handler's reconcile.
+
+    """
+    logger.debug("Reconciling the fulltext index with the bookmarks")
+    trans = transaction.begin()
+    stats = get_fulltext_handler(None).reconcile()
+    FulltextLog.reconcile(stats)
+    trans.commit()
 
 
 @celery.task(ignore_result=True)
-def missing_fulltext_index(sync=False):
-    """Find and add fulltext for bookmarks missing from fulltext."""
-    logger.debug("Searching for missing fulltext bookmarks")
-    bookmarks = Bmark.query.limit(500).all()
-    searcher = get_fulltext_handler(None)
-
-    for bmark in bookmarks:
-        if searcher.findByID(bmark.bid):
-            continue
-        else:
-            fulltext_index_bookmark.delay(bmark.bid, None)
+def suggest_content_tags(hash_ids=None):
+    """Work out the tag suggestions for urls that have content without them
+
+    Content saved through the api, or from before suggestions were kept,
+    gets them here rather than on the edit page. Without hash_ids it works
+    through all that are missing.
+
+    """
+    while True:
+        todo = hash_ids or ReadableMgr.unsuggested(limit=FETCH_CHUNK)
+        if not todo:
+            break
+        trans = transaction.begin()
+        for readable in Readable.query.filter(Readable.hash_id.in_(todo)):
+            try:
+                text = readable.clean_content
+            except (KeyError, IOError):
+                logger.error('Content missing for: ' + readable.hash_id)
+                text = None
+            TagMgr.set_suggestions(readable, content_tags(text))
+        trans.commit()
+        if hash_ids:
+            break
+
+
+@celery.task(ignore_result=True)
+def optimize_fulltext_index():
+    """Merge the fulltext index down if it's gotten fragmented.
+
+    The thresholds come from the fulltext.optimize_segments and
+    fulltext.optimize_deleted_ratio settings.
+
+    """
+    trans = transaction.begin()
+    stats = get_fulltext_handler(None).optimize(
+        segments=int(INI.get('fulltext.optimize_segments', 10)),
+        deleted_ratio=float(INI.get('fulltext.optimize_deleted_ratio', 0.2)))
+    trans.commit()
+    logger.info("Fulltext optimize check: " + str(stats))
 
 
 @celery.task(ignore_result=True)
@@ -320,81 +354,434 @@ def process_twitter_connections(username=None):
         create_twitter_api(connection)
 
 
+def ini_pairs(key, cast):
+    """The name:value pairs listed in an ini setting"""
+    return dict(
+        (name, cast(value)) for name, value in
+        (pair.split(':', 1) for pair in INI.get(key, '').split()
+         if ':' in pair))
+
+
+FETCH_CHUNK = 500
+REFRESH_MIN = int(float(INI.get('fetch.refresh_min_hours', 24)) * 60 * 60)
+REFRESH_MAX = int(float(INI.get('fetch.refresh_max_hours', 720)) * 60 * 60)
+# the share of the bulk fetch lane users get each round
+FETCH_WEIGHTS = ini_pairs('fetch.user_weights', int)
+FETCH_LEASE = int(float(INI.get('fetch.lease_minutes', 30)) * 60)
+HOST_FAILURES = int(INI.get('fetch.host_failures', 5))
+HOST_COOLDOWN = int(float(INI.get('fetch.host_cooldown_minutes', 15)) * 60)
+# How many hours to leave a url that failed alone before trying it again, by
+# status code or by the class of status from fetch_status_class.
+BAD_TTL = {
+    '410': 30 * 24,
+    'client': 7 * 24,
+    'unreadable': 7 * 24,
+    'network': 12,
+    'server': 6,
+    'throttled': 2,
+}
+BAD_TTL.update(ini_pairs('fetch.bad_ttl_hours', float))
+
+
+def bad_ttl(status):
+    """How many seconds a url that failed with status is left alone"""
+    hours = BAD_TTL.get(str(status),
+                        BAD_TTL.get(fetch_status_class(status), 24))
+    return int(hours * 60 * 60)
+
+
+def content_fetcher():
+    """A ContentFetcher set up from the fetch.* ini settings"""
+    return ContentFetcher(
+        concurrency=int(INI.get('fetch.concurrency', 20)),
+        per_host=int(INI.get('fetch.per_host', 2)),
+        connect_timeout=float(INI.get('fetch.connect_timeout', 5)),
+        read_timeout=float(INI.get('fetch.read_timeout', 20)),
+        parse_processes=int(INI.get('fetch.parse_processes', 0)) or None,
+        host_failures=HOST_FAILURES,
+        max_bytes=int(float(INI.get('fetch.max_mb', 5)) * 1024 * 1024),
+        cache=get_cache())
+
+
+def store_readable(readable, read, title_tags=frozenset()):
+    """Copy a fetched Readable onto the url's stored readable
+
+    A refresh that found the page unchanged, or failed, keeps the content we
+    have and only moves the refresh schedule along. Urls that failed are left
+    alone for the bad_ttl of their status. New content is suggested the
+    title_tags as well, after its own.
+
+    """
+    logger.debug("%s: %s %d %s %s" % (
+        readable.hash_id,
+        read.url,
+        len(read.content) if read.content else -1,
+        read.is_error(),
+        read.status_message))
+
+    if readable.imported is not None and (
+            read.unchanged or (read.is_error() and readable.content)):
+        if read.unchanged:
+            readable.etag = read.etag or readable.etag
+            readable.last_modified = (read.last_modified or
+                                      readable.last_modified)
+        else:
+            readable.status_code = read.status
+            readable.status_message = read.status_message
+            ReadableMgr.put_off(readable, bad_ttl(read.status))
+            return
+        ReadableMgr.schedule(readable, False,
+                             low=REFRESH_MIN, high=REFRESH_MAX)
+        return
+
+    if not read.is_image():
+        readable.content = read.content
+        # The fetcher parses the plain text out with the content, None leaves
+        # it for the model to work out.
+        readable.clean_content = read.clean_content
+    else:
+        readable.content = None
+        readable.clean_content = None
+    # The tag suggestions come out of the parse with the content.
+    tags = read.suggested_tags if read.content is not None else []
+    if read.content is not None and tags is not None:
+        seen = set(tag for tag, score in tags)
+        tags = list(tags) + [
+            (tag, 0) for tag in sorted(title_tags)
+            if tag not in seen and 2 < len(tag) <= 255 and not tag.isdigit()]
+    TagMgr.set_suggestions(readable, tags)
+
+    # set some of the extra metadata
+    readable.imported = readable.imported or datetime.utcnow()
+    readable.content_type = read.content_type
+    readable.status_code = read.status
+    readable.status_message = read.status_message
+    readable.etag = read.etag
+    readable.last_modified = read.last_modified
+    readable.digest = read.digest
+    if read.is_error():
+        ReadableMgr.put_off(readable, bad_ttl(read.status))
+    else:
+        ReadableMgr.schedule(readable, True,
+                             low=REFRESH_MIN, high=REFRESH_MAX)
+
+
+def queue_fetch(hash_ids, username=None, lane=FETCH_BULK, attempts=3):
+    """Queue the urls that don't have their content yet for fetching
+
+    Two workers queueing the same new url at once trip over the primary key,
+    so the loser tries again and finds it queued.
+
+    """
+    for attempt in range(attempts):
+        trans = transaction.begin()
+        try:
+            fetched = ReadableMgr.fetched(hash_ids)
+            queued = FetchQueueMgr.enqueue(
+                [hash_id for hash_id in hash_ids if hash_id not in fetched],
+                username=username, lane=lane)
+            trans.commit()
+            return queued
+        except IntegrityError:
+            transaction.abort()
+    logger.error('Could not queue urls to fetch: ' + ', '.join(hash_ids))
+    return []
+
+
 @celery.task(ignore_result=True)
 def fetch_unfetched_bmark_content(ignore_result=True):
     """Check the db for any unfetched content. Fetch and index."""
     logger.info("Checking for unfetched bookmarks")
 
-    url_list = Bmark.query.outerjoin(
-        Readable, Bmark.readable).\
-        filter(Readable.imported.is_(None)).all()
+    # A url goes in the bulk lane of the first user to bookmark it.
+    first = DBSession.query(func.min(Bmark.bid).label('bid')).\
+        outerjoin(Readable, Bmark.readable).\
+        filter(Readable.imported.is_(None)).\
+        group_by(Bmark.hash_id).subquery()
+    users = {}
+    for hash_id, username in DBSession.query(
+            Bmark.hash_id, Bmark.username).\
+            join(first, Bmark.bid == first.c.bid).\
+            order_by(Bmark.hash_id):
+        users.setdefault(username, []).append(hash_id)
+    transaction.commit()
+
+    for username, hash_ids in users.items():
+        for start in range(0, len(hash_ids), FETCH_CHUNK):
+            queue_fetch(hash_ids[start:start + FETCH_CHUNK], username)
+    fetch_queued_content.delay()
 
-    for bmark in url_list:
-        fetch_bmark_content.delay(bmark.bid)
+
+@celery.task(ignore_result=True)
+def refresh_bmark_content():
+    """Refetch the content of urls that are due for a check
+
+    Each one is only fetched if the server says it changed, and only parsed
+    and indexed again if it hashes differently.
+
+    """
+    hash_ids = ReadableMgr.due(
+        limit=int(INI.get('fetch.refresh_batch', 2000)))
+    logger.info("Refreshing content for %d urls" % len(hash_ids))
+    if not hash_ids:
+        return
+
+    # Push these out so the next run doesn't pick them up again before the
+    # fetch gets to them.
+    trans = transaction.begin()
+    DBSession.query(Readable).filter(Readable.hash_id.in_(hash_ids)).update(
+        {'next_fetch': datetime.utcnow() + timedelta(hours=1)},
+        synchronize_session=False)
+    trans.commit()
+
+    for start in range(0, len(hash_ids), FETCH_CHUNK):
+        fetch_url_content.delay(hash_ids[start:start + FETCH_CHUNK],
+                                refresh=True)
+
+
+@celery.task(ignore_result=True)
+def prune_fetch_cache():
+    """Clear expired pages and redirects out of the response cache"""
+    cache = get_cache()
+    if cache is not None:
+        removed = cache.prune()
+        logger.info("Removed %d expired pages from the cache" % removed)
+
+
+@celery.task(ignore_result=True)
+def compact_blob_store():
+    """Drop the readable content no readable points at from the blob store"""
+    store = get_store()
+    if store is None:
+        return
+
+    keep = set()
+    for content, clean in DBSession.query(Readable.content_digest,
+                                          Readable.clean_digest):
+        keep.update((content, clean))
+    transaction.commit()
+    keep.discard(None)
+
+    stats = store.compact(keep)
+    logger.info("Removed %d blobs and %d packs, freeing %d bytes" % (
+        stats['removed'], stats['packs'], stats['bytes']))
+
+
+@celery.task(ignore_result=True)
+def fetch_bmarks_content(bids):
+    """Fetch the content for a set of bookmarks at once and store it
+
+    Bookmarks of a url we already have, or that's queued right now, share
+    that content without another download.
+
+    """
+    if not bids:
+        return
+
+    users = {}
+    for hash_id, username in DBSession.query(
+            Bmark.hash_id, Bmark.username).filter(Bmark.bid.in_(bids)):
+        users.setdefault(username, []).append(hash_id)
+    transaction.commit()
+
+    queued = [queue_fetch(hash_ids, username)
+              for username, hash_ids in users.items()]
+    if any(queued):
+        fetch_queued_content()
+
+
+@celery.task(ignore_result=True)
+def fetch_queued_content(lanes=FETCH_LANES):
+    """Work through the fetch queue until nothing is ready
+
+    Each batch is leased from the queue, so any number of workers can run
+    this at once. Every batch takes what's in the interactive lane first and
+    fills up with a share of each user's bulk fetches.
+
+    """
+    worker = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    while True:
+        owner = '{0}:{1}'.format(worker, uuid.uuid4().hex)
+        trans = transaction.begin()
+        hash_ids = FetchQueueMgr.claim(owner, limit=FETCH_CHUNK,
+                                       lease=FETCH_LEASE, lanes=lanes,
+                                       weights=FETCH_WEIGHTS)
+        trans.commit()
+        if not hash_ids:
+            break
+        fetch_url_content(hash_ids, owner=owner)
+
+
+@celery.task(ignore_result=True)
+def fetch_url_content(hash_ids, refresh=False, owner=None):
+    """Fetch the content for a set of urls at once and store it
+
+    The pages are downloaded concurrently and saved a batch at a time as they
+    come in. A refresh sends what the last fetch saw so unchanged pages are
+    skipped. With the owner of their lease, the urls are taken out of the
+    fetch queue as they're stored, or put back to try again later.
+
+    Urls on hosts that are down are put off until the host can be tried
+    again, other than one to probe it with once its cooldown is up.
+
+    """
+    if not hash_ids:
+        return
+
+    urls = [(hash_id, url) for hash_id, url in DBSession.query(
+        Hashed.hash_id, Hashed.url).
+        filter(Hashed.hash_id.in_(hash_ids)).all()]
+    validators = {}
+    if refresh:
+        validators = dict(
+            (readable.hash_id, readable.validators()) for readable in
+            Readable.query.filter(Readable.hash_id.in_(hash_ids)))
+    if owner is not None:
+        # Urls that have gone away since they were queued.
+        found = set(hash_id for hash_id, url in urls)
+        FetchQueueMgr.complete(
+            [hash_id for hash_id in hash_ids if hash_id not in found], owner)
+        for username, waits in sorted(
+                FetchQueueMgr.waits(list(found)).items(),
+                key=lambda item: item[0] or u''):
+            logger.info("Fetch wait for %s: count=%d, avg=%.1fs, max=%.1fs" % (
+                username, len(waits), sum(waits) / len(waits), max(waits)))
+    blocked, probes = HostHealthMgr.check(
+        set(ContentFetcher.host(url) for hash_id, url in urls))
+    transaction.commit()
+
+    def put_off(later):
+        """Push urls back until their host can be tried again"""
+        trans = transaction.begin()
+        for until, put_off_ids in later.items():
+            if owner is not None:
+                FetchQueueMgr.defer(put_off_ids, owner, until)
+            else:
+                DBSession.query(Readable).\
+                    filter(Readable.hash_id.in_(put_off_ids)).\
+                    update({'next_fetch': until}, synchronize_session=False)
+        trans.commit()
+
+    def record(outcomes):
+        """Count the results against their hosts"""
+        trans = transaction.begin()
+        try:
+            HostHealthMgr.record(outcomes, probes=probes,
+                                 failures=HOST_FAILURES,
+                                 cooldown=HOST_COOLDOWN)
+            trans.commit()
+        except IntegrityError:
+            # Another worker added the host first, it'll count next time.
+            transaction.abort()
+
+    if blocked:
+        later = {}
+        allowed = []
+        probing = set(probes)
+        for hash_id, url in urls:
+            host = ContentFetcher.host(url)
+            if host in blocked and host not in probing:
+                later.setdefault(blocked[host], []).append(hash_id)
+            else:
+                probing.discard(host)
+                allowed.append((hash_id, url))
+        logger.info("Putting off %d urls on hosts that are down" % (
+            len(urls) - len(allowed)))
+        put_off(later)
+        urls = allowed
+
+    def store(batch):
+        # The fetcher gave up on these hosts part way through.
+        skipped = [hash_id for hash_id, read in batch
+                   if read.status == STATUS_CODES['906']]
+        if skipped:
+            put_off({
+                datetime.utcnow() + timedelta(seconds=HOST_COOLDOWN): skipped
+            })
+
+        trans = transaction.begin()
+        found = dict(
+            (readable.hash_id, readable) for readable in
+            Readable.query.filter(
+                Readable.hash_id.in_([hash_id for hash_id, read in batch])))
+        # What the pages were bookmarked as, worked out for the whole batch
+        # at once.
+        titles = dict(DBSession.query(Bmark.hash_id, Bmark.description).filter(
+            Bmark.hash_id.in_([hash_id for hash_id, read in batch
+                               if read.content is not None])))
+        title_tags = dict(zip(titles, suggest_tags_batch(
+            list(titles.values()))))
+        done = []
+        outcomes = []
+        for hash_id, read in batch:
+            if hash_id in skipped:
+                continue
+            if read.url is not None:
+                outcomes.append((
+                    ContentFetcher.host(read.url),
+                    read.status if host_down(read.status) else None))
+            if owner is not None:
+                # Leave the readable alone while there are retries left,
+                # urls we give up on are parked by fail.
+                if read.is_error():
+                    if FetchQueueMgr.fail(hash_id, read.status, owner):
+                        continue
+                else:
+                    done.append(hash_id)
+
+            readable = found.get(hash_id)
+            if readable is None:
+                readable = Readable(hash_id=hash_id)
+                DBSession.add(readable)
+            store_readable(readable, read,
+                           title_tags.get(hash_id, frozenset()))
+        if owner is not None:
+            # Hold on to the rest of the batch while it's still coming in.
+            FetchQueueMgr.complete(done, owner)
+            FetchQueueMgr.renew(owner, lease=FETCH_LEASE)
+        trans.commit()
+        record(outcomes)
+
+    if not urls:
+        return
+
+    fetcher = content_fetcher()
+    try:
+        if len(urls) == 1:
+            # Not worth starting up the parse processes for a single page.
+            hash_id, url = urls[0]
+            store([(hash_id, fetcher.download(
+                url, validators=validators.get(hash_id)))])
+            count = 1
+        else:
+            count = fetcher.fetch_all(
+                urls, store,
+                batch_size=int(INI.get('fetch.batch_size', 50)),
+                validators=validators)
+    finally:
+        fetcher.close()
+    stats = fetcher.stats()
+    logger.info("Fetched content for %d urls" % count)
+    for stage in ('fetch', 'parse'):
+        logger.info("%s: %s" % (stage, ', '.join(
+            '%s=%s' % (key, value)
+            for key, value in sorted(stats[stage].items()))))
 
 
 @celery.task(ignore_result=True)
 def fetch_bmark_content(bid):
     """Given a bookmark, fetch its content and index it."""
-    trans = transaction.begin()
-
     if not bid:
         raise Exception('missing bookmark id')
     bmark = Bmark.query.get(bid)
     if not bmark:
         raise Exception('Bookmark not found: ' + str(bid))
-    hashed = bmark.hashed
-
-    try:
-        read = ReadUrl.parse(hashed.url)
-    except ValueError:
-        # We hit this where urllib2 choked trying to get the protocol type of
-        # this url to fetch it.
-        logger.error('Could not parse url: ' + hashed.url)
-        logger.error('exc')
-        read = None
-
-    if read:
-        logger.debug(read)
-        logger.debug(read.content)
-
-        logger.debug("%s: %s %d %s %s" % (
-            hashed.hash_id,
-            read.url,
-            len(read.content) if read.content else -1,
-            read.is_error(),
-            read.status_message))
-
-        if not read.is_image():
-            if not bmark.readable:
-                bmark.readable = Readable()
-
-            bmark.readable.content = read.content
-        else:
-            if not bmark.readable:
-                bmark.readable = Readable()
-            bmark.readable.content = None
-
-        # set some of the extra metadata
-        bmark.readable.content_type = read.content_type
-        bmark.readable.status_code = read.status
-        bmark.readable.status_message = read.status_message
-        trans.commit()
-        fulltext_index_bookmark.delay(
-            bid,
-            read.content if read else None)
-    else:
-        logger.error(
-            'No readable record for bookmark: ',
-            str(bid), str(bmark.hashed.url))
-
-        # There was a failure reading the thing.
-        bmark.readable = Readable()
-        bmark.readable.status = '900'
-        bmark.readable.status_message = (
-            'No readable record '
-            'during existing processing')
-        trans.commit()
+    hash_id = bmark.hash_id
+    username = bmark.username
+    transaction.commit()
+    # Someone is waiting on this one, don't leave it behind the imports.
+    if queue_fetch([hash_id], username, lane=FETCH_INTERACTIVE):
+        fetch_queued_content(lanes=[FETCH_INTERACTIVE])
 
 
 @celery.task(ignore_result=True)
@@ -418,14 +805,20 @@ def fetch_tweets(twitter_user, connection):
         include_entities=True,
         since_id=connection.last_tweet_seen)
     if tweets:
-        for tweet in tweets:
-            for url in tweet.entities['urls']:
-                expanded_url, title = get_url_title(url['expanded_url'])
-                new = BmarkMgr.get_by_url(
-                    expanded_url, connection.username)
-                if not new:
-                    BmarkMgr.store(expanded_url, connection.username,
-                                   title, '', 'twitter')
+        # The pages are cached on the way, ready for the content fetch.
+        fetcher = content_fetcher()
+        try:
+            for tweet in tweets:
+                for url in tweet.entities['urls']:
+                    expanded_url, title = get_url_title(
+                        url['expanded_url'], fetcher)
+                    new = BmarkMgr.get_by_url(
+                        expanded_url, connection.username)
+                    if not new:
+                        BmarkMgr.store(expanded_url, connection.username,
+                                       title, '', 'twitter')
+        finally:
+            fetcher.close()
         SocialMgr.update_last_tweet_data(connection, tweets[0].id)
     else:
         pass
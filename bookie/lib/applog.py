@@ -111,6 +111,59 @@ class BmarkLog(Log):
         BmarkLog.store(status, message, **data)
 
 
+class FulltextLog(Log):
+    """Fulltext index specific log items"""
+    component = "FULLTEXT"
+
+    @staticmethod
+    def reconcile(stats):
+        """Note what a run of the fulltext reconcile job found"""
+        message = ("Fulltext reconcile checked {checked} bookmarks, queued "
+                   "{queued} of {missing} missing and {stale} stale").format(
+                       **stats)
+        LOG.info(message)
+
+        data = {
+            'user': 'system',
+            'component': FulltextLog.component,
+            'payload': stats,
+        }
+
+        FulltextLog.store(Log.INFO, message, **data)
+
+    @staticmethod
+    def search(route, phrase, results, timeout, username=None):
+        """Note the time a search took if it hit or came close to its deadline
+
+        Searches that finish in under half their timeout aren't stored.
+
+        """
+        if not timeout or results.elapsed is None:
+            return
+        if not results.truncated and results.elapsed < timeout / 2:
+            return
+
+        message = "Search on {0} took {1:.3f}s of {2}s{3}".format(
+            route, results.elapsed, timeout,
+            ", truncated" if results.truncated else "")
+        LOG.info(message)
+
+        data = {
+            'user': username if username else 'anon',
+            'component': FulltextLog.component,
+            'payload': {
+                'route': route,
+                'phrase': phrase,
+                'elapsed': results.elapsed,
+                'timeout': timeout,
+                'truncated': results.truncated,
+            },
+        }
+
+        status = Log.WARNING if results.truncated else Log.INFO
+        FulltextLog.store(status, message, **data)
+
+
 class LogRecord(object):
     """A record in the log"""
 
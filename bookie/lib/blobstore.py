@@ -0,0 +1,306 @@
+"""Keep page bodies out of the database in compressed pack files
+
+Bodies are stored under the sha256 of their content, so a page that hasn't
+changed between fetches, or that's saved twice, is only kept once. Each blob
+is compressed and appended to the current pack file, and a small sqlite index
+next to the packs maps digests to where they landed. Reads mmap the pack and
+only decompress the blob asked for.
+
+Every blob is written with a header holding its digest and codec so the index
+can be rebuilt from the packs alone.
+
+The packs are only ever appended to, compact() drops the blobs nothing refers
+to any more by copying what's left of a pack to the end of the current one.
+
+"""
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'BKB1'
+# magic, sha256 digest, codec, compressed length
+HEADER = struct.Struct('>4s32sBI')
+CODECS = {
+    'zlib': 1,
+    'zstd': 2,
+}
+PACK_SIZE = 256 * 1024 * 1024
+# A blob stored this recently may belong to a row that isn't committed yet.
+COMPACT_GRACE = 60 * 60
+# Rewrite a pack once this share of its bytes is blobs nobody needs.
+COMPACT_RATIO = 0.3
+
+STORE = None
+
+
+def set_store(path, codec='zlib', pack_size=PACK_SIZE):
+    """Keep page bodies in the blob store at path, None keeps them in the db"""
+    global STORE
+    STORE = BlobStore(path, codec=codec, pack_size=pack_size) if path else None
+    return STORE
+
+
+def get_store():
+    """The configured blob store, if any"""
+    return STORE
+
+
+class BlobStore(object):
+    """Append-only, content addressed store of compressed blobs"""
+
+    def __init__(self, path, codec='zlib', pack_size=PACK_SIZE):
+        if codec not in CODECS:
+            raise ValueError('Unknown blob codec: ' + str(codec))
+        if codec == 'zstd' and zstandard is None:
+            LOG.warning('zstandard is not installed, storing blobs with zlib')
+            codec = 'zlib'
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.codec = codec
+        self.pack_size = pack_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reset(self):
+        """Connections and maps don't survive a fork, open our own"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._maps = {}
+            self._index = sqlite3.connect(
+                os.path.join(self.path, 'index.db'),
+                check_same_thread=False)
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS blobs ("
+                "digest TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, "
+                "length INTEGER, codec INTEGER, used REAL)")
+            columns = [row[1] for row in
+                       self._index.execute("PRAGMA table_info(blobs)")]
+            if 'used' not in columns:
+                # An index from before compaction, when each blob was last
+                # stored is the grace period compact() gives it.
+                self._index.execute("ALTER TABLE blobs ADD COLUMN used REAL")
+            self._index.commit()
+
+    def _pack_path(self, pack):
+        return os.path.join(self.path, 'pack-{0:06d}.pack'.format(pack))
+
+    @contextmanager
+    def _write_lock(self):
+        """Only one process appends to the packs at a time"""
+        with open(os.path.join(self.path, 'write.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _current_pack(self, size):
+        """The pack to append size bytes to, starting a new one when full"""
+        packs = sorted(
+            int(name[5:11]) for name in os.listdir(self.path)
+            if name.startswith('pack-') and name.endswith('.pack'))
+        if not packs:
+            return 1
+        pack = packs[-1]
+        used = os.path.getsize(self._pack_path(pack))
+        if used and used + size > self.pack_size:
+            return pack + 1
+        return pack
+
+    def _compress(self, data):
+        if self.codec == 'zstd':
+            return zstandard.ZstdCompressor().compress(data)
+        return zlib.compress(data, 6)
+
+    @staticmethod
+    def _decompress(codec, data):
+        if codec == CODECS['zstd']:
+            if zstandard is None:
+                raise IOError('zstandard is needed to read this blob')
+            return zstandard.ZstdDecompressor().decompress(data)
+        return zlib.decompress(data)
+
+    def _location(self, digest):
+        return self._index.execute(
+            "SELECT pack, offset, length, codec FROM blobs WHERE digest = ?",
+            (digest,)).fetchone()
+
+    def _map(self, pack, needed):
+        """An mmap of the pack covering at least needed bytes"""
+        found = self._maps.get(pack)
+        if found is None or len(found) < needed:
+            if found is not None:
+                found.close()
+            with open(self._pack_path(pack), 'rb') as fh:
+                found = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = found
+        return found
+
+    def _append(self, digest, codec, blob):
+        """Write the blob to the end of the current pack, with the write lock
+
+        Returns the (pack, offset) it landed at.
+
+        """
+        pack = self._current_pack(HEADER.size + len(blob))
+        with open(self._pack_path(pack), 'ab') as fh:
+            fh.seek(0, os.SEEK_END)
+            offset = fh.tell() + HEADER.size
+            fh.write(HEADER.pack(MAGIC, bytes.fromhex(digest), codec,
+                                 len(blob)))
+            fh.write(blob)
+            fh.flush()
+            os.fsync(fh.fileno())
+        return pack, offset
+
+    def put(self, data):
+        """Store the bytes, returning their (digest, length)"""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._reset()
+            if self._location(digest) is not None:
+                # Stored again, keep it out of the next compaction's way.
+                self._index.execute(
+                    "UPDATE blobs SET used = ? WHERE digest = ?",
+                    (time.time(), digest))
+                self._index.commit()
+                return digest, len(data)
+
+            blob = self._compress(data)
+            with self._write_lock():
+                # Someone may have beaten us to it while we waited.
+                if self._location(digest) is None:
+                    pack, offset = self._append(
+                        digest, CODECS[self.codec], blob)
+                    self._index.execute(
+                        "INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?)",
+                        (digest, pack, offset, len(blob),
+                         CODECS[self.codec], time.time()))
+                    self._index.commit()
+        return digest, len(data)
+
+    def get(self, digest):
+        """The bytes stored under digest, KeyError if there aren't any"""
+        with self._lock:
+            self._reset()
+            found = self._location(digest)
+            if found is None:
+                raise KeyError(digest)
+            pack, offset, length, codec = found
+            blob = self._map(pack, offset + length)[offset:offset + length]
+        return self._decompress(codec, blob)
+
+    def __contains__(self, digest):
+        with self._lock:
+            self._reset()
+            return self._location(digest) is not None
+
+    def rebuild_index(self):
+        """Recreate the index by walking the headers in the packs"""
+        with self._lock:
+            self._reset()
+            with self._write_lock():
+                self._index.execute("DELETE FROM blobs")
+                for name in sorted(os.listdir(self.path)):
+                    if not (name.startswith('pack-') and
+                            name.endswith('.pack')):
+                        continue
+                    pack = int(name[5:11])
+                    size = os.path.getsize(self._pack_path(pack))
+                    with open(self._pack_path(pack), 'rb') as fh:
+                        while True:
+                            header = fh.read(HEADER.size)
+                            if len(header) < HEADER.size:
+                                break
+                            magic, digest, codec, length = \
+                                HEADER.unpack(header)
+                            if magic != MAGIC or \
+                                    fh.tell() + length > size:
+                                # A write that didn't finish, nothing after
+                                # it can be trusted.
+                                LOG.error('Bad blob header in ' + name)
+                                break
+                            self._index.execute(
+                                "INSERT OR IGNORE INTO blobs "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (digest.hex(), pack, fh.tell(), length,
+                                 codec, os.path.getmtime(
+                                     self._pack_path(pack))))
+                            fh.seek(length, os.SEEK_CUR)
+                self._index.commit()
+
+    def compact(self, keep, grace=COMPACT_GRACE, ratio=COMPACT_RATIO):
+        """Drop the blobs whose digest isn't in keep
+
+        Blobs stored in the last grace seconds stay, their rows may not be
+        committed yet. The dropped blobs come out of the index, and a pack
+        with at least ratio of its bytes dropped has what's left of it
+        copied to the current pack and is removed. The current pack is never
+        rewritten, so pack numbers aren't reused under other processes.
+
+        Returns the counts of blobs dropped, packs removed and bytes freed.
+
+        """
+        stats = {'removed': 0, 'packs': 0, 'bytes': 0}
+        cutoff = time.time() - grace
+        with self._lock:
+            self._reset()
+            with self._write_lock():
+                packs = {}
+                for digest, pack, offset, length, codec, used in \
+                        self._index.execute("SELECT * FROM blobs"):
+                    live, dead = packs.setdefault(pack, ([], []))
+                    if digest in keep or (used or 0) > cutoff:
+                        live.append((digest, offset, length, codec))
+                    else:
+                        dead.append((digest, length))
+
+                newest = max(packs) if packs else 0
+                for pack, (live, dead) in sorted(packs.items()):
+                    if not dead:
+                        continue
+                    self._index.executemany(
+                        "DELETE FROM blobs WHERE digest = ?",
+                        [(digest,) for digest, length in dead])
+                    stats['removed'] += len(dead)
+                    dropped = sum(length for digest, length in dead)
+                    size = dropped + sum(item[2] for item in live)
+                    if pack >= newest or dropped < size * ratio:
+                        self._index.commit()
+                        continue
+
+                    with open(self._pack_path(pack), 'rb') as fh:
+                        for digest, offset, length, codec in live:
+                            fh.seek(offset)
+                            moved = self._append(digest, codec,
+                                                 fh.read(length))
+                            self._index.execute(
+                                "UPDATE blobs SET pack = ?, offset = ? "
+                                "WHERE digest = ?", moved + (digest,))
+                    self._index.commit()
+                    stats['bytes'] += os.path.getsize(self._pack_path(pack)) \
+                        - sum(HEADER.size + item[2] for item in live)
+                    os.remove(self._pack_path(pack))
+                    found = self._maps.pop(pack, None)
+                    if found is not None:
+                        found.close()
+                    stats['packs'] += 1
+        return stats
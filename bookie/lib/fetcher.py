@@ -0,0 +1,526 @@
+"""Fetch bookmark content for many urls at once
+
+The downloads run on a thread pool, a host's urls only handed out while it
+has a free slot so a slow host only ties up its own. There's a cap on the
+total number of requests in flight and a smaller cap per host, and each host
+gets a keep-alive session so pages from the same site reuse their
+connections.
+
+Parsing the readable content out of a page is cpu bound, so that's a second
+stage run on a process pool sized to the cores, leaving the threads free to
+keep downloading.
+
+With a response cache, pages fetched recently are read from there instead,
+and urls known to redirect are requested from where they end up.
+
+Bodies are streamed, anything that turns out not to be html is dropped after
+its first KB and pages are cut off at max_bytes.
+
+A host that fails host_failures times in a row is given up on for the rest
+of the run, its urls come back with a 906 status without a request.
+
+"""
+import billiard
+import logging
+import multiprocessing
+import os
+import requests
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from collections import defaultdict
+from collections import deque
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import BaseHTTPRequestHandler as HTTPH
+from queue import Queue
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from bookie.lib.httpcache import CachedResponse
+from bookie.lib.readable import CHUNK_SIZE
+from bookie.lib.readable import MAX_BYTES
+from bookie.lib.readable import Readable
+from bookie.lib.readable import ReadUrl
+from bookie.lib.readable import STATUS_CODES
+from bookie.lib.readable import USER_AGENT
+from bookie.lib.readable import extract
+from bookie.lib.readable import read_body
+
+LOG = logging.getLogger(__name__)
+
+# No response at all: bad connections, timeouts, broken transfers
+HOST_ERRORS = (901, 902, 903, 905)
+
+
+def host_down(status):
+    """Does a fetch that ended with status count against its host"""
+    return status in HOST_ERRORS or status == 429 or \
+        (status is not None and 500 <= status < 600)
+
+
+class StageStats(object):
+    """Track the throughput of one stage of the content pipeline"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+
+    def record(self, started, size=0, error=False, finished=None):
+        """Count one item that began at started, and finished just now"""
+        now = finished or time.time()
+        if self.started is None or started < self.started:
+            self.started = started
+        self.finished = now
+        self.count += 1
+        self.errors += 1 if error else 0
+        self.bytes += size
+        self.busy += now - started
+
+    def __iter__(self):
+        elapsed = (self.finished - self.started) if self.count else 0
+        yield 'count', self.count
+        yield 'errors', self.errors
+        yield 'bytes', self.bytes
+        yield 'elapsed', round(elapsed, 3)
+        yield 'per_second', round(self.count / elapsed, 2) if elapsed else 0
+        yield 'avg_seconds', round(self.busy / self.count, 3) \
+            if self.count else 0
+
+
+class DaemonPool(object):
+    """A process pool executor that can be started from a daemon process
+
+    billiard is celery's fork of multiprocessing and doesn't hold daemon
+    processes back from starting a pool.
+
+    """
+
+    def __init__(self, processes):
+        self.pool = billiard.Pool(processes)
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.pool.apply_async(fn, args, callback=future.set_result,
+                              error_callback=future.set_exception)
+        return future
+
+    def shutdown(self, wait=True):
+        self.pool.close()
+        if wait:
+            self.pool.join()
+
+
+class ContentFetcher(object):
+    """Download urls concurrently into Readable objects"""
+
+    def __init__(self, concurrency=20, per_host=2, connect_timeout=5.0,
+                 read_timeout=20.0, parse_processes=None, host_failures=5,
+                 max_bytes=MAX_BYTES, cache=None):
+        self.concurrency = concurrency
+        self.cache = cache
+        self.per_host = per_host
+        self.max_bytes = max_bytes
+        self.host_failures = host_failures
+        self.timeout = (connect_timeout, read_timeout)
+        self.parse_processes = parse_processes or os.cpu_count() or 1
+        self.fetch_stats = StageStats('fetch')
+        self.parse_stats = StageStats('parse')
+        self._sessions = {}
+        self._failures = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """The throughput numbers for each stage so far"""
+        return {
+            'fetch': dict(self.fetch_stats),
+            'parse': dict(self.parse_stats),
+        }
+
+    @staticmethod
+    def host(url):
+        """The key the per host limit is kept under"""
+        return urlparse(url).netloc.lower()
+
+    def session(self, host):
+        """The keep-alive session for this host"""
+        with self._lock:
+            if host not in self._sessions:
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.per_host,
+                                      max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['User-Agent'] = USER_AGENT
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def skip(self, url):
+        """A read for a url on a host we've given up on"""
+        read = Readable()
+        read.url = url
+        read.error(STATUS_CODES['906'],
+                   'Skipped, {0} is down'.format(self.host(url)))
+        return read
+
+    def close(self):
+        """Drop the connections held open by the sessions"""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+    def download(self, url, parse=True, validators=None):
+        """Fetch a single url, this blocks
+
+        Unless parse is False the readable content is parsed out here too,
+        otherwise the page is left on read.body for needs_parse pages.
+
+        validators are the etag, last_modified and digest of the last fetch.
+        If the server says the page hasn't changed, or it hashes the same,
+        read.unchanged is set and there's nothing to parse.
+
+        read.url ends up as the url the page was finally served from.
+
+        """
+        read = Readable()
+        clean_url = ReadUrl.clean_url(url, read)
+        if clean_url is None:
+            return read
+        read.url = clean_url
+        validators = validators or {}
+
+        target = clean_url
+        if self.cache is not None:
+            try:
+                cached = self.cache.get(clean_url)
+                if cached is not None:
+                    return self.cached(read, cached, validators, parse)
+                target = self.cache.resolve(clean_url)
+            except (sqlite3.Error, OSError) as exc:
+                LOG.warning('Response cache unavailable: ' + str(exc))
+
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        try:
+            LOG.debug('Fetching: ' + target)
+            resp = self.session(self.host(target)).get(
+                target, headers=headers, timeout=self.timeout,
+                stream=True)
+        except requests.exceptions.RequestException as exc:
+            return self.failed(read, exc)
+
+        try:
+            read.headers = resp.headers
+            read.etag = resp.headers.get('etag')
+            read.last_modified = resp.headers.get('last-modified')
+            content_type = resp.headers.get('content-type')
+            if content_type:
+                read.content_type = \
+                    content_type.split(';')[0].strip().lower()
+
+            if resp.status_code == 304:
+                read.status = STATUS_CODES['200']
+                read.unchanged = True
+                read.digest = validators.get('digest')
+                return read
+
+            if resp.status_code >= 400:
+                # for some reason getting a code 429 from a server
+                if resp.status_code in HTTPH.responses and \
+                        resp.status_code not in [429]:
+                    read.error(resp.status_code,
+                               HTTPH.responses[resp.status_code][0])
+                else:
+                    read.error(resp.status_code,
+                               str(resp.status_code) + ': ' + clean_url)
+                return read
+
+            read.status = STATUS_CODES['200']
+            read.url = resp.url
+            body = read_body(read, resp.iter_content(CHUNK_SIZE),
+                             content_type, max_bytes=self.max_bytes)
+        except requests.exceptions.RequestException as exc:
+            return self.failed(read, exc)
+        finally:
+            resp.close()
+
+        self.remember(clean_url, read, body)
+
+        if read.digest and read.digest == validators.get('digest'):
+            read.unchanged = True
+        elif body is not None:
+            read.body = body
+            if parse:
+                self.parse(read)
+        return read
+
+    def cached(self, read, cached, validators, parse=True):
+        """Fill the read in from a cached response, as download would"""
+        read.url = cached.url
+        read.status = STATUS_CODES['200']
+        read.content_type = cached.content_type
+        read.etag = cached.etag
+        read.last_modified = cached.last_modified
+        read.digest = cached.digest
+        read.truncated = cached.truncated
+        if read.digest and read.digest == validators.get('digest'):
+            read.unchanged = True
+        elif cached.body is not None:
+            read.body = cached.body
+            if parse:
+                self.parse(read)
+        return read
+
+    def remember(self, url, read, body):
+        """Keep the response in the cache for whoever asks for it next"""
+        if self.cache is None:
+            return
+        try:
+            self.cache.put(url, CachedResponse(
+                read.url,
+                content_type=read.content_type,
+                etag=read.etag,
+                last_modified=read.last_modified,
+                digest=read.digest,
+                truncated=read.truncated,
+                body=body))
+        except (sqlite3.Error, OSError) as exc:
+            LOG.warning('Could not cache {0}: {1}'.format(read.url, exc))
+
+    @staticmethod
+    def failed(read, exc):
+        """Set the error for a request that raised exc on the read"""
+        if isinstance(exc, requests.exceptions.Timeout):
+            read.error(STATUS_CODES['902'], str(exc))
+        elif isinstance(exc, (requests.exceptions.InvalidURL,
+                              requests.exceptions.InvalidSchema,
+                              requests.exceptions.MissingSchema,
+                              requests.exceptions.ConnectionError)):
+            read.error(STATUS_CODES['901'], str(exc))
+        elif isinstance(exc, requests.exceptions.ChunkedEncodingError):
+            read.error(STATUS_CODES['903'], str(exc))
+        else:
+            read.error(STATUS_CODES['902'], str(exc))
+        return read
+
+    @staticmethod
+    def needs_parse(read):
+        """Is there a downloaded page waiting on the parse stage"""
+        return read.body is not None
+
+    def parse(self, read, parsed=None, started=None):
+        """Set the readable content from the page on the read
+
+        parsed is the extract result when the parse ran elsewhere, started
+        when it began.
+
+        """
+        started = started or time.time()
+        size = len(read.body)
+        ReadUrl.parse_document(read, read.body, read.url, parsed=parsed)
+        read.body = None
+        self.parse_stats.record(started, size=size, error=read.is_error())
+        return read
+
+    def parse_pool(self):
+        """The executor for the parse stage
+
+        Celery's prefork workers run as daemon processes that
+        multiprocessing won't let start children of their own, so they get a
+        billiard pool instead.
+
+        """
+        if multiprocessing.current_process().daemon:
+            return DaemonPool(self.parse_processes)
+        return ProcessPoolExecutor(max_workers=self.parse_processes)
+
+    def fetch_all(self, urls, handle, batch_size=50, validators=None):
+        """Fetch each (key, url) pair and pass the results on in batches
+
+        handle is called with a list of (key, Readable) pairs every
+        batch_size results, in the calling thread. The downloads and parses
+        already under way carry on, and new ones keep being started, while
+        it runs. validators maps keys to what their last fetch saw so those
+        are only parsed if they changed. Returns how many urls were fetched.
+
+        """
+        run = FetchRun(self, urls, validators or {}, self.parse_pool())
+        count = 0
+        batch = []
+        try:
+            run.dispatch()
+            for idx in range(len(urls)):
+                batch.append(run.next())
+                count += 1
+                if len(batch) >= batch_size:
+                    handle(batch)
+                    batch = []
+            if batch:
+                handle(batch)
+        finally:
+            run.stop()
+        return count
+
+    def given_up(self, host):
+        """Has the host failed too many times in a row to try again"""
+        return bool(self.host_failures) and \
+            self._failures[host] >= self.host_failures
+
+    def count_failure(self, host, status):
+        """Keep count of the host's failures in a row"""
+        if host_down(status):
+            self._failures[host] += 1
+        else:
+            self._failures[host] = 0
+
+
+class FetchRun(object):
+    """The downloads and parses of one ContentFetcher.fetch_all call
+
+    The urls are handed out to a thread pool, a host's urls only while it
+    has fewer than per_host in flight. Each finished download starts the
+    next ones and goes on to the parse pool from the download thread, so
+    none of it waits on the thread taking the results.
+
+    """
+
+    def __init__(self, fetcher, urls, validators, parser):
+        self.fetcher = fetcher
+        self.validators = validators
+        self.parser = parser
+        self.downloads = ThreadPoolExecutor(max_workers=fetcher.concurrency)
+        self.results = Queue()
+        self.waiting = OrderedDict()
+        for key, url in urls:
+            self.waiting.setdefault(
+                fetcher.host(url), deque()).append((key, url))
+        self.active = defaultdict(int)
+        self.running = 0
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def dispatch(self):
+        """Start downloads while there are free slots
+
+        A download that's already done when its callback is added finishes
+        in here, its dispatch is folded into this one rather than nested.
+
+        """
+        if getattr(self.local, 'dispatching', False):
+            self.local.again = True
+            return
+        self.local.dispatching = True
+        try:
+            self.local.again = True
+            while self.local.again:
+                self.local.again = False
+                self._dispatch()
+        finally:
+            self.local.dispatching = False
+
+    def _dispatch(self):
+        starts = []
+        skips = []
+        with self.lock:
+            if self.stopped:
+                return
+            for host in list(self.waiting):
+                pending = self.waiting[host]
+                while pending and self.active[host] < self.fetcher.per_host \
+                        and self.running < self.fetcher.concurrency:
+                    key, url = pending.popleft()
+                    if self.fetcher.given_up(host):
+                        skips.append((key, url))
+                        continue
+                    self.active[host] += 1
+                    self.running += 1
+                    starts.append((key, url, host))
+                if not pending:
+                    del self.waiting[host]
+
+        for key, url in skips:
+            self.results.put((key, self.fetcher.skip(url), None, None))
+        for key, url, host in starts:
+            try:
+                future = self.downloads.submit(
+                    self.fetcher.download, url, False,
+                    self.validators.get(key))
+            except RuntimeError:
+                # Stopped while we were handing these out.
+                return
+            future.add_done_callback(
+                partial(self.downloaded, key, url, host, time.time()))
+
+    def downloaded(self, key, url, host, started, future):
+        """Send a finished download on to the parse and start the next"""
+        try:
+            read = future.result()
+        except Exception as exc:
+            LOG.exception('Failed fetching: ' + url)
+            read = Readable()
+            read.error(STATUS_CODES['902'], str(exc))
+        fetched = (started, time.time())
+
+        with self.lock:
+            self.active[host] -= 1
+            self.running -= 1
+            # Urls we couldn't make a request for say nothing of the host.
+            if read.url is not None:
+                self.fetcher.count_failure(host, read.status)
+        self.dispatch()
+
+        if not self.fetcher.needs_parse(read):
+            self.results.put((key, read, fetched, None))
+            return
+        parse_started = time.time()
+        try:
+            parsed = self.parser.submit(extract, read.body, read.url)
+        except Exception as exc:
+            LOG.exception('Failed parsing: ' + url)
+            parsed = Future()
+            parsed.set_exception(exc)
+        parsed.add_done_callback(
+            lambda done: self.results.put(
+                (key, read, fetched, (parse_started, done))))
+
+    def next(self):
+        """Wait for the next result and finish it off, a (key, Readable)"""
+        key, read, fetched, parsing = self.results.get()
+        fetcher = self.fetcher
+        if fetched is not None:
+            fetcher.fetch_stats.record(
+                fetched[0], size=len(read.body) if read.body else 0,
+                error=read.is_error(), finished=fetched[1])
+        if parsing is not None:
+            started, done = parsing
+            try:
+                parsed = done.result()
+            except Exception as exc:
+                LOG.error('Failed parsing: {0}: {1}'.format(read.url, exc))
+                parsed = (STATUS_CODES['900'], str(exc), None, None, None)
+            fetcher.parse(read, parsed=parsed, started=started)
+        return key, read
+
+    def stop(self):
+        """Let what's in flight finish and shut the pools down"""
+        with self.lock:
+            self.stopped = True
+        self.downloads.shutdown(wait=True)
+        self.parser.shutdown(wait=True)
@@ -0,0 +1,211 @@
+"""Keep fetched pages on disk for a while so they're only downloaded once
+
+Title lookups for tweeted links and the content fetch both want the same
+pages, usually within minutes of each other. Responses are kept under the
+url they were finally served from for ttl seconds, and a redirect map sends
+the urls that led there, shortened links and the like, straight to it for
+redirect_ttl seconds.
+
+The bodies are kept decoded, as the fetcher reads them, compressed in files
+named for their sha256 with a small sqlite index next to them. A body is on
+disk before its row is, so prune leaves the bodies nothing points at alone
+until they're body_grace seconds old.
+
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+LOG = logging.getLogger(__name__)
+
+TTL = 6 * 60 * 60
+REDIRECT_TTL = 30 * 24 * 60 * 60
+BODY_GRACE = 10 * 60
+
+CACHE = None
+
+
+def set_cache(path, ttl=TTL, redirect_ttl=REDIRECT_TTL):
+    """Cache responses in the directory at path, None turns the cache off"""
+    global CACHE
+    CACHE = ResponseCache(path, ttl=ttl, redirect_ttl=redirect_ttl) \
+        if path else None
+    return CACHE
+
+
+def get_cache():
+    """The configured response cache, if any"""
+    return CACHE
+
+
+class CachedResponse(object):
+    """What was kept of a response"""
+
+    def __init__(self, url, content_type=None, etag=None,
+                 last_modified=None, digest=None, truncated=False,
+                 body=None):
+        self.url = url
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.digest = digest
+        self.truncated = truncated
+        self.body = body
+
+
+class ResponseCache(object):
+    """Responses by their final url, and where other urls redirect to"""
+
+    def __init__(self, path, ttl=TTL, redirect_ttl=REDIRECT_TTL,
+                 body_grace=BODY_GRACE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.ttl = ttl
+        self.redirect_ttl = redirect_ttl
+        self.body_grace = body_grace
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _reset(self):
+        """Connections don't survive a fork, open our own"""
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._index = sqlite3.connect(
+                os.path.join(self.path, 'index.db'),
+                timeout=30,
+                check_same_thread=False)
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "url TEXT PRIMARY KEY, content_type TEXT, etag TEXT, "
+                "last_modified TEXT, digest TEXT, truncated INTEGER, "
+                "body TEXT, expires REAL)")
+            self._index.execute(
+                "CREATE TABLE IF NOT EXISTS redirects ("
+                "url TEXT PRIMARY KEY, final_url TEXT, expires REAL)")
+            self._index.commit()
+
+    def _body_path(self, key):
+        return os.path.join(self.path, key[:2], key + '.z')
+
+    def _write_body(self, body):
+        """Store the text once under its sha256, returning that key"""
+        data = body.encode('utf-8')
+        key = hashlib.sha256(data).hexdigest()
+        path = self._body_path(key)
+        try:
+            # Already there, start its grace period over so a prune running
+            # before our row is in doesn't take it.
+            os.utime(path)
+        except OSError:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and moved in so no one reads half a file.
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(zlib.compress(data, 6))
+            os.replace(tmp, path)
+        return key
+
+    def _read_body(self, key):
+        with open(self._body_path(key), 'rb') as fh:
+            return zlib.decompress(fh.read()).decode('utf-8')
+
+    def resolve(self, url, now=None):
+        """Where url is known to redirect to, url itself if it isn't"""
+        now = now or time.time()
+        with self._lock:
+            self._reset()
+            found = self._index.execute(
+                "SELECT final_url FROM redirects "
+                "WHERE url = ? AND expires > ?", (url, now)).fetchone()
+        return found[0] if found else url
+
+    def get(self, url, now=None):
+        """The CachedResponse for url, following redirects, or None"""
+        now = now or time.time()
+        final_url = self.resolve(url, now=now)
+        with self._lock:
+            self._reset()
+            found = self._index.execute(
+                "SELECT content_type, etag, last_modified, digest, "
+                "truncated, body FROM responses "
+                "WHERE url = ? AND expires > ?", (final_url, now)).fetchone()
+        if found is None:
+            return None
+
+        content_type, etag, last_modified, digest, truncated, key = found
+        body = None
+        if key is not None:
+            try:
+                body = self._read_body(key)
+            except (IOError, zlib.error):
+                LOG.warning('Cached body missing for: ' + final_url)
+                return None
+        return CachedResponse(final_url, content_type=content_type,
+                              etag=etag, last_modified=last_modified,
+                              digest=digest, truncated=bool(truncated),
+                              body=body)
+
+    def put(self, url, response, now=None):
+        """Keep the CachedResponse that url was finally served as"""
+        now = now or time.time()
+        key = None
+        if response.body is not None:
+            key = self._write_body(response.body)
+        with self._lock:
+            self._reset()
+            self._index.execute(
+                "INSERT OR REPLACE INTO responses VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?)",
+                (response.url, response.content_type, response.etag,
+                 response.last_modified, response.digest,
+                 int(response.truncated), key, now + self.ttl))
+            if url != response.url:
+                self._index.execute(
+                    "INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)",
+                    (url, response.url, now + self.redirect_ttl))
+            self._index.commit()
+
+    def prune(self, now=None):
+        """Drop what has expired, and the bodies nothing points at
+
+        The bodies go by the clock, not now, they're only removed once their
+        file is body_grace seconds old.
+
+        """
+        now = now or time.time()
+        with self._lock:
+            self._reset()
+            self._index.execute(
+                "DELETE FROM responses WHERE expires <= ?", (now,))
+            self._index.execute(
+                "DELETE FROM redirects WHERE expires <= ?", (now,))
+            self._index.commit()
+            keep = set(key for (key,) in self._index.execute(
+                "SELECT DISTINCT body FROM responses "
+                "WHERE body IS NOT NULL"))
+
+        removed = 0
+        for name in os.listdir(self.path):
+            folder = os.path.join(self.path, name)
+            if len(name) != 2 or not os.path.isdir(folder):
+                continue
+            for body in os.listdir(folder):
+                if not body.endswith('.z') or body[:-2] in keep:
+                    continue
+                try:
+                    body = os.path.join(folder, body)
+                    if os.path.getmtime(body) > time.time() - self.body_grace:
+                        # Likely a put whose row isn't in yet.
+                        continue
+                    os.remove(body)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
@@ -232,10 +232,10 @@ class DelImporter(Importer):
         transaction.commit()
 
         from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        # Fetch the content for the bookmarks in this set that we saved in
+        # one go.
+        if ids:
+            tasks.fetch_bmarks_content.delay(ids)
 
         # Start a new transaction for the next grouping.
         transaction.begin()
@@ -327,10 +327,10 @@ class DelXMLImporter(Importer):
         transaction.commit()
 
         from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        # Fetch the content for the bookmarks in this set that we saved in
+        # one go.
+        if ids:
+            tasks.fetch_bmarks_content.delay(ids)
 
         # Start a new transaction for the next grouping.
         transaction.begin()
@@ -465,10 +465,10 @@ class GBookmarkImporter(Importer):
         transaction.commit()
 
         from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        # Fetch the content for the bookmarks in this set that we saved in
+        # one go.
+        if ids:
+            tasks.fetch_bmarks_content.delay(ids)
 
 
 class FBookmarkImporter(Importer):
@@ -612,7 +612,7 @@ class FBookmarkImporter(Importer):
         transaction.commit()
 
         from bookie.bcelery import tasks
-        # For each bookmark in this set that we saved, sign up to
-        # fetch its content.
-        for bid in ids:
-            tasks.fetch_bmark_content.delay(bid)
+        # Fetch the content for the bookmarks in this set that we saved in
+        # one go.
+        if ids:
+            tasks.fetch_bmarks_content.delay(ids)
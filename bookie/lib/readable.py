@@ -1,13 +1,17 @@
 """Handle processing and setting web content into Readability/cleaned
 
 """
+import codecs
+import hashlib
 import logging
 import lxml
+import re
 import socket
 
 from http.client import InvalidURL, BadStatusLine, IncompleteRead
 from http.server import BaseHTTPRequestHandler as HTTPH
 from breadability.readable import Article
+from bookie.lib.utils import content_tags
 from urllib.parse import urlparse
 from urllib.request import Request, HTTPError, URLError, build_opener
 
@@ -41,6 +45,7 @@ STATUS_CODES = DictObj({
     '903': 903,   # httplib.IncompleteRead error
     '904': 904,   # lxml error about document is empty
     '905': 905,   # httplib.BadStatusLine
+    '906': 906,   # host is down, skipped without a request
 })
 
 IMAGE_TYPES = DictObj({
@@ -51,11 +56,168 @@ IMAGE_TYPES = DictObj({
 })
 
 
+# Pages are read a chunk at a time and given up on past MAX_BYTES. The first
+# SNIFF_BYTES are checked for what the body really is before reading on.
+CHUNK_SIZE = 64 * 1024
+MAX_BYTES = 5 * 1024 * 1024
+SNIFF_BYTES = 1024
+
+HTML_TYPES = ('text/html', 'application/xhtml+xml')
+# Declared types that are often really html, anything else that isn't html is
+# dropped without reading the body.
+SNIFF_TYPES = ('text/plain', 'text/xml', 'application/xml',
+               'application/octet-stream', 'binary/octet-stream')
+HTML_MARKERS = (b'<!doctype html', b'<html', b'<head', b'<body', b'<title',
+                b'<meta', b'<div', b'<p>', b'<script', b'<!--')
+MAGIC_TYPES = (
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+    (b'7z\xbc\xaf', 'application/x-7z-compressed'),
+    (b'Rar!', 'application/x-rar-compressed'),
+    (b'\x89PNG', 'image/png'),
+    (b'GIF8', 'image/gif'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'ID3', 'audio/mpeg'),
+    (b'OggS', 'audio/ogg'),
+    (b'\x1aE\xdf\xa3', 'video/webm'),
+    (b'RIFF', 'application/octet-stream'),
+    (b'\x7fELF', 'application/octet-stream'),
+    (b'MZ', 'application/octet-stream'),
+)
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+CHARSET = re.compile(br'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+
+def sniff(head, declared=None):
+    """The content type of a body going by its first bytes"""
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return declared if declared in HTML_TYPES else 'text/html'
+    for magic, content_type in MAGIC_TYPES:
+        if head.startswith(magic):
+            return content_type
+    if head[4:8] == b'ftyp':
+        return 'video/mp4'
+
+    lowered = head.lower()
+    if any(marker in lowered for marker in HTML_MARKERS):
+        return 'text/html'
+    if b'\x00' in head:
+        return 'application/octet-stream'
+    return declared or 'text/plain'
+
+
+def charset(content_type, head):
+    """The encoding to decode a body with
+
+    A byte order mark wins, then the charset in the Content-Type header, then
+    one in a meta tag in the head of the page, then utf-8.
+
+    """
+    for bom, encoding in BOMS:
+        if head.startswith(bom):
+            return encoding
+    for found in (CHARSET.search((content_type or '').encode('latin-1',
+                                                             'replace')),
+                  CHARSET.search(head)):
+        if found:
+            encoding = found.group(1).decode('ascii', 'replace')
+            try:
+                return codecs.lookup(encoding).name
+            except LookupError:
+                pass
+    return 'utf-8'
+
+
+def read_body(read, chunks, content_type=None, max_bytes=MAX_BYTES):
+    """Read a page body from an iterable of byte chunks
+
+    Bodies that aren't html are dropped by their declared type, or after the
+    first SNIFF_BYTES, without reading the rest. Html is decoded as it comes
+    in so the raw bytes are never held on to, and reading stops at max_bytes.
+    The content type is set on the read, and for a body that's kept the
+    digest of the bytes read and whether it was cut off at max_bytes.
+
+    Returns the decoded body, None if it was dropped.
+
+    """
+    declared = None
+    if content_type:
+        declared = content_type.split(';')[0].strip().lower()
+    if declared and declared not in HTML_TYPES + SNIFF_TYPES:
+        read.content_type = declared
+        return None
+
+    digest = hashlib.sha256()
+    head = b''
+    decoder = None
+    parts = []
+    size = 0
+    truncated = False
+
+    def start(head):
+        """The decoder for the body, None if it isn't html"""
+        found = sniff(head, declared)
+        if found not in HTML_TYPES:
+            read.content_type = found
+            return None
+        read.content_type = declared if declared in HTML_TYPES else found
+        return codecs.getincrementaldecoder(
+            charset(content_type, head))(errors='replace')
+
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if max_bytes and size + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - size]
+            truncated = True
+        size += len(chunk)
+        digest.update(chunk)
+
+        if decoder is None:
+            head += chunk
+            if len(head) < SNIFF_BYTES and not truncated:
+                continue
+            decoder = start(head)
+            if decoder is None:
+                return None
+            chunk = head
+        parts.append(decoder.decode(chunk))
+        if truncated:
+            LOG.warning('Read the first {0} bytes of: {1}'.format(
+                max_bytes, read.url))
+            break
+
+    if decoder is None:
+        # The whole body was shorter than what we sniff.
+        decoder = start(head)
+        if decoder is None:
+            return None
+        parts.append(decoder.decode(head))
+    parts.append(decoder.decode(b'', True))
+    read.truncated = truncated
+    read.digest = digest.hexdigest()
+    return ''.join(parts)
+
+
 class Readable(object):
     """Understand the base concept of making readable"""
     is_error = False
+    body = None
+    clean_content = None
     content = None
     content_type = None
+    digest = None
+    etag = None
+    last_modified = None
+    unchanged = False
+    truncated = False
+    suggested_tags = None
     headers = None
     status_message = None
     status = None
@@ -98,6 +260,27 @@ class Readable(object):
             self.content_type = content_type
 
 
+def extract(body, url=None):
+    """Parse the readable html and its plain text out of a page in one pass
+
+    This is the cpu heavy part of reading a page and may run in another
+    process, so it takes and returns plain values: a (status, message,
+    content, clean_content, tags) tuple. tags are the (tag, score) suggestions
+    for the page, best first.
+
+    """
+    try:
+        document = Article(body, url=url)
+        if not document.readable:
+            return (STATUS_CODES['900'], "Could not parse document.",
+                    None, None, None)
+        clean_content = ' '.join(document.readable_dom.itertext())
+        return (STATUS_CODES['200'], None, document.readable, clean_content,
+                content_tags(clean_content))
+    except lxml.etree.ParserError as exc:
+        return (STATUS_CODES['904'], str(exc), None, None, None)
+
+
 class ReadContent(object):
     """Handle some given content and parse the readable out of it"""
 
@@ -120,10 +303,13 @@ class ReadUrl(object):
     """Fetch a url and read some content out of it"""
 
     @staticmethod
-    def parse(url):
-        """Fetch the given url and parse out a Readable Obj for the content"""
-        read = Readable()
+    def clean_url(url, read):
+        """Tidy the url up for fetching
+
+        Returns None, with the error set on the read, if the url isn't one we
+        can fetch.
 
+        """
         # print(url)
         if not isinstance(url, str):
             url = url.decode('utf-8')
@@ -150,7 +336,7 @@ class ReadUrl(object):
                 read.error(
                     STATUS_CODES['901'],
                     'Invalid url scheme for readable content')
-                return read
+                return None
 
             if parsed.query is not None and parsed.query != '':
                 query = '?'
@@ -164,6 +350,32 @@ class ReadUrl(object):
                 parsed[4],
                 query=query)
             # print(clean_url)
+        return clean_url
+
+    @staticmethod
+    def parse_document(read, body, url, parsed=None):
+        """Set the readable content of the body onto the read
+
+        parsed is the result of extract if it has already been run.
+
+        """
+        status, message, content, clean_content, tags = (
+            parsed or extract(body, url=url))
+        if content is None:
+            read.error(status, message)
+        else:
+            read.set_content(content)
+            read.clean_content = clean_content
+            read.suggested_tags = tags
+        return read
+
+    @staticmethod
+    def parse(url):
+        """Fetch the given url and parse out a Readable Obj for the content"""
+        read = Readable()
+        clean_url = ReadUrl.clean_url(url, read)
+        if clean_url is None:
+            return read
 
         try:
             LOG.debug('Readable Parsed: ' + clean_url)
@@ -206,21 +418,21 @@ class ReadUrl(object):
         LOG.debug(read.status)
 
         # let's check to make sure we should be parsing this
-        # for example: don't parse images
-        if not read.is_error() and not read.is_image():
+        # for example: don't parse images, videos or archives
+        if not read.is_error():
+            read.url = clean_url
             try:
-                document = Article(fh.read(), url=clean_url)
-                if not document.readable:
-                    read.error(STATUS_CODES['900'],
-                               "Could not parse document.")
-                else:
-                    read.set_content(document.readable)
-
+                body = read_body(read,
+                                 iter(lambda: fh.read(CHUNK_SIZE), b''),
+                                 fh.headers.get('Content-Type'))
             except socket.error as exc:
                 read.error(STATUS_CODES['902'], str(exc))
             except IncompleteRead as exc:
                 read.error(STATUS_CODES['903'], str(exc))
-            except lxml.etree.ParserError as exc:
-                read.error(STATUS_CODES['904'], str(exc))
+            else:
+                if body is not None:
+                    ReadUrl.parse_document(read, body, clean_url)
+            finally:
+                fh.close()
 
         return read
@@ -1,9 +1,11 @@
 
 from bs4 import BeautifulSoup
-import requests
 from tweepy import OAuthHandler
 from tweepy import API
 
+from bookie.lib.fetcher import ContentFetcher
+from bookie.lib.httpcache import get_cache
+
 
 def create_twitter_userapi(consumer_key, consumer_secret,
                            oauth_token, oauth_verifier):
@@ -22,11 +24,24 @@ def create_twitter_OAuthHandler(consumer_key, consumer_secret):
     return auth_url
 
 
-def get_url_title(url):
-    """Return title of webpage """
+def get_url_title(url, fetcher=None):
+    """Return the url a link ends up at and the title of the webpage
+
+    The page goes through the response cache so fetching its content for the
+    bookmark afterwards doesn't download it again.
+
+    """
+    own = fetcher is None
     try:
-        webpage = requests.get(url)
-        parsed_html = BeautifulSoup(webpage.content, 'html.parser')
-        return webpage.url, parsed_html.title.string
+        if own:
+            fetcher = ContentFetcher(cache=get_cache())
+        read = fetcher.download(url, parse=False)
+        if read.body is None:
+            return read.url or url, ''
+        parsed_html = BeautifulSoup(read.body, 'html.parser')
+        return read.url, parsed_html.title.string
     except:
         return url, ''
+    finally:
+        if own and fetcher is not None:
+            fetcher.close()
@@ -1,44 +1,201 @@
 """Generic and small utilities that are used in Bookie"""
 import re
+import threading
+
+from collections import OrderedDict
 from urllib.parse import urlparse, quote
-from textblob import TextBlob
+from topia.termextract import extract
 
+# How many tags are kept for a page's content
+MAX_CONTENT_TAGS = 20
+# How many urls and titles each process keeps suggested tags for
+SUGGEST_CACHE_SIZE = 4096
 
-def _generate_nouns_from_url(string):
-    res = set()
-    if string:
-        string = string.replace('_', ' ')
-        words = re.findall(r"[\w]+", string)
+TERMS = None
+NOUNS = None
+_LOAD_LOCK = threading.Lock()
 
-        clean_path = " ".join(words)
-        path_tokens = TextBlob(clean_path)
-        title_nouns = path_tokens.noun_phrases
-        for result in title_nouns:
-            # If result has spaces split it to match our tag system.
-            nouns = result.split()
-            res.update(nouns)
-    return res
 
+class SuggestCache(object):
+    """Bounded LRU of the tags suggested for a url or title"""
 
-def suggest_tags(data):
-    """Suggest tags based on the content string `data`"""
-    tag_set = set()
-    if not data:
-        return tag_set
+    def __init__(self, size=SUGGEST_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
 
-    # The string might be a url that needs some cleanup before we parse for
-    # suggestions
-    parsed = urlparse(data)
+    def get(self, data):
+        """The tags suggested for data, None if they aren't known"""
+        with self._lock:
+            found = self._cache.get(data)
+            if found is not None:
+                self._cache.move_to_end(data)
+            return found
+
+    def put(self, data, tags):
+        with self._lock:
+            self._cache[data] = frozenset(tags)
+            self._cache.move_to_end(data)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
+
+
+SUGGESTED = SuggestCache()
+
+
+def set_suggest_cache(size=SUGGEST_CACHE_SIZE):
+    """Keep suggestions for the last size urls and titles, 0 keeps none"""
+    global SUGGESTED
+    SUGGESTED = SuggestCache(int(size)) if int(size) > 0 else None
+    return SUGGESTED
+
+
+def _noun_extractor():
+    """The noun phrase extractor, loaded once per process on first use
+
+    Training it loads the tagger and corpora, which takes seconds, so it's
+    kept around rather than redone for every TextBlob.
+
+    """
+    global NOUNS
+    if NOUNS is None:
+        with _LOAD_LOCK:
+            if NOUNS is None:
+                from textblob.en.np_extractors import FastNPExtractor
+                extractor = FastNPExtractor()
+                extractor.train()
+                NOUNS = extractor
+    return NOUNS
+
+
+def _term_extractor():
+    """The term extractor, its tagger is only loaded once per process"""
+    global TERMS
+    if TERMS is None:
+        with _LOAD_LOCK:
+            if TERMS is None:
+                TERMS = extract.TermExtractor()
+    return TERMS
+
+
+def warm_up():
+    """Load the language models now instead of on the first request"""
+    _noun_extractor()
+    _term_extractor()
+
+
+def _clean(data):
+    """The words to find nouns in for a url or title
+
+    A url only has its path looked at, the host says nothing about the page.
 
-    # Check if title is url. If title is not a string, url, and title will be
-    # the same so no need to consider tags from url.
+    """
+    parsed = urlparse(data)
     if parsed.hostname:
-        tag_set.update(_generate_nouns_from_url(parsed.path))
-    else:
-        # If the title is not a url extract nouns from title and the url.
-        tag_set.update(_generate_nouns_from_url(data))
+        data = parsed.path
+    return " ".join(re.findall(r"[\w]+", data.replace('_', ' ')))
+
+
+def _noun_phrases(extractor, tagged):
+    """The noun phrases in a tagged sentence, as FastNPExtractor finds them"""
+    from textblob.en.np_extractors import _normalize_tags
+    tags = _normalize_tags(tagged)
+    merge = True
+    while merge:
+        merge = False
+        for idx in range(len(tags) - 1):
+            first, second = tags[idx], tags[idx + 1]
+            pos = extractor.CFG.get((first[1], second[1]))
+            if pos:
+                merge = True
+                tags[idx:idx + 2] = [(first[0] + ' ' + second[0], pos)]
+                break
+    return [phrase for phrase, pos in tags if pos in ('NNP', 'NNI')]
+
+
+def _suggest(items):
+    """Work out the tags for each of items, skipping the cache
+
+    The words of every item go through the extractor's tagger together.
+    They're tagged as separate sentences, run together the phrases would
+    run from one item into the next.
+
+    """
+    extractor = _noun_extractor()
+    sentences = [extractor._tokenize_sentence(_clean(data))
+                 for data in items]
+    found = []
+    for tagged in extractor.tagger.tag_sents(sentences):
+        nouns = set()
+        for phrase in _noun_phrases(extractor, tagged):
+            phrase = phrase.strip().lower()
+            if len(phrase) > 1:
+                # If the phrase has spaces split it to match our tag system.
+                nouns.update(phrase.split())
+        found.append(nouns)
+    return found
+
+
+def suggest_tags(data):
+    """Suggest tags based on the content string `data`
+
+    Suggestions for recent urls and titles come from the SuggestCache. The
+    set returned is always a new one the caller is free to change.
+
+    """
+    return suggest_tags_batch([data])[0]
+
+
+def suggest_tags_batch(items):
+    """Suggest tags for many urls or titles in one pass, say for an import
+
+    Returns a new set of tags for each item, in order. The items the
+    SuggestCache doesn't know are worked out together, each distinct one
+    once.
+
+    """
+    found = {}
+    for data in items:
+        if data and data not in found:
+            found[data] = SUGGESTED.get(data) if SUGGESTED is not None \
+                else None
+
+    todo = [data for data, tags in found.items() if tags is None]
+    if todo:
+        for data, tags in zip(todo, _suggest(todo)):
+            found[data] = tags
+            if SUGGESTED is not None:
+                SUGGESTED.put(data, tags)
+    return [set(found[data]) if data else set() for data in items]
+
+
+def content_tags(text, limit=MAX_CONTENT_TAGS):
+    """Suggest tags from the terms in a page's plain text
+
+    Returns up to limit (tag, score) pairs, best first, scored by how often
+    their term turns up.
+
+    """
+    if not text:
+        return []
 
-    return tag_set
+    scores = {}
+    text = text.encode('ascii', 'ignore').decode('ascii')
+    for term, occurrences, strength in _term_extractor()(text):
+        # If it has a space in it, split it to match our tag system.
+        for tag in term.lower().split():
+            # Require at least 3 chars long and ignore pure numbers.
+            if 2 < len(tag) <= 255 and not tag.isdigit():
+                scores[tag] = max(scores.get(tag, 0), occurrences)
+    return sorted(scores.items(),
+                  key=lambda item: (-item[1], item[0]))[:limit]
 
 
 def url_fix(url, charset='UTF-8'):
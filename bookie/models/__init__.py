@@ -1,14 +1,20 @@
 """Sqlalchemy Models for objects stored with Bookie"""
 import logging
 
-from topia.termextract import extract
 from bs4 import BeautifulSoup
+from bookie.lib.blobstore import get_store
+from bookie.lib.blobstore import set_store
+from bookie.lib.httpcache import set_cache
 from bookie.lib.urlhash import generate_hash
+from bookie.lib.utils import set_suggest_cache
+from bookie.lib.utils import warm_up
 
 from datetime import datetime
+from datetime import timedelta
 
 from sqlalchemy import engine_from_config
 from sqlalchemy import event
+from sqlalchemy import inspect
 from sqlalchemy import Boolean
 from sqlalchemy import Column
 from sqlalchemy import DateTime
@@ -18,6 +24,7 @@ from sqlalchemy import UnicodeText
 from sqlalchemy import ForeignKey
 from sqlalchemy import Table
 from sqlalchemy import select
+from os import path
 from unidecode import unidecode
 from urllib.parse import urlparse
 
@@ -33,6 +40,7 @@ from sqlalchemy.orm import Query
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.sql import func
 from sqlalchemy.sql import and_
+from sqlalchemy.sql import or_
 
 from zope.sqlalchemy import ZopeTransactionExtension
 
@@ -50,9 +58,36 @@ def initialize_sql(settings):
         DBSession.configure(bind=engine)
         Base.metadata.bind = engine
 
+    here = settings.get('app_root', path.dirname(path.dirname(
+        path.dirname(path.abspath(__file__)))))
+    store_path = settings.get('readable.store_path')
+    if store_path:
+        store_path = store_path.format(here=here)
+    set_store(store_path,
+              codec=settings.get('readable.store_codec', 'zlib'))
+
+    cache_path = settings.get('fetch.cache_path')
+    if cache_path:
+        cache_path = cache_path.format(here=here)
+    set_cache(cache_path,
+              ttl=int(float(settings.get('fetch.cache_hours', 6)) * 60 * 60),
+              redirect_ttl=int(float(
+                  settings.get('fetch.redirect_days', 30)) * 24 * 60 * 60))
+
     import bookie.models.fulltext as ft
     ft.set_index(settings.get('fulltext.engine'),
-                 settings.get('fulltext.index'))
+                 settings.get('fulltext.index'),
+                 cache_size=settings.get('fulltext.cache_size', 500),
+                 cache_path=settings.get('fulltext.cache_path'),
+                 suggest_cache_size=settings.get(
+                     'fulltext.suggest_cache_size', 1000))
+
+    set_suggest_cache(settings.get('suggest.cache_size', 4096))
+    if str(settings.get('suggest.preload', 'false')).lower() in (
+            'true', 'yes', 'on', '1'):
+        # Pay for loading the tagging models at startup, before a worker
+        # forks, rather than on someone's first bookmark.
+        warm_up()
 
     # setup the User relation, we've got import race conditions, ugh
     from bookie.models.auth import User
@@ -61,16 +96,16 @@ def initialize_sql(settings):
                               backref="bmark")
 
 
-def todict(self):
-    """Method to turn an SA instance into a dict so we can output to json"""
+def convert_datetime(value):
+    """We need to treat datetime's special to get them to json"""
+    if value:
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    else:
+        return ""
 
-    def convert_datetime(value):
-        """We need to treat datetime's special to get them to json"""
-        if value:
-            return value.strftime("%Y-%m-%d %H:%M:%S")
-        else:
-            return ""
 
+def todict(self):
+    """Method to turn an SA instance into a dict so we can output to json"""
     for col in self.__table__.columns:
         if isinstance(col.type, DateTime):
             value = convert_datetime(getattr(self, col.name))
@@ -247,44 +282,43 @@ class TagMgr(object):
             Suggest tags based on the readable content of the Bookmark
             that the user is editing. New Bookmarks won't end up here.
 
-        """
-        # tag_suggest = []
-        tag_list = []
+        The suggestions are worked out when the content is fetched, so this
+        only reads them back, best first, leaving out the tags the bookmark
+        already has.
 
+        """
         #  If url is None return empty tags
         if url is None:
-            return tag_list
-        else:
-            bmark = BmarkMgr.get_by_url(url)
-            # If bmark is not parsed return empty tag list
-            if bmark.readable is None:
-                return tag_list
-            # Some times parsing may fail and we cannot parse the webpage
-            # then satus_code will be set to 900
-            elif bmark.readable.status_code == '900':
-                return tag_list
-            else:
-                content = bmark.readable.content
-                # Remove unicode character while printing
-                clean_content = (
-                    "".join(
-                        BeautifulSoup(content, 'html.parser').findAll(
-                            text=True)).encode('ascii', 'ignore'))
-                # print(clean_content)
-                get_tags = extract.TermExtractor()
-                tag_suggest = get_tags(clean_content.decode('utf-8'))
-                tag_suggest = sorted(tag_suggest, key=lambda tag_suggest:
-                                     tag_suggest[1], reverse=True)
-                for result in tag_suggest:
-                    # If it has a space in it, split it.
-                    tags = result[0].split()
-                    for tag in tags:
-                        # Require at least 3 chars long and ignore pure
-                        # numbers.
-                        if tag not in tag_list and tag not in bmark.tags:
-                            if len(tag) > 2 and not tag.isdigit():
-                                tag_list.append(tag.lower())
-                return tag_list
+            return []
+
+        bmark = bmark or BmarkMgr.get_by_url(url)
+        if not bmark:
+            return []
+        qry = DBSession.query(TagSuggestion.tag).\
+            filter(TagSuggestion.hash_id == bmark.hash_id).\
+            order_by(TagSuggestion.score.desc(), TagSuggestion.tag)
+        return [tag for (tag,) in qry if tag not in bmark.tags]
+
+    @staticmethod
+    def set_suggestions(readable, tags, now=None):
+        """Replace the suggestions for the readable's url with tags
+
+        tags are (tag, score) pairs, None leaves them to be worked out later.
+
+        """
+        TagSuggestion.query.\
+            filter(TagSuggestion.hash_id == readable.hash_id).\
+            delete(synchronize_session=False)
+        if tags is None:
+            readable.suggested = None
+            return
+        if tags:
+            DBSession.execute(TagSuggestion.__table__.insert(), [{
+                'hash_id': readable.hash_id,
+                'tag': tag,
+                'score': score,
+            } for tag, score in tags])
+        readable.suggested = now or datetime.utcnow()
 
     @staticmethod
     def count():
@@ -292,6 +326,17 @@ class TagMgr(object):
         return Tag.query.count()
 
 
+class TagSuggestion(Base):
+    """Tags suggested by a url's readable content, with how strongly"""
+    __tablename__ = "tag_suggestions"
+
+    hash_id = Column(Unicode(22),
+                     ForeignKey('url_hash.hash_id'),
+                     primary_key=True)
+    tag = Column(Unicode(255), primary_key=True)
+    score = Column(Integer, nullable=False, default=0)
+
+
 class Tag(Base):
     """Bookmarks can have many many tags"""
     __tablename__ = "tags"
@@ -304,26 +349,213 @@ class Tag(Base):
 
 
 class ReadableMgr(object):
-    """Handle non-instance model issues for readable"""
-    pass
+    """Handle non-instance model issues for readable
+
+    The readable content belongs to the url, so every bookmark of a url
+    shares the one row and the page is only fetched once.
+
+    """
+
+    # How long to wait before checking a page for changes, in seconds. Pages
+    # that change get checked more often, ones that don't less.
+    REFRESH_MIN = 24 * 60 * 60
+    REFRESH_MAX = 30 * 24 * 60 * 60
+    REFRESH_START = 7 * 24 * 60 * 60
+
+    @staticmethod
+    def due(limit=500, now=None):
+        """The hash_ids of fetched urls due for a refresh, oldest first"""
+        now = now or datetime.utcnow()
+        qry = DBSession.query(Readable.hash_id).\
+            filter(Readable.imported.isnot(None)).\
+            filter(or_(Readable.next_fetch.is_(None),
+                       Readable.next_fetch <= now)).\
+            order_by(Readable.next_fetch).\
+            limit(limit)
+        return [hash_id for (hash_id,) in qry.all()]
+
+    @staticmethod
+    def fetched(hash_ids):
+        """Which of these urls already have their content"""
+        if not hash_ids:
+            return set()
+        qry = DBSession.query(Readable.hash_id).\
+            filter(Readable.hash_id.in_(hash_ids)).\
+            filter(Readable.imported.isnot(None))
+        return set(hash_id for (hash_id,) in qry)
+
+    @staticmethod
+    def unsuggested(limit=500):
+        """The hash_ids of urls with content but no tag suggestions yet"""
+        qry = DBSession.query(Readable.hash_id).\
+            filter(Readable.suggested.is_(None)).\
+            filter(or_(Readable._content.isnot(None),
+                       Readable.content_digest.isnot(None))).\
+            order_by(Readable.hash_id).\
+            limit(limit)
+        return [hash_id for (hash_id,) in qry.all()]
+
+    @staticmethod
+    def move_to_store(after=u'', chunk=500):
+        """Move a chunk of inline content into the blob store
+
+        The rows are updated in bulk so nothing is reindexed, the text is the
+        same. Returns the last hash_id moved, None once there's nothing left.
+
+        """
+        rows = DBSession.query(
+            Readable.hash_id, Readable._content, Readable._clean_content).\
+            filter(Readable.hash_id > after).\
+            filter(or_(Readable._content.isnot(None),
+                       Readable._clean_content.isnot(None))).\
+            order_by(Readable.hash_id).\
+            limit(chunk).all()
+
+        for hash_id, content, clean_content in rows:
+            content, content_digest, content_length = \
+                Readable._put_text(content)
+            clean_content, clean_digest, clean_length = \
+                Readable._put_text(clean_content)
+            DBSession.query(Readable).\
+                filter(Readable.hash_id == hash_id).\
+                update({
+                    Readable._content: content,
+                    Readable.content_digest: content_digest,
+                    Readable.content_length: content_length,
+                    Readable._clean_content: clean_content,
+                    Readable.clean_digest: clean_digest,
+                    Readable.clean_length: clean_length,
+                }, synchronize_session=False)
+        return rows[-1][0] if rows else None
+
+    @staticmethod
+    def schedule(readable, changed, now=None, low=None, high=None):
+        """Set when the readable is next due based on whether it changed
+
+        The interval halves when the page changed since the last fetch and
+        doubles when it didn't.
+
+        """
+        now = now or datetime.utcnow()
+        low = low or ReadableMgr.REFRESH_MIN
+        high = high or ReadableMgr.REFRESH_MAX
+        interval = readable.refresh_interval or ReadableMgr.REFRESH_START
+        if readable.fetched is not None:
+            interval = interval // 2 if changed else interval * 2
+        interval = max(low, min(high, interval))
+
+        readable.fetched = now
+        readable.refresh_interval = interval
+        readable.next_fetch = now + timedelta(seconds=interval)
+        return readable
+
+    @staticmethod
+    def put_off(readable, ttl, now=None):
+        """Leave a url that failed alone for ttl seconds
+
+        The refresh interval is kept for when it works again.
+
+        """
+        now = now or datetime.utcnow()
+        readable.fetched = now
+        readable.next_fetch = now + timedelta(seconds=ttl)
+        return readable
 
 
 class Readable(Base):
     """Handle the storing of the readable version of the page content"""
     __tablename__ = 'bmark_readable'
 
-    bid = Column(Integer,
-                 ForeignKey('bmarks.bid'),
-                 primary_key=True)
     hash_id = Column(Unicode(22),
-                     ForeignKey('bmarks.hash_id'),
-                     index=True)
-    content = Column(UnicodeText)
-    clean_content = Column(UnicodeText)
+                     ForeignKey('url_hash.hash_id'),
+                     primary_key=True)
+    # With a blob store set up the text lives there and the row only keeps
+    # its digest and length, see the content and clean_content properties.
+    _content = Column('content', UnicodeText)
+    _clean_content = Column('clean_content', UnicodeText)
+    content_digest = Column(Unicode(64))
+    content_length = Column(Integer)
+    clean_digest = Column(Unicode(64))
+    clean_length = Column(Integer)
     imported = Column(DateTime, default=datetime.utcnow)
     content_type = Column(Unicode(255))
     status_code = Column(Integer)
     status_message = Column(Unicode(255))
+    etag = Column(Unicode(255))
+    last_modified = Column(Unicode(64))
+    digest = Column(Unicode(64))
+    fetched = Column(DateTime)
+    next_fetch = Column(DateTime, index=True)
+    refresh_interval = Column(Integer)
+    # When the tag suggestions were last worked out from the content.
+    suggested = Column(DateTime)
+
+    # Where the text is in the blob store, nothing the api hands out.
+    BLOB_COLUMNS = ('content_digest', 'content_length', 'clean_digest',
+                    'clean_length')
+
+    def _get_text(self, inline, digest):
+        """The text from the row, or from the blob store decompressed once"""
+        if digest is None:
+            return inline
+        texts = self.__dict__.setdefault('_texts', {})
+        if digest not in texts:
+            texts[digest] = get_store().get(digest).decode('utf-8')
+        return texts[digest]
+
+    @staticmethod
+    def _put_text(value):
+        """Where to keep the text: an (inline, digest, length) for the row"""
+        store = get_store()
+        if value is None or store is None:
+            return value, None, None
+        digest, length = store.put(value.encode('utf-8'))
+        return None, digest, length
+
+    @property
+    def content(self):
+        return self._get_text(self._content, self.content_digest)
+
+    @content.setter
+    def content(self, value):
+        self._content, self.content_digest, self.content_length = \
+            self._put_text(value)
+
+    @property
+    def clean_content(self):
+        return self._get_text(self._clean_content, self.clean_digest)
+
+    @clean_content.setter
+    def clean_content(self, value):
+        self._clean_content, self.clean_digest, self.clean_length = \
+            self._put_text(value)
+
+    def __todict__(self):
+        """The columns for json, without the blob store's bookkeeping
+
+        The text is read out of the blob store, a blob gone missing from it
+        comes back as no content rather than failing the whole response.
+
+        """
+        for col in self.__table__.columns:
+            if col.name in self.BLOB_COLUMNS:
+                continue
+            try:
+                value = getattr(self, col.name)
+            except (KeyError, IOError):
+                LOG.error('Missing readable content for ' + self.hash_id)
+                value = None
+            if isinstance(col.type, DateTime):
+                value = convert_datetime(value)
+            yield(col.name, value)
+
+    def validators(self):
+        """What the last fetch saw, for a conditional request"""
+        return {
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'digest': self.digest,
+        }
 
 
 def sync_readable_content(mapper, connection, target):
@@ -334,13 +566,37 @@ def sync_readable_content(mapper, connection, target):
         else:
             return ""
 
-    target.clean_content = _clean_content(target.content)
-
-    # Background the process of fulltext indexing this bookmark's content.
-    from bookie.bcelery import tasks
-    tasks.fulltext_index_bookmark.delay(
-        target.bmark.bid,
-        target.clean_content)
+    # A fetch that failed without content, or a refresh that found the page
+    # unchanged, has nothing new to index.
+    state = inspect(target).attrs
+    history = [state._content.history, state.content_digest.history]
+    if not any(changes.has_changes() for changes in history) or (
+            target.content is None and
+            not any(changes.deleted for changes in history)):
+        return
+
+    # The content fetcher hands over the plain text it parsed along with the
+    # content, only work it out when it's missing.
+    if target.clean_content is None:
+        target.clean_content = _clean_content(target.content)
+
+    # New content without new tag suggestions leaves the old ones stale,
+    # drop them for suggest_content_tags to fill back in.
+    if not state.suggested.history.has_changes():
+        connection.execute(TagSuggestion.__table__.delete().where(
+            TagSuggestion.__table__.c.hash_id == target.hash_id))
+        connection.execute(Readable.__table__.update().where(
+            Readable.__table__.c.hash_id == target.hash_id).values(
+            suggested=None))
+
+    # Get the content into the fulltext index for every bookmark of the url.
+    from bookie.models.fulltext import get_fulltext_handler
+    handler = get_fulltext_handler(None)
+    bids = connection.execute(
+        select([Bmark.__table__.c.bid]).
+        where(Bmark.__table__.c.hash_id == target.hash_id))
+    for (bid,) in bids:
+        handler.index_content(connection, bid, target.clean_content)
 
 
 event.listen(Readable, 'after_insert', sync_readable_content)
@@ -615,11 +871,18 @@ class BmarkMgr(object):
             filter(Bmark.username == username).\
             all()
         if len(bids):
+            bids = [i[0] for i in bids]
             deltags = bmarks_tags.delete().where(
-                bmarks_tags.c.bmark_id.in_([i[0] for i in bids])
+                bmarks_tags.c.bmark_id.in_(bids)
             )
             DBSession.execute(deltags)
             Bmark.query.filter(Bmark.username == username).delete()
+
+            # A bulk delete skips the mapper events, so tell the fulltext
+            # index ourselves.
+            from bookie.models.fulltext import get_fulltext_handler
+            get_fulltext_handler(None).delete_bookmarks(
+                DBSession.connection(), bids)
             return len(bids)
         else:
             return None
@@ -678,10 +941,12 @@ class Bmark(Base):
                       uselist=False
                       )
 
+    # Shared by every bookmark of the url, so it outlives any one of them.
     readable = relation(Readable,
-                        backref="bmark",
-                        cascade="all, delete, delete-orphan",
-                        primaryjoin="Readable.bid == Bmark.bid",
+                        cascade="save-update, merge",
+                        primaryjoin="Readable.hash_id == Bmark.hash_id",
+                        foreign_keys="Readable.hash_id",
+                        passive_deletes='all',
                         uselist=False)
 
     def __init__(self, url, username, desc=None, ext=None, tags=None,
@@ -754,9 +1019,18 @@ def bmark_fulltext_insert_update(mapper, connection, target):
     if target.readable and target.readable.clean_content:
         content = target.readable.clean_content
 
-    # Background the process of fulltext indexing this bookmark's content.
-    from bookie.bcelery import tasks
-    tasks.fulltext_index_bookmark.delay(target.bid, content)
+    # Get the bookmark into the fulltext index. Depending on the engine it's
+    # either queued for the index writer or stored right here.
+    from bookie.models.fulltext import get_fulltext_handler
+    get_fulltext_handler(None).index_bookmark(connection, target, content)
 
 event.listen(Bmark, 'after_insert', bmark_fulltext_insert_update)
 event.listen(Bmark, 'after_update', bmark_fulltext_insert_update)
+
+
+def bmark_fulltext_delete(mapper, connection, target):
+    """Take the removed bookmark back out of the fulltext index"""
+    from bookie.models.fulltext import get_fulltext_handler
+    get_fulltext_handler(None).delete_bookmarks(connection, [target.bid])
+
+event.listen(Bmark, 'after_delete', bmark_fulltext_delete)
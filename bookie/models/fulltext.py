@@ -3,48 +3,206 @@
 This is going to be dependant on the db model found so we'll setup a factory
 and API as we did in the importer
 
+The fulltext.engine setting picks the implementation:
+
+- whoosh: a Whoosh index on disk written by the index writer process
+- sqlite: an FTS5 table in the sqlite database itself
+- pgsql: tsvector columns with GIN indexes in the postgresql database
+
 """
+import json
 import logging
+import multiprocessing
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import transaction
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from sqlalchemy import cast
+from sqlalchemy import func
+from sqlalchemy import Unicode
 from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import text
 
 from whoosh import qparser
 from whoosh.fields import (
     BOOLEAN,
     ID,
     KEYWORD,
+    NGRAMWORDS,
     SchemaClass,
+    STORED,
     TEXT,
 )
 from whoosh.analysis import StemmingAnalyzer
+from whoosh.collectors import TimeLimitCollector
 from whoosh.index import create_in
+from whoosh.index import exists_in
 from whoosh.index import open_dir
-from whoosh.writing import AsyncWriter
-from whoosh.query import (
-    And,
-    Or,
-    Term,
-)
+from whoosh.idsets import BitSet
+from whoosh import sorting
+from whoosh.query import And
+from whoosh.query import NullQuery
+from whoosh.query import Term
+from whoosh.searching import ResultsPage
+from whoosh.searching import TimeLimit
 
+from bookie.models import Base
 from bookie.models import Bmark
+from bookie.models import DBSession
+from bookie.models.queue import FT_INDEX
+from bookie.models.queue import FT_OPTIMIZE
+from bookie.models.queue import FulltextQueueMgr
 
 
 LOG = logging.getLogger(__name__)
 INDEX_NAME = None
+INDEX_PATH = None
 INDEX_TYPE = None
 WIX = None
+CIX = None
+SIX = None
+SEARCHERS = None
+CONTENT_SEARCHERS = None
+SUGGEST_SEARCHERS = None
+INDEXES = {}
+POOLS = {}
+CACHE = None
+SUGGEST_CACHE = None
+
+# The page content lives in its own index next to the bookmark metadata so
+# the usual metadata only search never touches the page text postings. The
+# search as you type suggestions get a small index of their own too.
+META_INDEX = 'MAIN'
+CONTENT_INDEX = 'content'
+SUGGEST_INDEX = 'suggest'
+
+
+# The engines that keep their index inside the database.
+SQL_ENGINES = ('sqlite', 'pgsql')
+
+# How many of the most common tags in the hits a search reports.
+TAG_FACETS = 20
+
+# The shortest and longest prefixes the suggest index knows.
+SUGGEST_MIN = 2
+SUGGEST_MAX = 20
+
+# The reconcile job checks bookmarks updated since its last run. The window
+# overlaps a bit so a change committed while it ran isn't missed.
+RECONCILE_MARK = 'reconcile'
+RECONCILE_OVERLAP = timedelta(minutes=5)
+RECONCILE_CHUNK = 1000
 
 
 def _reset_index():
     """Used by the test suite to reset the fulltext index."""
-    WIX = create_in(INDEX_NAME, BmarkSchema)  # noqa
+    if INDEX_TYPE in SQL_ENGINES:
+        get_fulltext_handler(None).clear()
+        transaction.commit()
+        return
+
+    _open_index(os.path.realpath(INDEX_NAME), create=True)
+    CACHE.clear()
+    SUGGEST_CACHE.clear()
+
+
+def _open_index(path, create=False):
+    """Open each of the whoosh indexes in path and their searchers
+
+    :param create: start all the indexes out empty
+
+    """
+    global INDEX_PATH
+    global INDEXES
+    global POOLS
+    global WIX
+    global CIX
+    global SIX
+    global SEARCHERS
+    global CONTENT_SEARCHERS
+    global SUGGEST_SEARCHERS
+
+    indexes = {}
+    pools = {}
+    for indexname, schema in SCHEMAS.items():
+        if create or not exists_in(path, indexname=indexname):
+            # An index added since the directory was built starts out empty
+            # until it's rebuilt.
+            indexes[indexname] = create_in(path, schema, indexname=indexname)
+        else:
+            indexes[indexname] = open_dir(path, indexname=indexname)
+        # Any old pools close their searchers once they're garbage.
+        pools[indexname] = SearcherPool(indexes[indexname])
+
+    if not create:
+        reasons = rebuild_reasons(indexes)
+        if reasons:
+            LOG.warning(
+                'The fulltext index in {0} needs a rebuild: {1}. Until then '
+                'searches come back incomplete, run '
+                'scripts/admin/fulltext_backfill.py --rebuild'.format(
+                    path, '; '.join(reasons)))
+
+    INDEX_PATH = path
+    INDEXES = indexes
+    POOLS = pools
+    WIX = indexes[META_INDEX]
+    CIX = indexes[CONTENT_INDEX]
+    SIX = indexes[SUGGEST_INDEX]
+    SEARCHERS = pools[META_INDEX]
+    CONTENT_SEARCHERS = pools[CONTENT_INDEX]
+    SUGGEST_SEARCHERS = pools[SUGGEST_INDEX]
+
+
+def rebuild_reasons(indexes=None):
+    """Why the whoosh indexes need a rebuild, empty when they don't
+
+    An index keeps the schema it was built with, so an upgrade leaves the
+    metadata index without the newer fields and starts the content and
+    suggest indexes out empty next to it.
+
+    """
+    indexes = indexes or INDEXES
+    main = indexes[META_INDEX]
+    reasons = []
+    missing = [name for name in SCHEMAS[META_INDEX]().names()
+               if name not in main.schema]
+    if missing:
+        reasons.append('the {0} index has no {1} field'.format(
+            META_INDEX, ', '.join(missing)))
+    elif not main.schema['tags'].vector:
+        reasons.append('the tags have no term vectors')
+    if main.doc_count():
+        empty = [indexname for indexname in (CONTENT_INDEX, SUGGEST_INDEX)
+                 if not indexes[indexname].doc_count()]
+        if empty:
+            reasons.append('the {0} index is empty'.format(
+                ' and '.join(empty)))
+    return reasons
+
+
+def set_index(index_type, index_path, cache_size=500, cache_path=None,
+              suggest_cache_size=1000):
+    """Open up the fulltext index and the search cache for this process
 
+    :param cache_size: how many searches to keep in the result cache
+    :param cache_path: an optional sqlite file used to share cached results
+        with the other processes on this host
+    :param suggest_cache_size: how many prefixes to keep suggestions for
 
-def set_index(index_type, index_path):
+    """
     global INDEX_NAME
     global INDEX_TYPE
-    global WIX
+    global CACHE
+    global SUGGEST_CACHE
 
     INDEX_TYPE = index_type
     INDEX_NAME = index_path
@@ -52,49 +210,1039 @@ def set_index(index_type, index_path):
     cur_path = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
     INDEX_NAME = os.path.join(cur_path, INDEX_NAME)
 
+    if INDEX_TYPE in SQL_ENGINES:
+        # There's nothing to open, the index lives in the database.
+        return
+
+    # After a rebuild INDEX_NAME is a symlink to the live index directory.
+    # We open the directory it points at so a swap never changes the files
+    # under an open index, see _follow_swap.
     if not os.path.exists(INDEX_NAME):
         os.mkdir(INDEX_NAME)
-        WIX = create_in(INDEX_NAME, BmarkSchema)
+        _open_index(os.path.realpath(INDEX_NAME), create=True)
     else:
-        WIX = open_dir(INDEX_NAME)
+        _open_index(os.path.realpath(INDEX_NAME))
+
+    CACHE = SearchCache(int(cache_size), path=cache_path)
+    SUGGEST_CACHE = SearchCache(int(suggest_cache_size))
+
+
+def _follow_swap():
+    """Move over to the new index if a rebuild swapped one in"""
+    current = os.path.realpath(INDEX_NAME)
+    if current != INDEX_PATH:
+        LOG.info('fulltext index swapped to ' + current)
+        _open_index(current)
+        CACHE.clear()
+        SUGGEST_CACHE.clear()
 
 
 class BmarkSchema(SchemaClass):
-    bid = ID(unique=True, stored=True)
-    description = TEXT
-    extended = TEXT
-    tags = KEYWORD
+    bid = ID(unique=True, stored=True, sortable=True)
+    hash_id = ID(stored=True)
+    url = STORED
+    description = TEXT(stored=True)
+    extended = TEXT(stored=True)
+    # The term vectors let the tag facets read each hit's tags straight
+    # off, without them whoosh rebuilds every document's tags from the
+    # postings on each search.
+    tags = KEYWORD(stored=True, vector=True)
+    username = ID(stored=True)
+    is_private = BOOLEAN
+    updated = STORED
+
+
+class ContentSchema(SchemaClass):
+    bid = ID(unique=True, stored=True, sortable=True)
     readable = TEXT(analyzer=StemmingAnalyzer())
     username = ID
     is_private = BOOLEAN
 
 
+class SuggestSchema(SchemaClass):
+    bid = ID(unique=True, stored=True)
+    url = STORED
+    description = STORED
+    # Edge n-grams of each word in the description and tags, so a prefix is
+    # a plain term lookup.
+    suggest = NGRAMWORDS(minsize=SUGGEST_MIN, maxsize=SUGGEST_MAX, at='start')
+    username = ID
+    is_private = BOOLEAN
+
+
+# Every whoosh index in the index directory. The metadata index comes first,
+# its write lock is the one a rebuild holds during the swap.
+SCHEMAS = OrderedDict([
+    (META_INDEX, BmarkSchema),
+    (CONTENT_INDEX, ContentSchema),
+    (SUGGEST_INDEX, SuggestSchema),
+])
+
+
 def get_fulltext_handler(engine):
     """Based on the engine, figure out the type of fulltext interface"""
     global INDEX_TYPE
-    if INDEX_TYPE == 'whoosh':
+    if INDEX_TYPE == 'sqlite':
+        return SqliteFulltext()
+    elif INDEX_TYPE == 'pgsql':
+        return PgsqlFulltext()
+    else:
         return WhooshFulltext()
 
 
-def get_writer():
-    global WIX
-    writer = AsyncWriter(WIX)
-    return writer
+def _bmark_document(bmark, content=None):
+    """Build the fields we store in the index for a bookmark"""
+    if content:
+        found_content = content
+    elif bmark.readable:
+        found_content = bmark.readable.clean_content
+    else:
+        found_content = ""
+
+    return {
+        'bid': str(bmark.bid),
+        'hash_id': bmark.hash_id,
+        'url': bmark.hashed.url if bmark.hashed else "",
+        'description': bmark.description if bmark.description else "",
+        'extended': bmark.extended if bmark.extended else "",
+        'tags': bmark.tag_str if bmark.tag_str else "",
+        'readable': found_content if found_content else "",
+        'username': bmark.username,
+        'is_private': bmark.is_private,
+        'updated': _stamp(bmark.updated),
+        'suggest': '{0} {1}'.format(bmark.description or '',
+                                    bmark.tag_str or ''),
+    }
+
+
+def _stamp(updated):
+    """The bookmark's updated time the way the index stores it"""
+    return updated.isoformat() if updated else None
+
+
+def _diff_sorted(left, right):
+    """Walk two sorted streams side by side
+
+    Yields (value, in_left, in_right) for every value found in either one.
+
+    """
+    left = iter(left)
+    right = iter(right)
+    lval = next(left, None)
+    rval = next(right, None)
+    while lval is not None or rval is not None:
+        if rval is None or (lval is not None and lval < rval):
+            yield lval, True, False
+            lval = next(left, None)
+        elif lval is None or rval < lval:
+            yield rval, False, True
+            rval = next(right, None)
+        else:
+            yield lval, True, True
+            lval = next(left, None)
+            rval = next(right, None)
+
+
+def _indexed_bids(reader):
+    """Stream the bids in the index in sorted order
+
+    The terms of deleted documents hang around until their segment is
+    merged, so skip any term that no longer matches a document.
+
+    """
+    deletions = reader.has_deletions()
+    for bid in reader.field_terms('bid'):
+        if not deletions or reader.postings('bid', bid).is_active():
+            yield bid
+
+
+def _write_document(writers, doc, update=False):
+    """Split the bookmark's document between the whoosh indexes
+
+    Each index only gets the fields in its schema. That also covers an
+    index built with an older schema, which can't take the newer fields
+    until it's rebuilt.
+
+    """
+    for writer in writers:
+        fields = dict((k, v) for k, v in doc.items() if k in writer.schema)
+        if update:
+            writer.update_document(**fields)
+        else:
+            writer.add_document(**fields)
+
+
+def _cancel(*writers):
+    """Throw away whatever the writers that are still open have done"""
+    for writer in writers:
+        if writer is not None and not writer.is_closed:
+            writer.cancel()
+
+
+class IndexWriter(object):
+    """The single process that owns the writer on the fulltext index
+
+    Web and celery workers never open a writer. They add records to the
+    fulltext_queue table, usually in the same transaction as the bookmark
+    change, and this process drains that queue in batches. With only one
+    writer there is no fight over the whoosh write lock.
+
+    """
+
+    def __init__(self, batch_size=500, poll_interval=1.0):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+
+    def process(self):
+        """Index the next batch of queued bookmarks
+
+        Returns the number of queue records that were handled.
+
+        """
+        trans = transaction.begin()
+        queued = FulltextQueueMgr.get_ready(limit=self.batch_size)
+        if not queued:
+            trans.abort()
+            return 0
+
+        # Let a running rebuild know what it has to catch up on. This has to
+        # happen before we check for a swap, see rebuild_index.
+        _journal_rebuild(
+            item.bid for item in queued if item.action != FT_OPTIMIZE)
+        _follow_swap()
+
+        # A bookmark might be queued several times in a batch, we only need
+        # to write it once and the newest request wins.
+        pending = OrderedDict()
+        optimize = set()
+        for item in queued:
+            if item.action == FT_OPTIMIZE:
+                # The content says which index, empty means all of them.
+                optimize.update(
+                    [item.content] if item.content else SCHEMAS.keys())
+            else:
+                pending[item.bid] = item
+
+        to_index = [bid for bid, item in pending.items()
+                    if item.action == FT_INDEX]
+        bmarks = []
+        if to_index:
+            bmarks = Bmark.query.filter(Bmark.bid.in_(to_index)).\
+                options(joinedload('hashed'), joinedload('readable')).\
+                all()
+
+        # Bookmarks that were removed before we got to them come out of the
+        # index along with the ones queued for delete.
+        found = set(bmark.bid for bmark in bmarks)
+        to_delete = [bid for bid in pending if bid not in found]
+
+        writers = []
+        try:
+            for indexname in SCHEMAS:
+                writers.append(INDEXES[indexname].writer())
+            for bid in to_delete:
+                for writer in writers:
+                    writer.delete_by_term('bid', str(bid))
+            for bmark in bmarks:
+                doc = _bmark_document(bmark, pending[bmark.bid].content)
+                _write_document(writers, doc, update=True)
+            for writer in writers:
+                writer.commit()
+        except Exception:
+            _cancel(*writers)
+            trans.abort()
+            raise
+
+        # Merge down to one segment and purge the deleted documents, each
+        # index is only optimized when it needs it.
+        for indexname in optimize:
+            INDEXES[indexname].optimize()
+
+        FulltextQueueMgr.remove([item.id for item in queued])
+        trans.commit()
+
+        LOG.debug('indexed {0} and removed {1} bookmarks from {2} '
+                  'queued'.format(len(bmarks), len(to_delete), len(queued)))
+        return len(queued)
+
+    def drain(self):
+        """Process the queue until it is empty"""
+        total = 0
+        processed = self.process()
+        while processed:
+            total += processed
+            processed = self.process()
+        return total
+
+    def run(self):
+        """Run the writer loop forever, polling the queue for new work"""
+        LOG.info('fulltext index writer started on ' + str(INDEX_NAME))
+        while True:
+            try:
+                processed = self.process()
+            except Exception as exc:
+                LOG.error('fulltext index writer failed: ' + str(exc))
+                processed = 0
+
+            if processed < self.batch_size:
+                time.sleep(self.poll_interval)
+
+
+def _rebuild_journal():
+    """The file that exists while a rebuild is running"""
+    return INDEX_NAME + '.rebuilding'
+
+
+def _journal_rebuild(bids):
+    """Note the bookmarks the writer is about to index during a rebuild
+
+    The rebuilt index is read from the database as of when the rebuild
+    started, so anything written after that gets queued again once the new
+    index is swapped in.
+
+    """
+    try:
+        fd = os.open(_rebuild_journal(), os.O_WRONLY | os.O_APPEND)
+    except OSError:
+        # No rebuild going on.
+        return
+
+    with os.fdopen(fd, 'a') as journal:
+        journal.write(''.join('{0}\n'.format(bid) for bid in bids))
+
+
+def _rebuild_part(job):
+    """Index one range of bookmarks into its own index directory
+
+    Runs in a rebuild worker process. Each range is loaded, written and let
+    go before the next one so memory stays flat however many bookmarks there
+    are.
+
+    """
+    path, start, end = job
+    os.mkdir(path)
+    writers = [create_in(path, schema, indexname=indexname).writer()
+               for indexname, schema in SCHEMAS.items()]
+    count = 0
+    try:
+        bmarks = Bmark.query.\
+            filter(Bmark.bid >= start).\
+            filter(Bmark.bid < end).\
+            options(joinedload('hashed'), joinedload('readable')).\
+            all()
+        for bmark in bmarks:
+            _write_document(writers, _bmark_document(bmark))
+            count += 1
+        for writer in writers:
+            writer.commit(merge=False)
+    except Exception:
+        _cancel(*writers)
+        raise
+    finally:
+        DBSession.remove()
+    return path, count
+
+
+def rebuild_index(processes=None, chunk=1000):
+    """Build a brand new whoosh index and swap it in for the live one
+
+    The bookmarks are split up into ranges of ids and a pool of processes
+    indexes each range into its own part index. The parts are merged once
+    into a fresh directory which then replaces the live index by swapping
+    the INDEX_NAME symlink. The index writer keeps running the whole time,
+    anything it indexes during the rebuild is queued again afterwards.
+
+    Returns the number of bookmarks in the new index.
+
+    :param processes: how many worker processes, defaults to the core count
+    :param chunk: how many bookmark ids each worker takes at a time
+
+    """
+    stamp = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    build_path = '{0}-{1}'.format(INDEX_NAME, stamp)
+    parts_path = build_path + '.parts'
+    journal = _rebuild_journal()
+
+    # Start the journal before we read anything so the writer notes every
+    # change the rebuild might miss.
+    open(journal, 'w').close()
+
+    start, end = DBSession.query(func.min(Bmark.bid),
+                                 func.max(Bmark.bid)).one()
+    # Don't let the workers inherit our database connections.
+    DBSession.remove()
+    Base.metadata.bind.dispose()
+
+    os.mkdir(parts_path)
+    jobs = []
+    if start is not None:
+        for lower in range(start, end + 1, chunk):
+            jobs.append((os.path.join(parts_path, str(lower)),
+                         lower, lower + chunk))
+
+    try:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(_rebuild_part, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        os.mkdir(build_path)
+        for indexname, schema in SCHEMAS.items():
+            writer = create_in(build_path, schema, indexname=indexname).\
+                writer()
+            readers = []
+            for path, count in parts:
+                if count:
+                    readers.append(
+                        open_dir(path, indexname=indexname).reader())
+                    writer.add_reader(readers[-1])
+            writer.commit()
+            for reader in readers:
+                reader.close()
+
+        total = sum(count for path, count in parts)
+    except Exception:
+        os.remove(journal)
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise
+    finally:
+        shutil.rmtree(parts_path, ignore_errors=True)
+
+    _follow_swap()
+    old_path = INDEX_PATH
+
+    # Holding the write lock on the live index means the writer isn't part
+    # way through a batch while we swap. Any batch it picked up before the
+    # journal is gone is in the journal, any after will see the new index.
+    lock = WIX.lock('WRITELOCK')
+    lock.acquire(blocking=True)
+    try:
+        if not os.path.islink(INDEX_NAME):
+            # The first rebuild moves the original directory out of the way
+            # so INDEX_NAME can become a symlink.
+            os.rename(INDEX_NAME, old_path + '-original')
+            old_path = old_path + '-original'
+        link = INDEX_NAME + '.swap'
+        os.symlink(os.path.basename(build_path), link)
+        os.replace(link, INDEX_NAME)
+
+        with open(journal) as handle:
+            changed = set(int(bid) for bid in handle.read().split())
+        os.remove(journal)
+    finally:
+        lock.release()
+
+    _follow_swap()
+    # Processes still searching the old index keep their open files.
+    shutil.rmtree(old_path, ignore_errors=True)
+
+    if changed:
+        trans = transaction.begin()
+        for bid in changed:
+            FulltextQueueMgr.enqueue(bid)
+        trans.commit()
+
+    LOG.info('rebuilt the fulltext index with {0} bookmarks, {1} queued '
+             'again'.format(total, len(changed)))
+    return total
+
+
+def _enqueue_delta(bids, delete=False):
+    """Queue the bookmarks that aren't waiting in the queue already
+
+    A bookmark that's queued for anything is left be, the writer takes out
+    a bookmark that's gone whatever it was queued for.
+
+    :param delete: queue them to come out of the index
+
+    """
+    bids = sorted(bids)
+    queued = 0
+    for idx in range(0, len(bids), RECONCILE_CHUNK):
+        chunk = bids[idx:idx + RECONCILE_CHUNK]
+        waiting = FulltextQueueMgr.queued(chunk)
+        missing = [bid for bid in chunk if bid not in waiting]
+        if delete:
+            FulltextQueueMgr.enqueue_delete(missing)
+        else:
+            for bid in missing:
+                FulltextQueueMgr.enqueue(bid)
+        queued += len(missing)
+    return queued
+
+
+class SearchResults(list):
+    """A page of search results in relevance order
+
+    total is the number of hits for the search over all pages. If the search
+    ran out of time truncated is set and the hits are the best found before
+    the deadline. elapsed is how long the search took in seconds. facets
+    are the most common tags over all the hits with their counts.
+
+    """
+
+    def __init__(self, hits, total, truncated=False, elapsed=None,
+                 facets=None):
+        super(SearchResults, self).__init__(hits)
+        self.total = total
+        self.truncated = truncated
+        self.elapsed = elapsed
+        self.facets = facets if facets is not None else []
+
+
+def _suggest_words(prefix):
+    """The words of a partly typed search the suggest index can look up"""
+    return [word[:SUGGEST_MAX]
+            for word in re.findall(r'\w+', prefix.lower())
+            if len(word) >= SUGGEST_MIN]
+
+
+def search_timeout(settings, route_name):
+    """How many seconds a search from the route may run, None for no limit
+
+    fulltext.search_timeout.<route_name> wins over fulltext.search_timeout.
+
+    """
+    timeout = settings.get('fulltext.search_timeout.' + route_name,
+                           settings.get('fulltext.search_timeout'))
+    if timeout and float(timeout) > 0:
+        return float(timeout)
+    return None
+
+
+def _collect(searcher, qry, limit, allowed, deadline, facets=False):
+    """Run the search, stopping at the deadline with whatever's been found
+
+    Returns the whoosh results and if they were cut short.
+
+    :param facets: count the tags of every hit in the same pass
+
+    """
+    if allowed is not None and not len(allowed):
+        # Whoosh takes an empty filter for no filter at all, when nothing
+        # is allowed nothing may match.
+        qry = NullQuery
+    if facets:
+        collector = searcher.collector(
+            limit=limit,
+            filter=allowed,
+            groupedby={'tags': sorting.FieldFacet('tags',
+                                                  allow_overlap=True)},
+            maptype=sorting.Count)
+    else:
+        collector = searcher.collector(limit=limit, filter=allowed)
+    if deadline is None:
+        searcher.search_with_collector(qry, collector)
+        return collector.results(), False
+
+    # The alarm signal only works in the main thread and the web app runs
+    # searches in its worker threads.
+    collector = TimeLimitCollector(collector,
+                                   max(deadline - time.time(), 0.001),
+                                   use_alarm=False)
+    try:
+        searcher.search_with_collector(qry, collector)
+    except TimeLimit:
+        return collector.results(), True
+    return collector.results(), False
+
+
+def _tag_facets(counts):
+    """The most common tags from a tag to count dict, most common first"""
+    ranked = sorted(counts.items(), key=lambda tag: (-tag[1], tag[0]))
+    return [{'name': name, 'count': count}
+            for name, count in ranked[:TAG_FACETS]]
+
+
+def _hydrate(hits, with_readable=False):
+    """Load the bookmarks for a page of hits in a single query
+
+    :param hits: a list of (bid, score) in the order whoosh ranked them
+
+    Each bookmark gets a score attribute and the list keeps the ranking. Any
+    bid that has been removed since it was indexed is dropped.
+
+    """
+    if not hits:
+        return []
+
+    qry = Bmark.query.filter(Bmark.bid.in_([bid for bid, score in hits]))
+    qry = qry.options(joinedload('hashed'), joinedload('tags'))
+
+    if with_readable:
+        qry = qry.options(joinedload('readable'))
+
+    found = dict((bmark.bid, bmark) for bmark in qry.all())
+
+    results = []
+    for bid, score in hits:
+        bmark = found.get(bid)
+        if bmark is not None:
+            bmark.score = score
+            results.append(bmark)
+    return results
+
+
+def _stored_hit(fields, score):
+    """Build a result from the fields stored in the index for a hit"""
+    return {
+        'bid': int(fields['bid']),
+        'hash_id': fields.get('hash_id'),
+        'url': fields.get('url'),
+        'description': fields.get('description', ''),
+        'extended': fields.get('extended', ''),
+        'tags': fields.get('tags', '').split(),
+        'username': fields.get('username'),
+        'score': score,
+    }
+
+
+def _bmark_hit(bmark):
+    """Build the same result as _stored_hit from a loaded bookmark"""
+    return {
+        'bid': bmark.bid,
+        'hash_id': bmark.hash_id,
+        'url': bmark.hashed.url,
+        'description': bmark.description or '',
+        'extended': bmark.extended or '',
+        'tags': [tag for tag in bmark.tags],
+        'username': bmark.username,
+        'score': bmark.score,
+    }
+
+
+def _searcher_version(searcher):
+    """A token that changes any time the contents of the index change
+
+    The generation alone isn't enough since a fresh index starts counting
+    from zero again, so we add in the ids of the segments it is made of.
+
+    """
+    reader = searcher.reader()
+    segments = [leaf.segment().segment_id()
+                for leaf, offset in reader.leaf_readers()
+                if hasattr(leaf, 'segment')]
+    return '{0}:{1}'.format(reader.generation(), ','.join(segments))
+
+
+class SearchCache(object):
+    """Bounded LRU of search results tied to a version of the index
+
+    Entries are only good for the index version they were computed against.
+    As soon as the index writer commits, the version changes and everything
+    this process cached before it is thrown away.
+
+    If given a path, results are also kept in a sqlite file there so the
+    other web and celery processes on this host can share them. Those are
+    kept by version as well, processes that haven't caught up with the
+    latest generation yet still find theirs, and old versions age out of
+    the LRU.
+
+    """
+
+    def __init__(self, size=500, path=None):
+        self.size = size
+        self.path = path
+        self._lock = threading.Lock()
+        self._version = None
+        self._cache = OrderedDict()
+        self._stats = {
+            'hits': 0,
+            'shared_hits': 0,
+            'misses': 0,
+        }
+        self._shared = None
+        self._pid = None
+
+    def _reset(self):
+        """Connections don't survive a fork, open our own
+
+        Must be called while holding the lock.
+
+        """
+        if self.path and self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._shared = sqlite3.connect(self.path, timeout=30,
+                                           check_same_thread=False)
+            self._shared.execute(
+                'CREATE TABLE IF NOT EXISTS search_results ('
+                'version TEXT, key TEXT, value TEXT, used REAL, '
+                'PRIMARY KEY (version, key))')
+            self._shared.execute(
+                'CREATE INDEX IF NOT EXISTS search_results_used '
+                'ON search_results (used)')
+            self._shared.commit()
+
+    @staticmethod
+    def key(phrase, **kwargs):
+        """Normalize the search request into a cache key"""
+        kwargs['phrase'] = " ".join(phrase.split())
+        return json.dumps(kwargs, sort_keys=True)
+
+    def _check_version(self, version):
+        """Drop what this process computed against an older index
+
+        Must be called while holding the lock.
+
+        """
+        self._reset()
+        if version == self._version:
+            return
+
+        self._version = version
+        self._cache.clear()
+
+    def get(self, key, version):
+        """Find a cached result for the key or None"""
+        if not self.size:
+            return None
+
+        with self._lock:
+            self._check_version(version)
+
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._stats['hits'] += 1
+                return self._cache[key]
+
+            if self._shared:
+                row = self._shared.execute(
+                    'SELECT value FROM search_results WHERE version = ? '
+                    'AND key = ?', (version, key)).fetchone()
+                if row:
+                    value = json.loads(row[0])
+                    self._remember(key, value)
+                    self._stats['shared_hits'] += 1
+                    return value
+
+            self._stats['misses'] += 1
+            return None
+
+    def _remember(self, key, value):
+        """Store in the local LRU, must be called while holding the lock"""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def set(self, key, version, value):
+        """Cache the value for this key against the index version"""
+        if not self.size:
+            return
+
+        with self._lock:
+            self._check_version(version)
+            self._remember(key, value)
+
+            if self._shared:
+                self._shared.execute(
+                    'INSERT OR REPLACE INTO search_results '
+                    'VALUES (?, ?, ?, ?)',
+                    (version, key, json.dumps(value), time.time()))
+                self._shared.execute(
+                    'DELETE FROM search_results WHERE used < ('
+                    'SELECT used FROM search_results ORDER BY used DESC '
+                    'LIMIT 1 OFFSET ?)', (self.size - 1,))
+                self._shared.commit()
+
+    def clear(self):
+        """Empty out the cache"""
+        with self._lock:
+            self._reset()
+            self._version = None
+            self._cache.clear()
+            if self._shared:
+                self._shared.execute('DELETE FROM search_results')
+                self._shared.commit()
+
+    def stats(self):
+        """Report on how well the cache is working"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._cache)
+        return stats
+
+
+class VisibilityFilters(object):
+    """Doc id bitsets of the documents each user is allowed to see
+
+    Building the privacy clauses into every query means whoosh walks the
+    username and is_private postings on every search. Instead we keep the
+    set of public documents and each user's documents as bitsets and hand
+    the combination to the search as a filter.
+
+    Doc ids are only good for one version of the index, so the sets are
+    thrown out whenever the searcher version changes.
+
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self._lock = threading.Lock()
+        self._version = None
+        self._sets = OrderedDict()
+
+    def _docs(self, searcher, version, name, qry):
+        """The cached bitset of the documents matching qry"""
+        with self._lock:
+            if version != self._version:
+                self._version = version
+                self._sets.clear()
+
+            found = self._sets.get(name)
+            if found is not None:
+                self._sets.move_to_end(name)
+                return found
+
+        found = BitSet(searcher.docs_for_query(qry),
+                       size=searcher.doc_count_all())
+
+        with self._lock:
+            if version == self._version:
+                self._sets[name] = found
+                while len(self._sets) > self.size:
+                    self._sets.popitem(last=False)
+        return found
+
+    def allowed(self, searcher, version, username=None, requested_by=None):
+        """The documents a search for username by requested_by may return
+
+        Everyone sees public bookmarks. Searching your own bookmarks adds
+        your private ones, searching someone else's is limited to their
+        public ones.
+
+        """
+        public = self._docs(searcher, version, 'public',
+                            Term('is_private', 'f'))
+        if not username:
+            return public
+
+        owned = self._docs(searcher, version, 'user:' + username,
+                           Term('username', username))
+        if requested_by and username == requested_by:
+            return public.union(owned)
+        else:
+            return public.intersection(owned)
+
+
+class SearcherPool(object):
+    """Share one long lived searcher on the index across the process
+
+    Opening a searcher opens every segment reader and throws away their
+    caches, so we hang onto one and only refresh it when the index generation
+    moves on. Refreshing re-uses the readers of segments that didn't change.
+
+    Whoosh closes the segment readers it can't re-use during a refresh, so we
+    only refresh in place when nobody is using the current searcher. If it's
+    busy we open a new one and retire the old one once its last user is done
+    with it.
+
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.filters = VisibilityFilters()
+        self._lock = threading.Lock()
+        self._current = None
+        self._generation = None
+        self._users = {}
+        self._stats = {
+            'acquired': 0,
+            'opened': 0,
+            'refreshed': 0,
+            'last_refresh': None,
+        }
+
+    def _update(self):
+        """Make sure the current searcher is on the latest generation
+
+        Must be called while holding the lock.
+
+        """
+        # The reader of an empty index has no generation, so we keep the one
+        # the searcher was opened at rather than ask it with up_to_date.
+        generation = self.index.latest_generation()
+        current = self._current
+        if current is None:
+            self._current = self.index.searcher()
+            self._stats['opened'] += 1
+        elif generation != self._generation:
+            if self._users.get(current):
+                self._current = self.index.searcher()
+            else:
+                self._users.pop(current, None)
+                self._current = current.refresh()
+            self._stats['refreshed'] += 1
+            self._stats['last_refresh'] = datetime.utcnow()
+        self._generation = generation
+
+    @contextmanager
+    def searcher(self):
+        """Hand out the shared searcher for the length of the with block"""
+        with self._lock:
+            self._update()
+            searcher = self._current
+            self._users[searcher] = self._users.get(searcher, 0) + 1
+            self._stats['acquired'] += 1
+
+        try:
+            yield searcher
+        finally:
+            with self._lock:
+                self._users[searcher] -= 1
+                if not self._users[searcher] and searcher is not self._current:
+                    # A retired searcher nobody is using any more.
+                    del self._users[searcher]
+                    searcher.close()
+
+    def stats(self):
+        """How often are we refreshing the searcher"""
+        with self._lock:
+            stats = dict(self._stats)
+
+        if stats['last_refresh']:
+            stats['last_refresh'] = str(stats['last_refresh'])
+        return stats
 
 
 class WhooshFulltext(object):
     """Implement the fulltext api using whoosh as a storage backend
 
     """
-    global WIX
+
+    def index_bookmark(self, connection, bmark, content=None):
+        """Queue the bookmark for the index writer process"""
+        FulltextQueueMgr.enqueue(bmark.bid, content, connection=connection)
+
+    def index_content(self, connection, bid, content):
+        """Queue the bookmark's new readable content for the index writer"""
+        FulltextQueueMgr.enqueue(bid, content, connection=connection)
+
+    def delete_bookmarks(self, connection, bids):
+        """Queue the removed bookmarks to come out of the index"""
+        FulltextQueueMgr.enqueue_delete(bids, connection=connection)
+
+    def index_stats(self, indexname=META_INDEX):
+        """How fragmented is the metadata or the content index"""
+        _follow_swap()
+        with POOLS[indexname].searcher() as search:
+            reader = search.reader()
+            total = reader.doc_count_all()
+            return {
+                'segments': len(reader.leaf_readers()),
+                'documents': reader.doc_count(),
+                'deleted': total - reader.doc_count(),
+                'deleted_ratio': (
+                    float(total - reader.doc_count()) / total if total else 0),
+            }
+
+    def optimize(self, segments=10, deleted_ratio=0.2):
+        """Queue an optimize of each index fragmented past the thresholds
+
+        :param segments: optimize once there are at least this many segments
+        :param deleted_ratio: or once this share of the documents are deleted
+
+        """
+        stats = {}
+        for indexname in SCHEMAS:
+            found = self.index_stats(indexname)
+            found['optimize'] = (found['segments'] >= segments or
+                                 found['deleted_ratio'] >= deleted_ratio)
+            if found['optimize']:
+                FulltextQueueMgr.enqueue_optimize(indexname)
+            stats[indexname] = found
+
+        stats['optimize'] = any(found['optimize'] for found in stats.values())
+        return stats
+
+    def reindex(self, sync=False):
+        """Queue every bookmark for the index writer
+
+        :param sync: process the queue right here vs waiting on the writer
+
+        """
+        trans = transaction.begin()
+        for (bid,) in DBSession.query(Bmark.bid):
+            FulltextQueueMgr.enqueue(bid)
+        trans.commit()
+
+        if sync:
+            IndexWriter().drain()
+
+    def reconcile(self):
+        """Queue the bookmarks the index is missing or has an old copy of
+
+        The bids in the database and in the index are walked side by side as
+        two sorted streams, so every bookmark is checked without loading
+        them all. Only the bookmarks updated since the last run, the
+        high-water mark, are checked for a stale document.
+
+        Returns the counts of what was checked, found and queued.
+
+        """
+        started = datetime.utcnow()
+        mark = FulltextQueueMgr.get_mark(RECONCILE_MARK)
+        stats = {'checked': 0, 'missing': 0, 'stale': 0, 'orphaned': 0}
+        delta = set()
+        orphans = []
+
+        # The index sorts the bids as strings, so the database has to too.
+        db_bids = (str(bid) for (bid,) in DBSession.query(Bmark.bid).
+                   order_by(cast(Bmark.bid, Unicode)).
+                   yield_per(RECONCILE_CHUNK))
+
+        _follow_swap()
+        with SEARCHERS.searcher() as search:
+            diff = _diff_sorted(db_bids, _indexed_bids(search.reader()))
+            for bid, in_db, in_index in diff:
+                if in_db:
+                    stats['checked'] += 1
+                    if not in_index:
+                        stats['missing'] += 1
+                        delta.add(int(bid))
+                else:
+                    stats['orphaned'] += 1
+                    orphans.append(int(bid))
+
+            # An index built before the documents kept their updated stamp
+            # can't tell a stale copy apart, it takes a rebuild instead.
+            if mark is not None and 'updated' in search.schema:
+                changed = DBSession.query(Bmark.bid, Bmark.updated).\
+                    filter(Bmark.updated > mark)
+                for bid, updated in changed:
+                    doc = search.document(bid=str(bid))
+                    if doc and doc.get('updated') != _stamp(updated):
+                        stats['stale'] += 1
+                        delta.add(bid)
+
+        stats['queued'] = _enqueue_delta(delta)
+        _enqueue_delta(orphans, delete=True)
+        FulltextQueueMgr.set_mark(RECONCILE_MARK, started - RECONCILE_OVERLAP)
+        return stats
 
     def doc_count(self):
-        with WIX.searcher() as search:
+        _follow_swap()
+        with SEARCHERS.searcher() as search:
             return search.doc_count()
 
+    def stats(self):
+        """Report on the shared searchers for this process"""
+        _follow_swap()
+        stats = SEARCHERS.stats()
+        for indexname in (CONTENT_INDEX, SUGGEST_INDEX):
+            stats[indexname] = POOLS[indexname].stats()
+        return stats
+
+    def cache_stats(self):
+        """Report on the search result cache for this process"""
+        return CACHE.stats()
+
     def findByID(self, bid):
         """Find the item in the fulltext index by id"""
-        with WIX.searcher() as search:
+        _follow_swap()
+        with SEARCHERS.searcher() as search:
             found = search.documents(bid=str(bid))
             res = [b for b in found]
         if res:
@@ -103,51 +1251,622 @@ class WhooshFulltext(object):
             return None
 
     def search(self, phrase, content=False, username=None, ct=10, page=0,
-               requested_by=None):
-        """Implement the search, returning a list of bookmarks"""
-        page = int(page) + 1
+               requested_by=None, with_readable=False, hydrate=True,
+               timeout=None):
+        """Implement the search, returning a list of bookmarks
 
-        with WIX.searcher() as search:
-            fields = ['description', 'extended', 'tags']
+        The bookmarks come back in relevance order with their score attached
+        and the list knows the total number of hits for the search.
 
+        :param with_readable: also load the readable content of each bookmark
+        :param hydrate: load the bookmarks from the database. If False we
+            build the results from the fields stored in the index instead.
+        :param timeout: seconds the search may run before we settle for the
+            hits found so far, see search_timeout
+
+        """
+        started = time.time()
+        deadline = started + timeout if timeout else None
+        page = int(page) + 1
+        args = (phrase, content, username, int(ct), page, requested_by,
+                hydrate, deadline)
+
+        _follow_swap()
+        with SEARCHERS.searcher() as search:
             if content:
-                fields.append('readable')
-
-            parser = qparser.MultifieldParser(fields,
-                                              schema=WIX.schema,
-                                              group=qparser.OrGroup)
-            qry = parser.parse(phrase)
-
-            if username:
-                if requested_by and username == requested_by:
-                    qry = And([
-                        qry,
-                        Or([
-                            Term('is_private', 'f'),
-                            And([
-                                Term('username', username),
-                                Term('is_private', 't')
-                            ])
-                        ])
-                    ])
-                else:
-                    qry = And([qry, Term('username', username),
-                              Term('is_private', 'f')])
+                with CONTENT_SEARCHERS.searcher() as content_search:
+                    cached = self._cached_search(search, content_search, *args)
             else:
-                qry = And([qry, Term('is_private', 'f')])
+                cached = self._cached_search(search, None, *args)
 
-            try:
-                res = search.search_page(qry, page, pagelen=int(ct))
-            except ValueError as exc:
-                raise(exc)
+        if hydrate:
+            hits = _hydrate(cached['hits'], with_readable=with_readable)
+        else:
+            # Hand out copies, the cached hits are shared.
+            hits = [dict(hit) for hit in cached['hits']]
+        return SearchResults(hits, cached['total'],
+                             truncated=cached.get('truncated', False),
+                             elapsed=time.time() - started,
+                             facets=cached.get('facets'))
 
-            if res:
-                qry = Bmark.query.filter(
-                    Bmark.bid.in_([r['bid'] for r in res])
-                )
+    def suggest(self, prefix, username=None, requested_by=None, ct=10,
+                timeout=None):
+        """Suggest bookmarks for a search that's still being typed
 
-                qry = qry.options(joinedload('hashed'))
+        Every word is treated as a prefix of a word in the description or
+        tags and looked up in the small suggest index. Results are cached
+        per prefix until the index changes.
 
-                return qry.all()
-            else:
-                return []
+        Returns a list of dicts with the bid, description, url and score.
+
+        """
+        words = _suggest_words(prefix)
+        if not words:
+            return []
+        deadline = time.time() + timeout if timeout else None
+
+        _follow_swap()
+        with SUGGEST_SEARCHERS.searcher() as search:
+            version = _searcher_version(search)
+            key = SearchCache.key(
+                ' '.join(words),
+                username=username,
+                requested_by=requested_by,
+                ct=int(ct),
+            )
+            found = SUGGEST_CACHE.get(key, version)
+
+            if found is None:
+                allowed = SUGGEST_SEARCHERS.filters.allowed(
+                    search, version, username, requested_by)
+                qry = And([Term('suggest', word) for word in words])
+                results, truncated = _collect(search, qry, int(ct), allowed,
+                                              deadline)
+                found = [{
+                    'bid': int(hit['bid']),
+                    'description': hit.get('description', ''),
+                    'url': hit.get('url', ''),
+                    'score': hit.score,
+                } for hit in results]
+                if not truncated:
+                    SUGGEST_CACHE.set(key, version, found)
+
+        # Hand out copies, the cached ones are shared.
+        return [dict(hit) for hit in found]
+
+    def _cached_search(self, search, content_search, phrase, content,
+                       username, ct, page, requested_by, hydrate, deadline):
+        """Check the result cache before running the search"""
+        version = _searcher_version(search)
+        allowed = SEARCHERS.filters.allowed(
+            search, version, username, requested_by)
+
+        content_allowed = None
+        if content_search is not None:
+            content_version = _searcher_version(content_search)
+            content_allowed = CONTENT_SEARCHERS.filters.allowed(
+                content_search, content_version, username, requested_by)
+            version += '|' + content_version
+
+        key = SearchCache.key(
+            phrase,
+            content=content,
+            username=username,
+            requested_by=requested_by,
+            ct=ct,
+            page=page,
+            hydrate=hydrate,
+        )
+        cached = CACHE.get(key, version)
+
+        if cached is None:
+            cached = self._search(search, allowed, content_search,
+                                  content_allowed, phrase, ct, page, hydrate,
+                                  deadline)
+            # Partial results might do better next time, don't keep them.
+            if not cached['truncated']:
+                CACHE.set(key, version, cached)
+        return cached
+
+    def _search(self, search, allowed, content_search, content_allowed,
+                phrase, ct, page, hydrate, deadline=None):
+        """Run the search in whoosh for a page of hits
+
+        Without a content searcher only the metadata index is searched,
+        otherwise the page content index is searched as well. The allowed
+        bitsets limit each search to what the user may see.
+
+        """
+        parser = qparser.MultifieldParser(['description', 'extended', 'tags'],
+                                          schema=WIX.schema,
+                                          group=qparser.OrGroup)
+        qry = parser.parse(phrase)
+
+        if content_search is not None:
+            parser = qparser.QueryParser('readable',
+                                         schema=CIX.schema,
+                                         group=qparser.OrGroup)
+            content_qry = parser.parse(phrase)
+            return _merged_search((search, qry, allowed),
+                                  (content_search, content_qry,
+                                   content_allowed),
+                                  ct, page, hydrate, deadline)
+
+        results, truncated = _collect(search, qry, page * ct, allowed,
+                                      deadline, facets=True)
+        res = ResultsPage(results, page, pagelen=ct)
+
+        if hydrate:
+            hits = [(int(hit['bid']), hit.score) for hit in res]
+        else:
+            hits = [_stored_hit(hit.fields(), hit.score) for hit in res]
+
+        return {
+            'hits': hits,
+            'total': res.total,
+            'truncated': truncated,
+            'facets': _tag_facets(results.groups('tags')),
+        }
+
+
+def _matched_bids(searcher, qry, allowed):
+    """The bids of every allowed document that matches the query"""
+    reader = searcher.reader()
+    docnums = [docnum for docnum in searcher.docs_for_query(qry)
+               if docnum in allowed]
+    if reader.has_column('bid'):
+        bids = reader.column_reader('bid')
+        return set(bids[docnum] for docnum in docnums)
+    else:
+        # An index from before bid was sortable.
+        return set(searcher.stored_fields(docnum)['bid']
+                   for docnum in docnums)
+
+
+def _estimated_total(results, limit, allowed):
+    """About how many allowed documents the search matched
+
+    A search that scored fewer hits than it asked for found every one of
+    them. Otherwise whoosh guesses from the postings, which don't know about
+    the filter, so the guess can't be more than the documents allowed.
+
+    """
+    if results.has_exact_length():
+        return len(results)
+    if results.scored_length() < limit:
+        return results.scored_length()
+    estimate = results.estimated_length()
+    if allowed is not None:
+        estimate = min(estimate, len(allowed))
+    return max(estimate, results.scored_length())
+
+
+def _merged_search(meta, content, ct, page, hydrate, deadline=None):
+    """Search the metadata and content indexes, adding up the scores
+
+    Each of meta and content is a (searcher, query, allowed) tuple. A
+    bookmark found in both gets the sum of its scores. Each index gives up
+    its top hits through the requested page which are merged and ranked
+    together.
+
+    The tag facets come from the metadata index, so they count the hits
+    that matched on the bookmark's own fields.
+
+    """
+    search, qry, allowed = meta
+    content_search, content_qry, content_allowed = content
+
+    limit = page * ct
+    scores = {}
+    stored = {}
+    results, truncated = _collect(search, qry, limit, allowed, deadline,
+                                  facets=True)
+    facets = _tag_facets(results.groups('tags'))
+    meta_total = _estimated_total(results, limit, allowed)
+    for hit in results:
+        scores[hit['bid']] = hit.score
+        stored[hit['bid']] = hit.fields()
+
+    content_truncated = True
+    if not truncated:
+        results, content_truncated = _collect(
+            content_search, content_qry, limit, content_allowed, deadline)
+        content_total = _estimated_total(results, limit, content_allowed)
+        for hit in results:
+            scores[hit['bid']] = scores.get(hit['bid'], 0) + hit.score
+
+    if truncated or content_truncated or (deadline and time.time() > deadline):
+        # Counting every match takes a while too, settle for what we found.
+        truncated = True
+        total = len(scores)
+    elif page == 1:
+        # An exact count walks every match in both indexes. The first page
+        # is the one nearly every search stops at, it makes do with an
+        # estimate that's exact whenever all the hits fit on it.
+        total = max(len(scores), meta_total, content_total)
+    else:
+        total = len(_matched_bids(search, qry, allowed) |
+                    _matched_bids(content_search, content_qry,
+                                  content_allowed))
+
+    start = (page - 1) * ct
+    if page > 1 and start >= total:
+        raise ValueError('Page number out of range')
+
+    ranked = sorted(scores.items(), key=lambda hit: hit[1], reverse=True)
+    ranked = ranked[start:start + ct]
+
+    if hydrate:
+        hits = [(int(bid), score) for bid, score in ranked]
+    else:
+        hits = []
+        for bid, score in ranked:
+            fields = stored.get(bid) or search.document(bid=bid)
+            if fields:
+                hits.append(_stored_hit(fields, score))
+
+    return {
+        'hits': hits,
+        'total': total,
+        'truncated': truncated,
+        'facets': facets,
+    }
+
+
+def _sql_privacy(username, requested_by):
+    """The where clause limiting a search to what the user may see"""
+    params = {'public': False}
+    if username:
+        params['username'] = username
+        if requested_by and username == requested_by:
+            clause = '(is_private = :public OR username = :username)'
+        else:
+            clause = '(is_private = :public AND username = :username)'
+    else:
+        clause = 'is_private = :public'
+    return clause, params
+
+
+class SqlFulltext(object):
+    """The common bits of the engines that index inside the database
+
+    The index tables are kept up to date from the bookmark mapper events on
+    the same connection, so they change in the same transaction as the
+    bookmark and there's no index directory to share between nodes.
+
+    Subclasses fill in the sql for their database.
+
+    """
+    # Tag counts over every hit of a search, MATCHED selects their bids.
+    FACETS = """
+        SELECT t.name, count(*) AS ct
+        FROM bmark_tags bt JOIN tags t ON t.tid = bt.tag_id
+        WHERE bt.bmark_id IN ({matched})
+        GROUP BY t.name
+    """
+
+    def index_bookmark(self, connection, bmark, content=None):
+        """Store the bookmark in the index table"""
+        doc = _bmark_document(bmark, content)
+        doc['bid'] = bmark.bid
+        self._upsert(connection, doc)
+
+    def index_content(self, connection, bid, content):
+        """Update the readable content for the bookmark"""
+        self._set_content(connection, bid, content if content else "")
+
+    def delete_bookmarks(self, connection, bids):
+        """Remove the bookmarks' rows from the index table"""
+        if bids:
+            connection.execute(
+                text(self.DELETE.format(
+                    ', '.join(str(int(bid)) for bid in bids))))
+
+    def optimize(self, segments=10, deleted_ratio=0.2):
+        """The database keeps its own index tidy"""
+        return {'optimize': False}
+
+    def reindex(self, sync=False, chunk=500):
+        """Backfill the index table from the bookmarks
+
+        We walk the bookmarks in bid order a chunk at a time and commit as
+        we go so that memory stays flat on large installs.
+
+        """
+        last_bid = 0
+        while True:
+            trans = transaction.begin()
+            bmarks = Bmark.query.\
+                filter(Bmark.bid > last_bid).\
+                options(joinedload('hashed'), joinedload('readable')).\
+                order_by(Bmark.bid).\
+                limit(chunk).\
+                all()
+
+            if not bmarks:
+                trans.abort()
+                break
+
+            connection = DBSession.connection()
+            for bmark in bmarks:
+                self.index_bookmark(connection, bmark)
+
+            last_bid = bmarks[-1].bid
+            trans.commit()
+
+    def reconcile(self, chunk=500):
+        """Index any bookmark that's missing from the index table
+
+        The index rows are written in the same transaction as the bookmark
+        so they can't go stale, only rows from before the engine was
+        switched on can be missing.
+
+        """
+        missing = [bid for (bid,) in DBSession.execute(text(self.MISSING))]
+        connection = DBSession.connection()
+        for idx in range(0, len(missing), chunk):
+            bmarks = Bmark.query.\
+                filter(Bmark.bid.in_(missing[idx:idx + chunk])).\
+                options(joinedload('hashed'), joinedload('readable')).\
+                all()
+            for bmark in bmarks:
+                self.index_bookmark(connection, bmark)
+
+        return {
+            'checked': Bmark.query.count(),
+            'missing': len(missing),
+            'stale': 0,
+            'orphaned': 0,
+            'queued': len(missing),
+        }
+
+    def stats(self):
+        """There's no shared searcher to report on"""
+        return {}
+
+    def cache_stats(self):
+        """There's no search cache to report on"""
+        return {}
+
+    def doc_count(self):
+        return DBSession.execute(text(self.COUNT_ALL)).scalar()
+
+    def findByID(self, bid):
+        """Find the item in the fulltext index by id"""
+        found = DBSession.execute(text(self.FIND), {'bid': int(bid)}).first()
+        if found:
+            return dict(found)
+        else:
+            return None
+
+    def clear(self):
+        """Empty out the index table"""
+        DBSession.execute(text(self.CLEAR))
+
+    def search(self, phrase, content=False, username=None, ct=10, page=0,
+               requested_by=None, with_readable=False, hydrate=True,
+               timeout=None):
+        """Implement the search, returning a list of bookmarks
+
+        Same api as WhooshFulltext.search. Without hydrate the results are
+        shaped like the ones whoosh builds from its stored fields. The
+        database runs the whole query so the timeout isn't used.
+
+        """
+        ct = int(ct)
+        page = int(page)
+        terms = phrase.split()
+        if not terms:
+            return SearchResults([], 0)
+
+        where, params = _sql_privacy(username, requested_by)
+        match, match_params, parts = self._match(terms, content)
+        params.update(match_params)
+        parts['where'] = '{0} AND {1}'.format(match, where)
+
+        total = DBSession.execute(
+            text(self.COUNT.format(**parts)), params).scalar()
+        if page and page * ct >= total:
+            raise ValueError('Page number out of range')
+
+        params['limit'] = ct
+        params['offset'] = page * ct
+        hits = [(bid, score) for bid, score in DBSession.execute(
+            text(self.SEARCH.format(**parts)), params)]
+
+        facets = _tag_facets(dict(DBSession.execute(
+            text(self.FACETS.format(matched=self.MATCHED.format(**parts))),
+            params)))
+
+        bmarks = _hydrate(hits, with_readable=with_readable)
+        if hydrate:
+            return SearchResults(bmarks, total, facets=facets)
+        else:
+            return SearchResults([_bmark_hit(b) for b in bmarks], total,
+                                 facets=facets)
+
+    def suggest(self, prefix, username=None, requested_by=None, ct=10,
+                timeout=None):
+        """Suggest bookmarks for a search that's still being typed
+
+        Same api as WhooshFulltext.suggest, each word is matched as a prefix
+        of the indexed words.
+
+        """
+        words = _suggest_words(prefix)
+        if not words:
+            return []
+
+        where, params = _sql_privacy(username, requested_by)
+        match, match_params, parts = self._prefix_match(words)
+        params.update(match_params)
+        parts['where'] = '{0} AND {1}'.format(match, where)
+        params['limit'] = int(ct)
+        params['offset'] = 0
+
+        hits = [(bid, score) for bid, score in DBSession.execute(
+            text(self.SEARCH.format(**parts)), params)]
+        return [{
+            'bid': bmark.bid,
+            'description': bmark.description or '',
+            'url': bmark.hashed.url,
+            'score': bmark.score,
+        } for bmark in _hydrate(hits)]
+
+
+class SqliteFulltext(SqlFulltext):
+    """Fulltext search using an sqlite FTS5 table
+
+    The bmarks_fts table uses the bookmark's bid as its rowid.
+
+    """
+    COUNT_ALL = 'SELECT count(*) FROM bmarks_fts'
+    CLEAR = 'DELETE FROM bmarks_fts'
+    DELETE = 'DELETE FROM bmarks_fts WHERE rowid IN ({0})'
+    MISSING = """
+        SELECT b.bid
+        FROM bmarks b LEFT JOIN bmarks_fts f ON f.rowid = b.bid
+        WHERE f.rowid IS NULL
+    """
+    FIND = """
+        SELECT rowid AS bid, description, extended, tags, username
+        FROM bmarks_fts
+        WHERE rowid = :bid
+    """
+    COUNT = 'SELECT count(*) FROM bmarks_fts WHERE {where}'
+    MATCHED = 'SELECT rowid FROM bmarks_fts WHERE {where}'
+    # bm25 is smaller for better matches, flip it so scores go up like the
+    # other engines.
+    SEARCH = """
+        SELECT rowid, -bm25(bmarks_fts) AS score
+        FROM bmarks_fts
+        WHERE {where}
+        ORDER BY bm25(bmarks_fts)
+        LIMIT :limit OFFSET :offset
+    """
+
+    def _upsert(self, connection, doc):
+        connection.execute(
+            text('DELETE FROM bmarks_fts WHERE rowid = :bid'),
+            bid=doc['bid'])
+        connection.execute(
+            text("""
+                INSERT INTO bmarks_fts (rowid, description, extended, tags,
+                                        readable, username, is_private)
+                VALUES (:bid, :description, :extended, :tags, :readable,
+                        :username, :is_private)
+            """),
+            **doc)
+
+    def _set_content(self, connection, bid, content):
+        connection.execute(
+            text('UPDATE bmarks_fts SET readable = :content '
+                 'WHERE rowid = :bid'),
+            bid=bid,
+            content=content)
+
+    def _match(self, terms, content):
+        """Build the MATCH clause, each term is quoted and OR'd together"""
+        qry = " OR ".join(
+            '"{0}"'.format(term.replace('"', '""')) for term in terms)
+        if not content:
+            qry = '{{description extended tags}} : ({0})'.format(qry)
+        return 'bmarks_fts MATCH :match', {'match': qry}, {}
+
+    def _prefix_match(self, words):
+        """Build the MATCH clause with every word as a prefix"""
+        qry = " AND ".join('"{0}"*'.format(word) for word in words)
+        qry = '{{description tags}} : ({0})'.format(qry)
+        return 'bmarks_fts MATCH :match', {'match': qry}, {}
+
+
+class PgsqlFulltext(SqlFulltext):
+    """Fulltext search using tsvector columns in postgresql
+
+    The bmark_fulltext table keeps a weighted vector of the bookmark's
+    description, tags and extended text in meta, and the readable page text
+    in content. Both have a GIN index.
+
+    """
+    COUNT_ALL = 'SELECT count(*) FROM bmark_fulltext'
+    CLEAR = 'DELETE FROM bmark_fulltext'
+    DELETE = 'DELETE FROM bmark_fulltext WHERE bid IN ({0})'
+    MISSING = """
+        SELECT b.bid
+        FROM bmarks b LEFT JOIN bmark_fulltext f ON f.bid = b.bid
+        WHERE f.bid IS NULL
+    """
+    FIND = 'SELECT bid, username FROM bmark_fulltext WHERE bid = :bid'
+    COUNT = """
+        SELECT count(*)
+        FROM bmark_fulltext, {query} AS qry
+        WHERE {where}
+    """
+    MATCHED = """
+        SELECT bid
+        FROM bmark_fulltext, {query} AS qry
+        WHERE {where}
+    """
+    SEARCH = """
+        SELECT bid, {rank} AS score
+        FROM bmark_fulltext, {query} AS qry
+        WHERE {where}
+        ORDER BY score DESC, bid DESC
+        LIMIT :limit OFFSET :offset
+    """
+
+    def _upsert(self, connection, doc):
+        connection.execute(
+            text("""
+                INSERT INTO bmark_fulltext (bid, username, is_private, meta,
+                                            content)
+                VALUES (
+                    :bid, :username, :is_private,
+                    setweight(to_tsvector('english', :description), 'A') ||
+                    setweight(to_tsvector('english', :tags), 'A') ||
+                    setweight(to_tsvector('english', :extended), 'B'),
+                    to_tsvector('english', :readable))
+                ON CONFLICT (bid) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    is_private = EXCLUDED.is_private,
+                    meta = EXCLUDED.meta,
+                    content = EXCLUDED.content
+            """),
+            **doc)
+
+    def _set_content(self, connection, bid, content):
+        connection.execute(
+            text("UPDATE bmark_fulltext "
+                 "SET content = to_tsvector('english', :content) "
+                 "WHERE bid = :bid"),
+            bid=bid,
+            content=content)
+
+    def _match(self, terms, content):
+        """Build the match clause, each term is OR'd together"""
+        params = {}
+        parts = []
+        for idx, term in enumerate(terms):
+            params['term{0}'.format(idx)] = term
+            parts.append(
+                "plainto_tsquery('english', :term{0})".format(idx))
+        query = '({0})'.format(' || '.join(parts))
+
+        if content:
+            return '(meta @@ qry OR content @@ qry)', params, {
+                'query': query,
+                'rank': 'ts_rank(meta, qry) + ts_rank(content, qry)',
+            }
+        else:
+            return 'meta @@ qry', params, {
+                'query': query,
+                'rank': 'ts_rank(meta, qry)',
+            }
+
+    def _prefix_match(self, words):
+        """Build the match clause with every word as a prefix"""
+        prefix = ' & '.join('{0}:*'.format(word) for word in words)
+        return 'meta @@ qry', {'prefix': prefix}, {
+            'query': "to_tsquery('english', :prefix)",
+            'rank': 'ts_rank(meta, qry)',
+        }
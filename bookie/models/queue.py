@@ -1,13 +1,20 @@
 import logging
+from collections import OrderedDict
 from datetime import datetime
+from datetime import timedelta
 
+from sqlalchemy import and_
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import Integer
+from sqlalchemy import func
 from sqlalchemy import or_
 from sqlalchemy import Unicode
+from sqlalchemy import UnicodeText
+from sqlalchemy import text
 
 from bookie.models import Base
+from bookie.models import DBSession
 
 LOG = logging.getLogger(__name__)
 
@@ -16,6 +23,50 @@ RUNNING = 1
 COMPLETE = 2
 ERROR = 3
 
+# What the index writer should do with a fulltext_queue record.
+FT_INDEX = 0
+FT_DELETE = 1
+FT_OPTIMIZE = 2
+
+# Where a url in the fetch_queue is at. Fetched urls are removed.
+FETCH_PENDING = 0
+FETCH_LEASED = 1
+FETCH_FAILED = 2
+
+# Urls someone is waiting on go in the interactive lane and are always
+# claimed first. Imports and sweeps go in the bulk lane, which is shared out
+# between the users with urls in it.
+FETCH_INTERACTIVE = 0
+FETCH_BULK = 1
+FETCH_LANES = (FETCH_INTERACTIVE, FETCH_BULK)
+
+# How a failed fetch is retried, by the class of status it ended with: the
+# first delay in seconds, doubled each attempt, and how many attempts before
+# giving up. None won't get any better by trying again.
+FETCH_BACKOFF = {
+    'throttled': (15 * 60, 8),
+    'server': (60 * 60, 5),
+    'network': (30 * 60, 6),
+    'client': None,
+    'unreadable': None,
+}
+FETCH_BACKOFF_MAX = 7 * 24 * 60 * 60
+
+
+def fetch_status_class(status):
+    """Which FETCH_BACKOFF class a readable status falls in"""
+    if status in (429, 503):
+        return 'throttled'
+    if 500 <= status < 600:
+        return 'server'
+    # socket errors and timeouts, incomplete reads, bad status lines
+    if status in (408, 902, 903, 905):
+        return 'network'
+    if 400 <= status < 500:
+        return 'client'
+    # unparseable, unusable urls, empty documents
+    return 'unreadable'
+
 
 class ImportQueueMgr(object):
     """All the static methods for ImportQueue"""
@@ -102,3 +153,596 @@ class ImportQueue(Base):
         """Mark it complete"""
         self.completed = datetime.utcnow()
         self.status = COMPLETE
+
+
+class FulltextQueueMgr(object):
+    """All the static methods for FulltextQueue"""
+
+    @staticmethod
+    def enqueue(bid, content=None, connection=None):
+        """Ask the index writer to (re)index the bookmark bid
+
+        :param content: the clean readable content if we already have it
+        :param connection: when called from a mapper event pass the event's
+            connection so the queue row lands in the same transaction as the
+            bookmark change itself.
+
+        """
+        if connection is not None:
+            connection.execute(
+                FulltextQueue.__table__.insert().values(
+                    bid=bid,
+                    content=content,
+                    action=FT_INDEX,
+                )
+            )
+        else:
+            DBSession.add(FulltextQueue(bid, content=content))
+
+    @staticmethod
+    def enqueue_delete(bids, connection=None):
+        """Ask the index writer to remove the bookmarks from the index
+
+        All the bids go in with one insert so bulk deletes stay cheap.
+
+        """
+        if not bids:
+            return
+
+        if connection is None:
+            connection = DBSession.connection()
+        connection.execute(
+            FulltextQueue.__table__.insert(),
+            [{'bid': bid, 'action': FT_DELETE} for bid in bids])
+
+    @staticmethod
+    def enqueue_optimize(indexname=None):
+        """Ask the index writer to merge an index down
+
+        :param indexname: which of the whoosh indexes, None for all of them
+
+        """
+        DBSession.add(FulltextQueue(0, content=indexname, action=FT_OPTIMIZE))
+
+    @staticmethod
+    def get_ready(limit=500):
+        """Get the oldest batch of queued index requests"""
+        qry = FulltextQueue.query.order_by(FulltextQueue.id)
+        return qry.limit(limit).all()
+
+    @staticmethod
+    def remove(ids):
+        """Clear out the queue records once they've been indexed"""
+        if ids:
+            qry = FulltextQueue.query.filter(FulltextQueue.id.in_(ids))
+            qry.delete(synchronize_session=False)
+
+    @staticmethod
+    def size():
+        """How deep is the queue at the moment"""
+        return FulltextQueue.query.count()
+
+    @staticmethod
+    def queued(bids):
+        """Which of these bookmarks are already waiting in the queue"""
+        if not bids:
+            return set()
+        qry = DBSession.query(FulltextQueue.bid).\
+            filter(FulltextQueue.bid.in_(bids))
+        return set(bid for (bid,) in qry)
+
+    @staticmethod
+    def get_mark(name):
+        """Get the timestamp saved under name, None if there isn't one"""
+        state = FulltextState.query.get(name)
+        return state.tstamp if state else None
+
+    @staticmethod
+    def set_mark(name, tstamp):
+        """Save the timestamp under name for the next run"""
+        state = FulltextState.query.get(name)
+        if state is None:
+            state = FulltextState(name)
+            DBSession.add(state)
+        state.tstamp = tstamp
+
+
+class FulltextQueue(Base):
+    """Bookmarks waiting on the index writer to be put into the fulltext index
+
+    Only the index writer process ever opens a writer on the fulltext index.
+    Everyone else drops a record in here and moves on.
+
+    """
+    __tablename__ = 'fulltext_queue'
+
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    bid = Column(Integer, nullable=False, index=True)
+    content = Column(UnicodeText)
+    action = Column(Integer, nullable=False, default=FT_INDEX)
+    tstamp = Column(DateTime, default=datetime.utcnow)
+
+    def __init__(self, bid, content=None, action=FT_INDEX):
+        """Queue up a bookmark for the index writer"""
+        self.bid = bid
+        self.content = content
+        self.action = action
+
+
+class FulltextState(Base):
+    """Timestamps the fulltext jobs keep between runs
+
+    The reconcile job keeps its high-water mark in here so it only has to
+    check the bookmarks that changed since it last ran.
+
+    """
+    __tablename__ = 'fulltext_state'
+
+    name = Column(Unicode(255), primary_key=True)
+    tstamp = Column(DateTime)
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FetchQueueMgr(object):
+    """All the static methods for FetchQueue
+
+    The content fetch workers lease batches of urls out of the queue. A
+    worker that dies leaves its lease to run out and someone else picks the
+    urls up.
+
+    """
+
+    # Lease a batch of ready urls for this worker. Postgres skips rows another
+    # worker has locked, the others mark the rows with the worker's token and
+    # read back what they got.
+    CLAIM_READY = (
+        "((state = :pending AND next_attempt <= :now) OR "
+        "(state = :leased AND lease_expires < :now)) AND lane = :lane")
+    CLAIM_SET = (
+        "state = :leased, lease_owner = :owner, lease_expires = :expires, "
+        "attempts = attempts + 1")
+    CLAIM = {
+        'postgresql': (
+            "UPDATE fetch_queue SET {set} WHERE hash_id IN ("
+            "SELECT hash_id FROM fetch_queue WHERE {ready} "
+            "ORDER BY next_attempt LIMIT :limit "
+            "FOR UPDATE SKIP LOCKED) RETURNING hash_id"),
+        'mysql': (
+            "UPDATE fetch_queue SET {set} WHERE {ready} "
+            "ORDER BY next_attempt LIMIT :limit"),
+        'sqlite': (
+            "UPDATE fetch_queue SET {set} WHERE hash_id IN ("
+            "SELECT hash_id FROM fetch_queue WHERE {ready} "
+            "ORDER BY next_attempt LIMIT :limit)"),
+    }
+
+    @staticmethod
+    def enqueue(hash_ids, username=None, lane=FETCH_BULK, now=None):
+        """Queue the urls to be fetched for username
+
+        Urls already waiting in the bulk lane are moved up when they're
+        queued as interactive, and urls we gave up on are tried afresh.
+        Anything else already queued is left alone. Returns the hash_ids that
+        were added, moved up or tried again.
+
+        """
+        now = now or datetime.utcnow()
+        hash_ids = list(set(hash_ids))
+        if not hash_ids:
+            return []
+
+        queued = {}
+        failed = []
+        for hash_id, queued_lane, state in DBSession.query(
+                FetchQueue.hash_id, FetchQueue.lane, FetchQueue.state).\
+                filter(FetchQueue.hash_id.in_(hash_ids)):
+            if state == FETCH_FAILED:
+                failed.append(hash_id)
+            else:
+                queued[hash_id] = queued_lane
+        added = [hash_id for hash_id in hash_ids
+                 if hash_id not in queued and hash_id not in failed]
+        if added:
+            DBSession.execute(FetchQueue.__table__.insert(), [{
+                'hash_id': hash_id,
+                'lane': lane,
+                'username': username,
+                'state': FETCH_PENDING,
+                'attempts': 0,
+                'next_attempt': now,
+                'tstamp': now,
+            } for hash_id in added])
+
+        moved = []
+        if lane == FETCH_INTERACTIVE:
+            moved = [hash_id for hash_id, queued_lane in queued.items()
+                     if queued_lane != FETCH_INTERACTIVE]
+        if moved:
+            FetchQueue.query.\
+                filter(FetchQueue.hash_id.in_(moved)).\
+                filter(FetchQueue.state == FETCH_PENDING).\
+                update({
+                    'lane': FETCH_INTERACTIVE,
+                    'username': username,
+                    'next_attempt': now,
+                    'tstamp': now,
+                }, synchronize_session=False)
+        if failed:
+            FetchQueue.query.\
+                filter(FetchQueue.hash_id.in_(failed)).\
+                filter(FetchQueue.state == FETCH_FAILED).\
+                update({
+                    'lane': lane,
+                    'username': username,
+                    'state': FETCH_PENDING,
+                    'attempts': 0,
+                    'next_attempt': now,
+                    'tstamp': now,
+                }, synchronize_session=False)
+        return added + moved + failed
+
+    @staticmethod
+    def ready(now):
+        """Filter for the urls that can be claimed at now"""
+        return or_(
+            and_(FetchQueue.state == FETCH_PENDING,
+                 FetchQueue.next_attempt <= now),
+            and_(FetchQueue.state == FETCH_LEASED,
+                 FetchQueue.lease_expires < now))
+
+    @staticmethod
+    def shares(backlog, limit, weights=None):
+        """Split limit between users by weighted round robin
+
+        backlog is the (username, ready count) of each user, in the order
+        they're served. Each round every user gets up to their weight, 1
+        unless weights says otherwise, until the limit is used up or the
+        backlog runs out. Returns the (username, share) of users that got
+        any.
+
+        """
+        weights = weights or {}
+        left = OrderedDict(
+            (username, count) for username, count in backlog if count > 0)
+        shares = OrderedDict((username, 0) for username in left)
+        while limit > 0 and left:
+            for username in list(left):
+                take = min(max(1, int(weights.get(username, 1))),
+                           left[username], limit)
+                shares[username] += take
+                left[username] -= take
+                limit -= take
+                if not left[username]:
+                    del left[username]
+                if not limit:
+                    break
+        return [(username, share) for username, share in shares.items()
+                if share]
+
+    @staticmethod
+    def claim(owner, limit=500, lease=30 * 60, now=None, lanes=FETCH_LANES,
+              weights=None):
+        """Lease up to limit ready urls to owner, returning their hash_ids
+
+        owner should be unique to this claim, the lease is only good to it.
+        The interactive lane is claimed first, whatever is left of the limit
+        is shared out between the users waiting in the bulk lane with the
+        users that have waited longest going first.
+
+        """
+        now = now or datetime.utcnow()
+        dialect = DBSession.get_bind().dialect.name
+        sql = FetchQueueMgr.CLAIM.get(dialect, FetchQueueMgr.CLAIM['sqlite'])
+        params = {
+            'pending': FETCH_PENDING,
+            'leased': FETCH_LEASED,
+            'owner': owner,
+            'expires': now + timedelta(seconds=lease),
+            'now': now,
+        }
+
+        def lease_rows(lane, count, username=False):
+            """Lease count urls from the lane, for one user if given"""
+            ready = FetchQueueMgr.CLAIM_READY
+            values = dict(params, lane=lane, limit=count)
+            if username is None:
+                ready += " AND username IS NULL"
+            elif username is not False:
+                ready += " AND username = :username"
+                values['username'] = username
+            res = DBSession.execute(
+                text(sql.format(set=FetchQueueMgr.CLAIM_SET, ready=ready)),
+                values)
+            if dialect == 'postgresql':
+                return [hash_id for (hash_id,) in res]
+            return []
+
+        claimed = []
+        left = limit
+        if FETCH_INTERACTIVE in lanes:
+            claimed.extend(lease_rows(FETCH_INTERACTIVE, left))
+            if dialect != 'postgresql':
+                left -= FetchQueue.query.\
+                    filter(FetchQueue.lease_owner == owner).\
+                    filter(FetchQueue.state == FETCH_LEASED).count()
+            else:
+                left -= len(claimed)
+
+        if FETCH_BULK in lanes and left > 0:
+            backlog = DBSession.query(
+                FetchQueue.username, func.count(FetchQueue.hash_id)).\
+                filter(FetchQueue.lane == FETCH_BULK).\
+                filter(FetchQueueMgr.ready(now)).\
+                group_by(FetchQueue.username).\
+                order_by(func.min(FetchQueue.next_attempt)).all()
+            for username, share in FetchQueueMgr.shares(backlog, left,
+                                                        weights):
+                claimed.extend(lease_rows(FETCH_BULK, share, username))
+
+        if dialect == 'postgresql':
+            return claimed
+
+        qry = DBSession.query(FetchQueue.hash_id).\
+            filter(FetchQueue.lease_owner == owner).\
+            filter(FetchQueue.state == FETCH_LEASED)
+        return [hash_id for (hash_id,) in qry]
+
+    @staticmethod
+    def complete(hash_ids, owner):
+        """Take the fetched urls out of the queue"""
+        if hash_ids:
+            FetchQueue.query.\
+                filter(FetchQueue.hash_id.in_(hash_ids)).\
+                filter(FetchQueue.lease_owner == owner).\
+                delete(synchronize_session=False)
+
+    @staticmethod
+    def renew(owner, lease=30 * 60, now=None):
+        """Extend the lease on the urls owner still has to fetch"""
+        now = now or datetime.utcnow()
+        FetchQueue.query.\
+            filter(FetchQueue.lease_owner == owner).\
+            filter(FetchQueue.state == FETCH_LEASED).\
+            update({'lease_expires': now + timedelta(seconds=lease)},
+                   synchronize_session=False)
+
+    @staticmethod
+    def defer(hash_ids, owner, until):
+        """Put leased urls back until later without using up an attempt"""
+        if hash_ids:
+            FetchQueue.query.\
+                filter(FetchQueue.hash_id.in_(hash_ids)).\
+                filter(FetchQueue.lease_owner == owner).\
+                update({
+                    'state': FETCH_PENDING,
+                    'lease_owner': None,
+                    'lease_expires': None,
+                    'next_attempt': until,
+                    'attempts': FetchQueue.attempts - 1,
+                }, synchronize_session=False)
+
+    @staticmethod
+    def fail(hash_id, status, owner, now=None):
+        """Back off a failed fetch, returns False once we've given up on it
+
+        A url we give up on is parked as failed, out of the way of the
+        workers, until it's queued again.
+
+        """
+        now = now or datetime.utcnow()
+        item = FetchQueue.query.get(hash_id)
+        if item is None or item.lease_owner != owner:
+            return False
+
+        item.last_status = status
+        item.lease_owner = None
+        item.lease_expires = None
+        backoff = FETCH_BACKOFF[fetch_status_class(status)]
+        if backoff is None or item.attempts >= backoff[1]:
+            item.state = FETCH_FAILED
+            return False
+
+        delay = min(FETCH_BACKOFF_MAX,
+                    backoff[0] * 2 ** max(0, item.attempts - 1))
+        item.state = FETCH_PENDING
+        item.next_attempt = now + timedelta(seconds=delay)
+        return True
+
+    @staticmethod
+    def size():
+        """How many urls are waiting, being fetched and given up on"""
+        counts = dict(DBSession.query(
+            FetchQueue.state, func.count(FetchQueue.hash_id)).
+            group_by(FetchQueue.state))
+        return {
+            'pending': counts.get(FETCH_PENDING, 0),
+            'leased': counts.get(FETCH_LEASED, 0),
+            'failed': counts.get(FETCH_FAILED, 0),
+        }
+
+    @staticmethod
+    def backlog(now=None):
+        """What each user has waiting in each lane and for how long
+
+        Returns a dict per user and lane with the count of urls pending and
+        leased, and the seconds the oldest of them has been waiting.
+
+        """
+        now = now or datetime.utcnow()
+        qry = DBSession.query(
+            FetchQueue.username,
+            FetchQueue.lane,
+            FetchQueue.state,
+            func.count(FetchQueue.hash_id),
+            func.min(FetchQueue.tstamp)).\
+            filter(FetchQueue.state != FETCH_FAILED).\
+            group_by(FetchQueue.username, FetchQueue.lane, FetchQueue.state)
+
+        found = OrderedDict()
+        for username, lane, state, count, oldest in qry:
+            key = (username, lane)
+            if key not in found:
+                found[key] = {
+                    'username': username,
+                    'lane': 'interactive' if lane == FETCH_INTERACTIVE
+                    else 'bulk',
+                    'pending': 0,
+                    'leased': 0,
+                    'oldest_wait': 0,
+                }
+            item = found[key]
+            item['pending' if state == FETCH_PENDING else 'leased'] += count
+            if oldest is not None:
+                item['oldest_wait'] = max(
+                    item['oldest_wait'],
+                    int((now - oldest).total_seconds()))
+        return sorted(found.values(),
+                      key=lambda item: (-item['oldest_wait'],
+                                        item['username'] or u''))
+
+    @staticmethod
+    def waits(hash_ids, now=None):
+        """How long each user's urls have been waiting, by username"""
+        now = now or datetime.utcnow()
+        waits = {}
+        if hash_ids:
+            qry = DBSession.query(FetchQueue.username, FetchQueue.tstamp).\
+                filter(FetchQueue.hash_id.in_(hash_ids))
+            for username, tstamp in qry:
+                waits.setdefault(username, []).append(
+                    (now - tstamp).total_seconds())
+        return waits
+
+
+class FetchQueue(Base):
+    """Urls waiting on the content fetch workers"""
+    __tablename__ = 'fetch_queue'
+
+    hash_id = Column(Unicode(22), primary_key=True)
+    lane = Column(Integer, nullable=False, default=FETCH_BULK)
+    username = Column(Unicode(255), index=True)
+    state = Column(Integer, nullable=False, default=FETCH_PENDING)
+    lease_owner = Column(Unicode(255))
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, default=datetime.utcnow, index=True)
+    last_status = Column(Integer)
+    tstamp = Column(DateTime, default=datetime.utcnow)
+
+
+class HostHealthMgr(object):
+    """All the static methods for HostHealth
+
+    A host whose fetches keep failing has its circuit opened and its urls are
+    put off until the cooldown is up. Then a single url goes through as a
+    probe, which closes the circuit if it works and opens it for twice as
+    long if it doesn't.
+
+    """
+    FAILURES = 5
+    COOLDOWN = 15 * 60
+    COOLDOWN_MAX = 24 * 60 * 60
+    # How long a probe holds the host for itself.
+    PROBE = 5 * 60
+
+    @staticmethod
+    def check(hosts, now=None):
+        """Which hosts to put off, and which this caller may probe
+
+        Returns a dict of hosts with open circuits to when they can be tried
+        again, and the set of hosts whose cooldown is up that this caller
+        gets to send one url to. Those are put off for everyone else while
+        the probe runs.
+
+        """
+        now = now or datetime.utcnow()
+        blocked = {}
+        probes = set()
+        if not hosts:
+            return blocked, probes
+
+        qry = HostHealth.query.\
+            filter(HostHealth.host.in_(list(hosts))).\
+            filter(HostHealth.open_until.isnot(None))
+        for health in qry:
+            if health.open_until > now:
+                blocked[health.host] = health.open_until
+                continue
+
+            # Only one worker gets to probe, whoever moves open_until first.
+            until = now + timedelta(seconds=HostHealthMgr.PROBE)
+            won = HostHealth.query.\
+                filter(HostHealth.host == health.host).\
+                filter(HostHealth.open_until == health.open_until).\
+                update({'open_until': until}, synchronize_session=False)
+            if won:
+                probes.add(health.host)
+            blocked[health.host] = until
+        return blocked, probes
+
+    @staticmethod
+    def record(outcomes, probes=(), now=None, failures=None, cooldown=None):
+        """Count each (host, status) fetch result against its host, in order
+
+        status is None when the host answered fine. probes are the hosts
+        check handed out, their result decides whether the circuit closes or
+        opens again for longer.
+
+        """
+        now = now or datetime.utcnow()
+        failures = failures or HostHealthMgr.FAILURES
+        cooldown = cooldown or HostHealthMgr.COOLDOWN
+        hosts = set(host for host, status in outcomes)
+        if not hosts:
+            return
+
+        found = dict(
+            (health.host, health) for health in
+            HostHealth.query.filter(HostHealth.host.in_(list(hosts))))
+        for host, status in outcomes:
+            health = found.get(host)
+            if status is None:
+                if health is not None:
+                    health.failures = 0
+                    health.open_until = None
+                    health.cooldown = None
+                    health.last_success = now
+                continue
+
+            if health is None:
+                health = found[host] = HostHealth(host)
+                DBSession.add(health)
+            health.failures += 1
+            health.last_status = status
+            health.last_failure = now
+
+            if host in probes:
+                health.cooldown = min(HostHealthMgr.COOLDOWN_MAX,
+                                      (health.cooldown or cooldown) * 2)
+            elif health.open_until is None and health.failures >= failures:
+                health.cooldown = cooldown
+            else:
+                continue
+            health.open_until = now + timedelta(seconds=health.cooldown)
+            LOG.info('Host {0} is down, putting it off for {1}s'.format(
+                host, health.cooldown))
+
+
+class HostHealth(Base):
+    """How the fetches to each host have been going"""
+    __tablename__ = 'host_health'
+
+    host = Column(Unicode(255), primary_key=True)
+    failures = Column(Integer, nullable=False, default=0)
+    # Set while the circuit is open, when the host can be tried again.
+    open_until = Column(DateTime)
+    cooldown = Column(Integer)
+    last_status = Column(Integer)
+    last_failure = Column(DateTime)
+    last_success = Column(DateTime)
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
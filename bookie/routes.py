@@ -149,6 +149,9 @@ def build_routes(config):
     config.add_route("api_bmark_search", "api/v1/bmarks/search/*terms")
     config.add_route("api_bmark_search_user",
                      "/api/v1/{username}/bmarks/search/*terms")
+    config.add_route("api_bmark_suggest", "api/v1/bmarks/suggest")
+    config.add_route("api_bmark_suggest_user",
+                     "/api/v1/{username}/bmarks/suggest")
 
     config.add_route('api_bmarks', 'api/v1/bmarks')
     config.add_route('api_bmarks_tags', 'api/v1/bmarks/*tags')
@@ -183,6 +186,9 @@ def build_routes(config):
 
     # admin api calls
     config.add_route("api_admin_readable_todo", "/api/v1/a/readable/todo")
+    config.add_route(
+        "api_admin_readable_queue",
+        "/api/v1/a/readable/queue")
     config.add_route(
         "api_admin_readable_reindex",
         "/api/v1/a/readable/reindex")
@@ -16,8 +16,8 @@
                     % endif
                     ${bmark.description}</a></h1>
     <div id="readable_content">
-        % if bmark.readable and bmark.readable.content:
-            ${bmark.readable.content|n}
+        % if content:
+            ${content|n}
         % else:
             <p>No parsed content for this bookmark</p>
         % endif
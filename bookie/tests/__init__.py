@@ -16,9 +16,14 @@ from bookie.models import Bmark
 from bookie.models import Hashed
 from bookie.models import Readable
 from bookie.models import Tag
+from bookie.models import TagSuggestion
 from bookie.models.applog import AppLog
 from bookie.models.auth import Activation
 from bookie.models.auth import User
+from bookie.models.queue import FetchQueue
+from bookie.models.queue import FulltextQueue
+from bookie.models.queue import FulltextState
+from bookie.models.queue import HostHealth
 from bookie.models.queue import ImportQueue
 from bookie.models.social import (
     BaseConnection,
@@ -132,6 +137,7 @@ def empty_db():
     """On teardown, remove all the db stuff"""
     DBSession.execute(bmarks_tags.delete())
     Readable.query.delete()
+    TagSuggestion.query.delete()
     Bmark.query.delete()
     StatBookmark.query.delete()
     # BaseConnection and TwitterConnection should be individually
@@ -143,6 +149,10 @@ def empty_db():
     # we can't remove the toread tag we have from our commands
     Hashed.query.delete()
     ImportQueue.query.delete()
+    FulltextQueue.query.delete()
+    FetchQueue.query.delete()
+    HostHealth.query.delete()
+    FulltextState.query.delete()
     # Delete the users not admin in the system.
     Activation.query.delete()
     User.query.filter(User.username != 'admin').delete()
@@ -7,6 +7,8 @@ import logging
 import os
 import transaction
 
+from mock import patch
+
 from bookie.models import (
     BmarkMgr,
     DBSession,
@@ -333,6 +335,25 @@ class BookieAPITest(BaseTestCase):
             bmark['readable']['content'])
         self._check_cors_headers(res)
 
+    def test_add_content_keeps_existing(self):
+        """Posted content doesn't replace what we have for the url"""
+        self._get_good_request(content=True)
+        prms = {
+            'url': 'http://google.com',
+            'description': 'This is my google desc',
+            'tags': 'python search',
+            'api_key': API_KEY,
+            'username': 'admin',
+            'content': '<p>Something else entirely</p>',
+        }
+        self.app.post('/api/v1/admin/bmark',
+                      content_type='application/json',
+                      params=json.dumps(prms),
+                      status=200)
+
+        readable = Readable.query.get(GOOGLE_HASH)
+        self.assertTrue('dude' in readable.content, readable.content)
+
     def test_bookmark_fetch_with_suggestions(self):
         """When a very recent bookmark is present return it."""
         self._get_good_request(content=True, second_bmark=True)
@@ -351,6 +372,27 @@ class BookieAPITest(BaseTestCase):
         self.assertIn('search', bmark['tag_suggestions'])
         self._check_cors_headers(res)
 
+    @patch('bookie.views.api.TagMgr.suggestions')
+    @patch('bookie.views.api.suggest_tags')
+    def test_bookmark_fetch_suggestion_order(self, mock_suggest,
+                                             mock_content):
+        """Content suggestions come first, best first, each only once"""
+        self._get_good_request()
+        mock_suggest.side_effect = lambda data: set(['engine', 'web'])
+        mock_content.return_value = ['web', 'crawler', 'alpha']
+        res = self.app.get(
+            '/api/v1/admin/bmark/{0}'.format(GOOGLE_HASH),
+            {
+                'api_key': API_KEY,
+                'url': 'http://google.com',
+                'description': 'The best search engine for Python things.'
+            },
+            status=200)
+
+        bmark = json.loads(res.unicode_body)
+        self.assertEqual(['web', 'crawler', 'alpha', 'engine'],
+                         bmark['tag_suggestions'])
+
     def test_no_bookmark_fetch_with_suggestions(self):
         """When a very recent bookmark is present return it."""
         res = self.app.get(
@@ -4,9 +4,12 @@ from datetime import timedelta
 import transaction
 
 from bookie.bcelery import tasks
+from bookie.lib import readable as read_lib
 from bookie.models import Bmark
 from bookie.models import DBSession
+from bookie.models import Readable
 from bookie.models import Tag
+from bookie.models import TagMgr
 from bookie.models import stats
 from bookie.models.auth import User
 from bookie.models.auth import (
@@ -147,3 +150,61 @@ class BCeleryTaskTest(TestDBBase):
             len(activations),
             'We should have a total of 2 activations: ' + str(len(activations))
         )
+
+    @patch('bookie.bcelery.tasks.fetch_url_content')
+    def test_refresh_bmark_content(self, mock_fetch):
+        """Due urls are refetched and put off until the fetch is done"""
+        trans = transaction.begin()
+        bmarks = Bmark.query.filter(Bmark.username == self.username).all()
+        for bmark in bmarks:
+            bmark.readable = Readable(content=u'<p>Old page</p>')
+        bmarks[0].readable.next_fetch = datetime.utcnow() + timedelta(days=1)
+        due = sorted(bmark.hash_id for bmark in bmarks[1:])
+        trans.commit()
+
+        tasks.refresh_bmark_content()
+
+        self.assertEqual(1, mock_fetch.delay.call_count)
+        args, kwargs = mock_fetch.delay.call_args
+        self.assertEqual(due, sorted(args[0]))
+        self.assertEqual({'refresh': True}, kwargs)
+
+        # The next run leaves them for the fetch already on its way.
+        later = Readable.query.filter(Readable.hash_id.in_(due)).all()
+        self.assertTrue(all(
+            readable.next_fetch > datetime.utcnow() for readable in later))
+        tasks.refresh_bmark_content()
+        self.assertEqual(1, mock_fetch.delay.call_count)
+
+    def test_store_readable_title_tags(self):
+        """The title's nouns are suggested after the content's own"""
+        bmark = Bmark.query.filter(Bmark.username == self.username).first()
+        read = read_lib.Readable()
+        read.status = read_lib.STATUS_CODES['200']
+        read.set_content(u'<p>Python web frameworks</p>')
+        read.suggested_tags = [(u'python', 2), (u'frameworks', 1)]
+
+        readable = Readable(hash_id=bmark.hash_id)
+        DBSession.add(readable)
+        tasks.store_readable(readable, read,
+                             set([u'python', u'django', u'io', u'2014']))
+        DBSession.flush()
+        self.assertEqual(
+            [u'python', u'frameworks', u'django'],
+            TagMgr.suggestions(bmark=bmark, url=bmark.hashed.url))
+
+    @patch('bookie.bcelery.tasks.fetch_queued_content')
+    @patch('bookie.bcelery.tasks.queue_fetch')
+    def test_unfetched_first_bookmarker(self, mock_queue, mock_fetch):
+        """An unfetched url is queued for whoever bookmarked it first"""
+        tasks.fetch_unfetched_bmark_content()
+
+        queued = {}
+        for (hash_ids, username), kwargs in mock_queue.call_args_list:
+            for hash_id in hash_ids:
+                queued[hash_id] = username
+        shared = Bmark.query.filter(
+            Bmark.username == self.new_username).one()
+        self.assertEqual(3, len(queued))
+        self.assertEqual(self.username, queued[shared.hash_id])
+        self.assertEqual(1, mock_fetch.delay.call_count)
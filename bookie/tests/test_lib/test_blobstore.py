@@ -0,0 +1,73 @@
+"""Test the blob store for readable content."""
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from bookie.lib.blobstore import BlobStore
+
+
+class TestBlobStore(TestCase):
+    """Verify blobs are stored once and read back"""
+
+    def setUp(self):
+        """Start each test with an empty store"""
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the store"""
+        shutil.rmtree(self.path)
+
+    def test_put_get(self):
+        """Blobs come back as they went in, stored once per content"""
+        store = BlobStore(self.path)
+        page = b'<p>Bookie</p>' * 100
+        digest, length = store.put(page)
+        self.assertEqual(len(page), length)
+        self.assertEqual((digest, length), store.put(page))
+        self.assertEqual(page, store.get(digest))
+
+        packed = os.path.getsize(os.path.join(self.path, 'pack-000001.pack'))
+        self.assertTrue(packed < len(page),
+                        "Stored compressed: " + str(packed))
+        self.assertRaises(KeyError, store.get, 'missing')
+
+    def test_packs_roll_over(self):
+        """A full pack starts a new one and the index can be rebuilt"""
+        store = BlobStore(self.path, pack_size=100)
+        blobs = [os.urandom(80) for idx in range(3)]
+        digests = [store.put(blob)[0] for blob in blobs]
+        self.assertEqual(
+            3, len([name for name in os.listdir(self.path)
+                    if name.endswith('.pack')]))
+
+        os.remove(os.path.join(self.path, 'index.db'))
+        store = BlobStore(self.path, pack_size=100)
+        store.rebuild_index()
+        for digest, blob in zip(digests, blobs):
+            self.assertEqual(blob, store.get(digest))
+
+    def test_compact(self):
+        """Blobs nothing keeps are dropped and their pack rewritten"""
+        store = BlobStore(self.path, pack_size=100)
+        blobs = [os.urandom(80) for idx in range(3)]
+        digests = [store.put(blob)[0] for blob in blobs]
+
+        # Just stored, the grace period keeps everything.
+        self.assertEqual(0, store.compact(set())['removed'])
+
+        stats = store.compact(set(digests[1:]), grace=-1)
+        self.assertEqual(1, stats['removed'])
+        self.assertEqual(1, stats['packs'])
+        self.assertFalse(
+            os.path.exists(os.path.join(self.path, 'pack-000001.pack')))
+        self.assertNotIn(digests[0], store)
+        for digest, blob in zip(digests[1:], blobs[1:]):
+            self.assertEqual(blob, store.get(digest))
+
+        # The current pack is only ever appended to.
+        stats = store.compact(set(), grace=-1)
+        self.assertEqual(2, stats['removed'])
+        self.assertTrue(
+            os.path.exists(os.path.join(self.path, 'pack-000003.pack')))
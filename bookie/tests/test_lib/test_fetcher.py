@@ -0,0 +1,263 @@
+"""Test the concurrent content fetcher."""
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import TestCase
+
+from bookie.lib.fetcher import ContentFetcher
+from bookie.lib.httpcache import ResponseCache
+from bookie.lib.readable import extract
+
+
+PAGE = b"""<html><head><title>Bookie</title></head><body>
+<div><p>Bookie keeps your bookmarks and the content of the pages they point
+to, so you can search through what you have read later on.</p>
+<p>The fetcher pulls those pages down a few at a time.</p></div>
+</body></html>"""
+
+
+def parse_in_daemon(results):
+    """Parse PAGE on the parse pool of a daemon process, like celery's"""
+    fetcher = ContentFetcher(parse_processes=2)
+    pool = fetcher.parse_pool()
+    try:
+        parsed = pool.submit(extract, PAGE, 'http://bookie.io')
+        child = pool.submit(os.getpid)
+        results.put((os.getpid(), child.result(30), parsed.result(30)))
+    finally:
+        pool.shutdown(wait=True)
+        fetcher.close()
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Serve a page slowly, tracking how many requests are open at once"""
+    active = 0
+    most = 0
+    hits = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = SlowHandler
+        with cls.lock:
+            cls.hits += 1
+            cls.active += 1
+            cls.most = max(cls.most, cls.active)
+        time.sleep(0.05)
+        with cls.lock:
+            cls.active -= 1
+
+        if self.path.startswith('/missing'):
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path.startswith('/disk.iso'):
+            # Claims to be a page but is a big run of zeros.
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            try:
+                for idx in range(64):
+                    self.wfile.write(b'\x00' * 64 * 1024)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            return
+        if self.path.startswith('/etag') and \
+                self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        if self.path.startswith('/etag'):
+            self.send_header('ETag', '"v1"')
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestContentFetcher(TestCase):
+    """Verify the fetcher limits and batches its work"""
+
+    def setUp(self):
+        """Start a local server to fetch from"""
+        SlowHandler.active = SlowHandler.most = SlowHandler.hits = 0
+        self.server = ThreadedServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def tearDown(self):
+        """Stop the local server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_fetch_all(self):
+        """Every url is fetched, a host at a time, and handed on in batches"""
+        urls = [(idx, '{0}/page/{1}'.format(self.url, idx))
+                for idx in range(10)]
+        urls.append((10, self.url + '/missing'))
+        batches = []
+
+        fetcher = ContentFetcher(concurrency=10, per_host=3,
+                                 parse_processes=2)
+        try:
+            count = fetcher.fetch_all(urls, batches.append, batch_size=4)
+        finally:
+            fetcher.close()
+        stats = fetcher.stats()
+
+        self.assertEqual(11, count)
+        self.assertEqual([4, 4, 3], [len(batch) for batch in batches])
+        self.assertTrue(SlowHandler.most <= 3,
+                        "Host limit held: " + str(SlowHandler.most))
+
+        reads = dict(read for batch in batches for read in batch)
+        self.assertEqual(404, reads[10].status)
+        self.assertEqual(200, reads[0].status)
+        self.assertEqual('text/html', reads[0].content_type)
+        self.assertTrue('Bookie' in reads[0].content)
+        self.assertTrue('<' not in reads[0].clean_content)
+        self.assertTrue('search through' in reads[0].clean_content)
+
+        self.assertEqual(11, stats['fetch']['count'])
+        self.assertEqual(1, stats['fetch']['errors'])
+        self.assertEqual(10, stats['parse']['count'])
+        self.assertEqual(10 * len(PAGE), stats['parse']['bytes'])
+
+    def test_handle_runs_alongside(self):
+        """Downloads keep going while a batch is being handled"""
+        urls = [(idx, '{0}/page/{1}'.format(self.url, idx))
+                for idx in range(12)]
+        seen = []
+
+        def handle(batch):
+            if not seen:
+                started = SlowHandler.hits
+                time.sleep(0.5)
+                seen.append(SlowHandler.hits - started)
+            seen.append(len(batch))
+
+        fetcher = ContentFetcher(concurrency=4, per_host=2,
+                                 parse_processes=1)
+        try:
+            self.assertEqual(12, fetcher.fetch_all(urls, handle,
+                                                   batch_size=2))
+        finally:
+            fetcher.close()
+        self.assertTrue(seen[0] > 2, "Fetched while handling: " +
+                        str(seen[0]))
+
+    def test_unchanged(self):
+        """Pages that haven't changed since the last fetch aren't parsed"""
+        fetcher = ContentFetcher()
+        try:
+            first = fetcher.download(self.url + '/etag')
+            self.assertEqual('"v1"', first.etag)
+            self.assertFalse(first.unchanged)
+            self.assertTrue(first.content is not None)
+
+            validators = {'etag': first.etag, 'digest': first.digest}
+            again = fetcher.download(self.url + '/etag',
+                                     validators=validators)
+            self.assertTrue(again.unchanged)
+            self.assertEqual(first.digest, again.digest)
+
+            # No etag to go on, but the content hashes the same.
+            same = fetcher.download(self.url + '/page/1',
+                                    validators={'digest': first.digest})
+            self.assertTrue(same.unchanged)
+            self.assertTrue(same.content is None)
+        finally:
+            fetcher.close()
+        self.assertEqual(1, fetcher.parse_stats.count)
+
+    def test_unfetchable_url(self):
+        """Urls we can't fetch error out without a request"""
+        read = ContentFetcher().download('file://test.html')
+        self.assertEqual(read.status, 901)
+
+    def test_host_down(self):
+        """Once a host fails enough times the rest of its urls are skipped"""
+        # Nothing listens on a port we just gave back.
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        down = 'http://127.0.0.1:{0}'.format(sock.getsockname()[1])
+        sock.close()
+
+        urls = [(idx, '{0}/page/{1}'.format(down, idx)) for idx in range(6)]
+        urls.append((6, self.url + '/page/6'))
+        batches = []
+        fetcher = ContentFetcher(per_host=1, host_failures=2,
+                                 parse_processes=1)
+        try:
+            fetcher.fetch_all(urls, batches.extend)
+        finally:
+            fetcher.close()
+
+        reads = dict(batches)
+        statuses = sorted(reads[idx].status for idx in range(6))
+        self.assertEqual([901, 901, 906, 906, 906, 906], statuses)
+        self.assertEqual(200, reads[6].status)
+        self.assertEqual(3, fetcher.fetch_stats.count)
+
+    def test_daemon_parse_pool(self):
+        """A daemon process, like a celery worker, still parses on a pool"""
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=parse_in_daemon,
+                                         args=(results,))
+        worker.daemon = True
+        worker.start()
+        try:
+            pid, child, parsed = results.get(timeout=60)
+        finally:
+            worker.join(30)
+
+        self.assertEqual(worker.pid, pid)
+        self.assertNotEqual(pid, child)
+        self.assertTrue('search through' in parsed[3])
+
+    def test_not_html(self):
+        """Bodies that aren't html are dropped, big pages are cut off"""
+        fetcher = ContentFetcher(max_bytes=100)
+        try:
+            disk = fetcher.download(self.url + '/disk.iso')
+            page = fetcher.download(self.url + '/page/1')
+        finally:
+            fetcher.close()
+
+        self.assertEqual(200, disk.status)
+        self.assertEqual('application/octet-stream', disk.content_type)
+        self.assertTrue(disk.content is None)
+
+        self.assertTrue(page.truncated)
+        self.assertFalse(disk.truncated)
+
+    def test_cached(self):
+        """A page in the response cache isn't downloaded again"""
+        path = tempfile.mkdtemp()
+        fetcher = ContentFetcher(cache=ResponseCache(path))
+        try:
+            first = fetcher.download(self.url + '/page/1', parse=False)
+            again = fetcher.download(self.url + '/page/1')
+        finally:
+            fetcher.close()
+            shutil.rmtree(path)
+
+        self.assertEqual(1, SlowHandler.hits)
+        self.assertEqual(first.digest, again.digest)
+        self.assertEqual(self.url + '/page/1', again.url)
+        self.assertTrue('Bookie' in again.content)
@@ -0,0 +1,87 @@
+"""Test the on disk response cache for fetched pages."""
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+
+from bookie.lib.httpcache import CachedResponse
+from bookie.lib.httpcache import ResponseCache
+
+
+class TestResponseCache(TestCase):
+    """Verify responses are found by their url or a redirect to it"""
+
+    def setUp(self):
+        """Start each test with an empty cache"""
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the cache"""
+        shutil.rmtree(self.path)
+
+    def _age_bodies(self, seconds):
+        """Make the stored bodies look seconds older than they are"""
+        for folder, dirs, bodies in os.walk(self.path):
+            for body in bodies:
+                body = os.path.join(folder, body)
+                stamp = os.path.getmtime(body) - seconds - 1
+                os.utime(body, (stamp, stamp))
+
+    def test_redirects(self):
+        """A short link and the page it lands on share one response"""
+        cache = ResponseCache(self.path, ttl=60, redirect_ttl=600)
+        cache.put('http://bit.ly/x', CachedResponse(
+            'http://bookie.io/page', content_type='text/html',
+            digest='abc', body=u'<title>Bookie ☃</title>'),
+            now=1000)
+
+        for url in ('http://bit.ly/x', 'http://bookie.io/page'):
+            found = cache.get(url, now=1030)
+            self.assertEqual('http://bookie.io/page', found.url)
+            self.assertEqual(u'<title>Bookie ☃</title>', found.body)
+            self.assertEqual('abc', found.digest)
+
+        # The page goes stale before where the link goes does.
+        self.assertEqual(None, cache.get('http://bit.ly/x', now=1100))
+        self.assertEqual('http://bookie.io/page',
+                         cache.resolve('http://bit.ly/x', now=1100))
+        self.assertEqual('http://other.io',
+                         cache.resolve('http://other.io', now=1100))
+
+    def test_prune(self):
+        """Expired responses and their bodies are cleared out"""
+        cache = ResponseCache(self.path, ttl=60)
+        cache.put('http://bookie.io/a', CachedResponse(
+            'http://bookie.io/a', body=u'a'), now=1000)
+        cache.put('http://bookie.io/b', CachedResponse(
+            'http://bookie.io/b', body=u'b'), now=1050)
+        cache.put('http://bookie.io/iso', CachedResponse(
+            'http://bookie.io/iso', content_type='application/x-iso9660'),
+            now=1050)
+
+        self._age_bodies(cache.body_grace)
+        self.assertEqual(1, cache.prune(now=1070))
+        self.assertEqual(None, cache.get('http://bookie.io/a', now=1070))
+        self.assertEqual(u'b', cache.get('http://bookie.io/b', now=1070).body)
+        # Not html, so there's no body but we know not to fetch it again.
+        iso = cache.get('http://bookie.io/iso', now=1070)
+        self.assertEqual(None, iso.body)
+        bodies = [body for folder, dirs, bodies in os.walk(self.path)
+                  for body in bodies if body.endswith('.z')]
+        self.assertEqual(1, len(bodies))
+
+    def test_prune_during_put(self):
+        """A body written just before its row is left for the put"""
+        cache = ResponseCache(self.path, ttl=60)
+        key = cache._write_body(u'page')
+        self.assertEqual(0, cache.prune(now=1000))
+        self.assertTrue(os.path.exists(cache._body_path(key)))
+
+        # Storing it again starts its grace period over.
+        self._age_bodies(cache.body_grace)
+        self.assertEqual(key, cache._write_body(u'page'))
+        self.assertEqual(0, cache.prune(now=1000))
+
+        self._age_bodies(cache.body_grace)
+        self.assertEqual(1, cache.prune(now=1000))
@@ -0,0 +1,170 @@
+"""Test the queue of urls waiting on the content fetch workers"""
+from datetime import datetime
+from datetime import timedelta
+
+from bookie.models import DBSession
+from bookie.models.queue import (
+    FETCH_FAILED,
+    FETCH_INTERACTIVE,
+    FETCH_PENDING,
+    FetchQueue,
+    FetchQueueMgr,
+    HostHealth,
+    HostHealthMgr,
+)
+
+from bookie.tests import gen_random_word
+from bookie.tests import TestDBBase
+
+
+class TestFetchQueue(TestDBBase):
+    """Urls are leased out once and backed off by status"""
+
+    def _queue(self, count, username=None, **kwargs):
+        hash_ids = [gen_random_word(22) for idx in range(count)]
+        self.assertEqual(sorted(hash_ids), sorted(
+            FetchQueueMgr.enqueue(hash_ids, username, **kwargs)))
+        DBSession.flush()
+        return hash_ids
+
+    def test_enqueue_once(self):
+        """A url already in the queue isn't added again"""
+        hash_ids = self._queue(2)
+        self.assertEqual([], FetchQueueMgr.enqueue(hash_ids))
+
+    def test_claim_lease(self):
+        """Leased urls go to one owner until the lease runs out"""
+        hash_ids = self._queue(3)
+
+        first = FetchQueueMgr.claim('first', limit=2, lease=60)
+        self.assertEqual(2, len(first))
+        second = FetchQueueMgr.claim('second', limit=2, lease=60)
+        self.assertEqual(list(set(hash_ids) - set(first)), second)
+        self.assertEqual([], FetchQueueMgr.claim('third', limit=2))
+
+        later = datetime.utcnow() + timedelta(seconds=61)
+        retaken = FetchQueueMgr.claim('fourth', limit=5, now=later)
+        self.assertEqual(sorted(hash_ids), sorted(retaken))
+
+        FetchQueueMgr.complete(retaken, 'fourth')
+        self.assertEqual(0, FetchQueue.query.count())
+
+    def test_backoff(self):
+        """Transient errors are retried later, others give up"""
+        throttled, missing = self._queue(2)
+        FetchQueueMgr.claim('owner')
+
+        now = datetime.utcnow()
+        self.assertTrue(FetchQueueMgr.fail(throttled, 429, 'owner', now=now))
+        self.assertFalse(FetchQueueMgr.fail(missing, 404, 'owner', now=now))
+        DBSession.flush()
+
+        retry = FetchQueue.query.get(throttled)
+        self.assertEqual(FETCH_PENDING, retry.state)
+        self.assertEqual(now + timedelta(minutes=15), retry.next_attempt)
+        self.assertEqual(FETCH_FAILED, FetchQueue.query.get(missing).state)
+
+        # Not ready until the backoff is up.
+        self.assertEqual([], FetchQueueMgr.claim('again'))
+        self.assertEqual([throttled], FetchQueueMgr.claim(
+            'again', now=now + timedelta(minutes=16)))
+
+        # A url we gave up on stays parked until it's queued again.
+        self.assertEqual([missing], FetchQueueMgr.enqueue([missing]))
+        DBSession.flush()
+        DBSession.expire_all()
+        parked = FetchQueue.query.get(missing)
+        self.assertEqual(FETCH_PENDING, parked.state)
+        self.assertEqual(0, parked.attempts)
+
+    def test_renew(self):
+        """Renewing a lease keeps the urls from being claimed by others"""
+        hash_ids = self._queue(2)
+        now = datetime.utcnow()
+        FetchQueueMgr.claim('first', lease=60, now=now)
+        FetchQueueMgr.complete(hash_ids[:1], 'first')
+
+        later = now + timedelta(seconds=50)
+        FetchQueueMgr.renew('first', lease=60, now=later)
+        self.assertEqual([], FetchQueueMgr.claim(
+            'second', now=now + timedelta(seconds=90)))
+        self.assertEqual(hash_ids[1:], FetchQueueMgr.claim(
+            'second', now=now + timedelta(seconds=111)))
+
+    def test_shares(self):
+        """Each user gets their weight of the batch in turn"""
+        backlog = [('big', 1000), ('small', 2), ('paid', 1000)]
+        self.assertEqual(
+            [('big', 4), ('small', 2), ('paid', 4)],
+            FetchQueueMgr.shares(backlog, 10))
+        self.assertEqual(
+            [('big', 2), ('small', 2), ('paid', 6)],
+            FetchQueueMgr.shares(backlog, 10, weights={'paid': 3}))
+
+    def test_interactive_first(self):
+        """Saved bookmarks jump the imports, and bulk is shared out"""
+        now = datetime.utcnow()
+        earlier = now - timedelta(hours=1)
+        imported = self._queue(20, u'importer', now=earlier)
+        other = self._queue(2, u'other', now=now)
+        saved = self._queue(1, u'saver', lane=FETCH_INTERACTIVE, now=now)
+
+        # Moving a bulk url up counts as queueing it.
+        self.assertEqual(
+            [imported[0]],
+            FetchQueueMgr.enqueue([imported[0]], u'saver',
+                                  lane=FETCH_INTERACTIVE, now=now))
+        DBSession.flush()
+
+        claimed = FetchQueueMgr.claim('owner', limit=6, now=now)
+        self.assertEqual(6, len(claimed))
+        self.assertTrue(set(saved + [imported[0]]) <= set(claimed))
+        self.assertTrue(set(other) <= set(claimed))
+
+        backlog = dict(((item['username'], item['lane']), item)
+                       for item in FetchQueueMgr.backlog(now=now))
+        self.assertEqual(17, backlog[(u'importer', 'bulk')]['pending'])
+        self.assertEqual(2, backlog[(u'importer', 'bulk')]['leased'])
+        self.assertEqual(3600,
+                         backlog[(u'importer', 'bulk')]['oldest_wait'])
+        self.assertEqual(2, backlog[(u'saver', 'interactive')]['leased'])
+
+
+class TestHostHealth(TestDBBase):
+    """Hosts that keep failing are put off and probed"""
+
+    def test_circuit(self):
+        """The circuit opens, lets one probe through, and closes again"""
+        now = datetime.utcnow()
+        HostHealthMgr.record([(u'down.com', 902)] * 4 + [(u'up.com', None)],
+                             now=now, failures=5, cooldown=60)
+        DBSession.flush()
+        self.assertEqual(({}, set()),
+                         HostHealthMgr.check([u'down.com', u'up.com'], now))
+        self.assertEqual(None, HostHealth.query.get(u'up.com'))
+
+        HostHealthMgr.record([(u'down.com', 902)], now=now, failures=5,
+                             cooldown=60)
+        DBSession.flush()
+        blocked, probes = HostHealthMgr.check([u'down.com'], now)
+        self.assertEqual({u'down.com': now + timedelta(seconds=60)}, blocked)
+        self.assertEqual(set(), probes)
+
+        # Only the first to ask once the cooldown is up gets to probe.
+        later = now + timedelta(seconds=61)
+        blocked, probes = HostHealthMgr.check([u'down.com'], later)
+        self.assertEqual(set([u'down.com']), probes)
+        self.assertEqual(set(), HostHealthMgr.check([u'down.com'], later)[1])
+
+        # A failed probe doubles the cooldown, one that works closes it.
+        HostHealthMgr.record([(u'down.com', 902)], probes=probes, now=later,
+                             failures=5, cooldown=60)
+        DBSession.flush()
+        health = HostHealth.query.get(u'down.com')
+        self.assertEqual(120, health.cooldown)
+        self.assertEqual(later + timedelta(seconds=120), health.open_until)
+
+        HostHealthMgr.record([(u'down.com', None)], probes=probes, now=later)
+        DBSession.flush()
+        self.assertEqual(0, health.failures)
+        self.assertEqual(None, health.open_until)
@@ -0,0 +1,194 @@
+"""Test the readable content shared by the bookmarks of a url"""
+import shutil
+import tempfile
+
+from datetime import datetime
+from datetime import timedelta
+from mock import patch
+
+from bookie.lib.blobstore import set_store
+
+from bookie.models import (
+    Bmark,
+    DBSession,
+    Readable,
+    ReadableMgr,
+    TagMgr,
+    TagSuggestion,
+)
+from bookie.models.auth import User
+
+from bookie.tests import gen_random_word
+from bookie.tests import TestDBBase
+
+
+class TestReadable(TestDBBase):
+    """Readable content is stored once per url"""
+
+    def _bmark(self, url):
+        user = User()
+        user.username = gen_random_word(10)
+        DBSession.add(user)
+        bmark = Bmark(url=url, username=user.username)
+        DBSession.add(bmark)
+        DBSession.flush()
+        return bmark
+
+    def test_shared_by_url(self):
+        """A second bookmark of a url sees the content already there"""
+        url = 'http://' + gen_random_word(12) + '.com'
+        first = self._bmark(url)
+        first.readable = Readable(content=u'<p>Shared page</p>')
+        DBSession.flush()
+
+        second = self._bmark(url)
+        self.assertEqual(first.hash_id, second.hash_id)
+        self.assertEqual(u'<p>Shared page</p>', second.readable.content)
+        self.assertEqual(1, Readable.query.filter(
+            Readable.hash_id == first.hash_id).count())
+
+        # Removing one bookmark leaves the content for the other.
+        DBSession.delete(first)
+        DBSession.flush()
+        self.assertEqual(1, Readable.query.filter(
+            Readable.hash_id == second.hash_id).count())
+
+    def test_fetched(self):
+        """Only urls with content count as fetched"""
+        fetched = self._bmark('http://' + gen_random_word(12) + '.com')
+        fetched.readable = Readable(content=u'<p>Already here</p>')
+        fresh = self._bmark('http://' + gen_random_word(12) + '.com')
+        DBSession.flush()
+
+        self.assertEqual(
+            set([fetched.hash_id]),
+            ReadableMgr.fetched([fetched.hash_id, fresh.hash_id]))
+
+    def test_blob_store(self):
+        """With a blob store the row only keeps the digest and length"""
+        path = tempfile.mkdtemp()
+        set_store(path)
+        try:
+            bmark = self._bmark('http://' + gen_random_word(12) + '.com')
+            bmark.readable = Readable(content=u'<p>Packed page</p>')
+            DBSession.flush()
+
+            readable = bmark.readable
+            self.assertEqual(None, readable._content)
+            self.assertEqual(len(u'<p>Packed page</p>'),
+                             readable.content_length)
+            self.assertEqual(u'<p>Packed page</p>', readable.content)
+            self.assertTrue(readable.clean_digest is not None)
+        finally:
+            set_store(None)
+            shutil.rmtree(path)
+
+    def test_blob_missing(self):
+        """The api dict leaves out content the blob store lost"""
+        path = tempfile.mkdtemp()
+        set_store(path)
+        try:
+            bmark = self._bmark('http://' + gen_random_word(12) + '.com')
+            bmark.readable = Readable(content=u'<p>Lost page</p>')
+            DBSession.flush()
+
+            DBSession.expunge(bmark.readable)
+            shutil.rmtree(path)
+            set_store(path)
+            readable = dict(Readable.query.get(bmark.hash_id))
+            self.assertEqual(None, readable['content'])
+            self.assertEqual(bmark.hash_id, readable['hash_id'])
+            self.assertNotIn('content_digest', readable)
+            self.assertNotIn('clean_length', readable)
+        finally:
+            set_store(None)
+            shutil.rmtree(path)
+
+    def test_tag_suggestions(self):
+        """Suggestions are read back best first and go with the content"""
+        bmark = self._bmark('http://' + gen_random_word(12) + '.com')
+        bmark.tags = TagMgr.from_string(u'python')
+        bmark.readable = Readable(content=u'<p>Python web frameworks</p>')
+        DBSession.flush()
+        self.assertEqual([bmark.hash_id], ReadableMgr.unsuggested())
+
+        TagMgr.set_suggestions(bmark.readable, [
+            (u'web', 3), (u'python', 5), (u'frameworks', 3)])
+        DBSession.flush()
+        self.assertEqual([], ReadableMgr.unsuggested())
+        self.assertEqual(
+            [u'frameworks', u'web'],
+            TagMgr.suggestions(bmark=bmark, url=bmark.hashed.url))
+
+        # New content leaves the old suggestions to be worked out again.
+        bmark.readable.content = u'<p>Something else</p>'
+        DBSession.flush()
+        DBSession.expire(bmark.readable)
+        self.assertEqual(0, TagSuggestion.query.filter(
+            TagSuggestion.hash_id == bmark.hash_id).count())
+        self.assertEqual([bmark.hash_id], ReadableMgr.unsuggested())
+
+    def test_schedule(self):
+        """The refresh interval halves on a change and doubles without one"""
+        now = datetime(2014, 1, 1)
+        day = 24 * 60 * 60
+        readable = Readable()
+
+        # The first fetch starts at the default interval.
+        ReadableMgr.schedule(readable, True, now=now)
+        self.assertEqual(ReadableMgr.REFRESH_START, readable.refresh_interval)
+        self.assertEqual(now, readable.fetched)
+        self.assertEqual(now + timedelta(seconds=ReadableMgr.REFRESH_START),
+                         readable.next_fetch)
+
+        ReadableMgr.schedule(readable, False, now=now)
+        self.assertEqual(ReadableMgr.REFRESH_START * 2,
+                         readable.refresh_interval)
+        ReadableMgr.schedule(readable, True, now=now)
+        self.assertEqual(ReadableMgr.REFRESH_START,
+                         readable.refresh_interval)
+
+        # It stays within the bounds given.
+        ReadableMgr.schedule(readable, False, now=now, high=10 * day)
+        self.assertEqual(10 * day, readable.refresh_interval)
+        ReadableMgr.schedule(readable, True, now=now, low=8 * day)
+        self.assertEqual(8 * day, readable.refresh_interval)
+
+    def test_due(self):
+        """Fetched urls come up for a refresh once their time is up"""
+        now = datetime.utcnow()
+        overdue = self._bmark('http://' + gen_random_word(12) + '.com')
+        overdue.readable = Readable(content=u'<p>Old page</p>')
+        overdue.readable.next_fetch = now - timedelta(days=2)
+        waiting = self._bmark('http://' + gen_random_word(12) + '.com')
+        waiting.readable = Readable(content=u'<p>New page</p>')
+        waiting.readable.next_fetch = now + timedelta(days=2)
+        unscheduled = self._bmark('http://' + gen_random_word(12) + '.com')
+        unscheduled.readable = Readable(content=u'<p>Some page</p>')
+        DBSession.flush()
+
+        due = ReadableMgr.due(now=now)
+        self.assertEqual(2, len(due))
+        self.assertTrue(overdue.hash_id in due)
+        self.assertTrue(unscheduled.hash_id in due)
+        self.assertEqual(1, len(ReadableMgr.due(limit=1, now=now)))
+
+    @patch('bookie.models.fulltext.get_fulltext_handler')
+    def test_unchanged_not_indexed(self, mock_handler):
+        """Only new content is sent to the fulltext index"""
+        bmark = self._bmark('http://' + gen_random_word(12) + '.com')
+        bmark.readable = Readable(content=u'<p>Indexed page</p>')
+        DBSession.flush()
+        index_content = mock_handler.return_value.index_content
+        self.assertEqual(1, index_content.call_count)
+
+        # A refresh that found the page unchanged only touches the
+        # validators and the schedule.
+        bmark.readable.etag = u'"v2"'
+        ReadableMgr.schedule(bmark.readable, False)
+        DBSession.flush()
+        self.assertEqual(1, index_content.call_count)
+
+        bmark.readable.content = u'<p>Changed page</p>'
+        DBSession.flush()
+        self.assertEqual(2, index_content.call_count)
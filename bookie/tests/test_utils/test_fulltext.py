@@ -1,13 +1,28 @@
 """Test the fulltext implementation"""
 import json
+import multiprocessing
+import os
+import shutil
+import tempfile
 import transaction
 
+from datetime import datetime
+from mock import patch
 from pyramid import testing
 from unittest import TestCase
 
 from bookie.models import DBSession
+from bookie.models.fulltext import _diff_sorted
+from bookie.models.fulltext import _rebuild_journal
+from bookie.models.fulltext import _reset_index
+from bookie.models.fulltext import _sql_privacy
+from bookie.models.fulltext import IndexWriter
+from bookie.models.fulltext import SearchCache
+from bookie.models.fulltext import search_timeout
+from bookie.models.fulltext import SqliteFulltext
 from bookie.models.fulltext import WhooshFulltext
 from bookie.models.fulltext import get_fulltext_handler
+from bookie.models.queue import FulltextQueueMgr
 from bookie.tests import empty_db
 
 API_KEY = None
@@ -72,6 +87,374 @@ class TestFulltext(TestCase):
             isinstance(handler, WhooshFulltext),
             "Should get a whoosh fulltext by default")
 
+    def test_writer_drains_queue(self):
+        """Saved bookmarks wait in the queue until the index writer runs"""
+        prms = {
+            'url': 'http://google.com',
+            'description': 'This is my google desc SEE',
+            'tags': 'python search',
+            'api_key': API_KEY,
+            'username': 'admin',
+        }
+        self.testapp.post(
+            '/api/v1/admin/bmark?',
+            content_type='application/json',
+            params=json.dumps(prms),
+        )
+        transaction.commit()
+
+        handler = get_fulltext_handler("")
+        self.assertTrue(
+            FulltextQueueMgr.size() > 0,
+            "The new bookmark should be queued for the writer")
+        self.assertEqual(0, handler.doc_count())
+
+        IndexWriter().drain()
+        self.assertEqual(0, FulltextQueueMgr.size())
+        self.assertEqual(1, handler.doc_count())
+
+    def test_writer_journals_during_rebuild(self):
+        """A running rebuild hears about everything the writer indexes"""
+        journal = _rebuild_journal()
+        open(journal, 'w').close()
+        try:
+            self._get_good_request()
+            with open(journal) as handle:
+                bids = handle.read().split()
+        finally:
+            os.remove(journal)
+
+        self.assertEqual(1, len(set(bids)))
+        self.assertEqual(1, get_fulltext_handler("").doc_count())
+
+    def test_rebuild_swaps_in(self):
+        """A rebuild swaps in a new index and catches up on its writes"""
+        from bookie.models import fulltext
+        self._get_good_request()
+        self.testapp.post(
+            '/api/v1/admin/bmark?',
+            content_type='application/json',
+            params=json.dumps({
+                'url': 'http://google.com/maps',
+                'description': 'google maps',
+                'tags': 'search maps',
+                'api_key': API_KEY,
+                'username': 'admin',
+            }),
+        )
+        transaction.commit()
+
+        # The writer indexes an edit once the rebuild has read the range
+        # of bookmarks to build, which is when it lets go of its session.
+        remove = DBSession.remove
+        edited = []
+
+        def edit_during_rebuild():
+            if not edited:
+                edited.append(True)
+                self._get_good_request(new_tags='python search rebuilt')
+            remove()
+
+        live = os.path.realpath(fulltext.INDEX_NAME)
+        try:
+            with patch.object(DBSession, 'remove', edit_during_rebuild):
+                total = fulltext.rebuild_index(processes=2, chunk=1)
+
+            self.assertEqual(2, total)
+            self.assertTrue(os.path.islink(fulltext.INDEX_NAME))
+            self.assertNotEqual(live, fulltext.INDEX_PATH)
+            # The old directory was moved aside and removed.
+            self.assertFalse(os.path.exists(live + '-original'))
+            self.assertFalse(os.path.exists(_rebuild_journal()))
+
+            handler = get_fulltext_handler("")
+            self.assertEqual(2, handler.doc_count())
+            self.assertEqual(2, len(handler.search('google')))
+
+            # What the writer indexed during the rebuild is queued again.
+            self.assertTrue(FulltextQueueMgr.size() > 0)
+            IndexWriter().drain()
+            self.assertEqual(1, len(handler.search('rebuilt')))
+        finally:
+            # Put a plain directory back for the rest of the tests.
+            if os.path.islink(fulltext.INDEX_NAME):
+                built = os.path.realpath(fulltext.INDEX_NAME)
+                os.remove(fulltext.INDEX_NAME)
+                os.rename(built, fulltext.INDEX_NAME)
+            fulltext._follow_swap()
+
+    def test_reconcile_missing(self):
+        """Reconcile only queues the bookmarks the index doesn't have"""
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+
+        stats = handler.reconcile()
+        transaction.commit()
+        self.assertEqual(1, stats['checked'])
+        self.assertEqual(0, stats['queued'])
+
+        _reset_index()
+        stats = handler.reconcile()
+        transaction.commit()
+        self.assertEqual(1, stats['missing'])
+        self.assertEqual(1, stats['queued'])
+        self.assertEqual(1, FulltextQueueMgr.size())
+
+        # Running again doesn't queue it twice.
+        stats = handler.reconcile()
+        transaction.commit()
+        self.assertEqual(0, stats['queued'])
+
+    def test_reconcile_orphans(self):
+        """Bookmarks gone from the database are queued for delete once"""
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+
+        # A bulk delete skips the mapper event that queues it for us.
+        from bookie.models import Bmark
+        from bookie.models import bmarks_tags
+        DBSession.execute(bmarks_tags.delete())
+        Bmark.query.delete()
+        transaction.commit()
+
+        for idx in range(2):
+            stats = handler.reconcile()
+            transaction.commit()
+            self.assertEqual(1, stats['orphaned'])
+        self.assertEqual(1, FulltextQueueMgr.size())
+
+        IndexWriter().drain()
+        self.assertEqual(0, handler.doc_count())
+
+    def test_reconcile_old_schema(self):
+        """An index without the updated stamps doesn't requeue everything"""
+        from bookie.models import fulltext
+        from whoosh.index import create_in
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+        handler.reconcile()
+        transaction.commit()
+        from bookie.models import Bmark
+        doc = handler.findByID(Bmark.query.one().bid)
+        Bmark.query.update({'updated': datetime.utcnow()})
+        transaction.commit()
+
+        path = tempfile.mkdtemp()
+        try:
+            schema = fulltext.BmarkSchema()
+            schema.remove('updated')
+            old = create_in(path, schema, indexname=fulltext.META_INDEX)
+            writer = old.writer()
+            writer.add_document(**dict(
+                (k, v) for k, v in doc.items() if k in schema))
+            writer.commit()
+            fulltext._open_index(path)
+
+            with patch.object(fulltext, 'INDEX_NAME', path):
+                stats = handler.reconcile()
+            transaction.commit()
+            self.assertEqual(0, stats['stale'])
+            self.assertEqual(0, stats['queued'])
+        finally:
+            fulltext._open_index(os.path.realpath(fulltext.INDEX_NAME))
+            shutil.rmtree(path)
+
+    def test_rebuild_reasons(self):
+        """An index from before the split is reported as needing a rebuild"""
+        from bookie.models import fulltext
+        from whoosh.index import create_in
+        self.assertEqual([], fulltext.rebuild_reasons())
+
+        path = tempfile.mkdtemp()
+        try:
+            schema = fulltext.BmarkSchema()
+            schema.remove('updated')
+            old = create_in(path, schema, indexname=fulltext.META_INDEX)
+            writer = old.writer()
+            writer.add_document(bid=u'1', description=u'Old index')
+            writer.commit()
+            with patch.object(fulltext.LOG, 'warning') as warning:
+                fulltext._open_index(path)
+
+            reasons = fulltext.rebuild_reasons()
+            self.assertEqual(2, len(reasons))
+            self.assertTrue('updated' in reasons[0], reasons)
+            self.assertTrue('content and suggest' in reasons[1], reasons)
+            self.assertEqual(1, warning.call_count)
+        finally:
+            fulltext._open_index(os.path.realpath(fulltext.INDEX_NAME))
+            shutil.rmtree(path)
+
+    def test_diff_sorted(self):
+        """The two sorted streams are compared side by side"""
+        diff = list(_diff_sorted(['1', '10', '3'], ['10', '2', '3']))
+        self.assertEqual(
+            [('1', True, False), ('10', True, True), ('2', False, True),
+             ('3', True, True)],
+            diff)
+
+    def test_delete_removes_document(self):
+        """Removed bookmarks come back out of the index"""
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+        self.assertEqual(1, handler.doc_count())
+
+        from bookie.models import BmarkMgr
+        BmarkMgr.delete_all_bookmarks('admin')
+        transaction.commit()
+        IndexWriter().drain()
+
+        self.assertEqual(0, handler.doc_count())
+        self.assertEqual(0, len(handler.search('google')))
+
+    def test_optimize_thresholds(self):
+        """Optimize is only queued once the index is fragmented"""
+        handler = get_fulltext_handler("")
+        self._get_good_request()
+        self._get_good_request(new_tags='python search edit')
+
+        stats = handler.optimize(segments=100, deleted_ratio=1.0)
+        self.assertFalse(stats['optimize'])
+        self.assertEqual(0, FulltextQueueMgr.size())
+
+        stats = handler.optimize(segments=1, deleted_ratio=1.0)
+        transaction.commit()
+        self.assertTrue(stats['optimize'])
+        IndexWriter().drain()
+        self.assertEqual(1, handler.index_stats()['segments'])
+        self.assertEqual(0, handler.index_stats()['deleted'])
+
+    def test_content_index(self):
+        """Page content is only searched when asked for"""
+        from bookie.models import Bmark
+        self._get_good_request()
+        bmark = Bmark.query.first()
+        FulltextQueueMgr.enqueue(bmark.bid, content='zebra stripes')
+        transaction.commit()
+        IndexWriter().drain()
+
+        handler = get_fulltext_handler("")
+        self.assertEqual(0, len(handler.search('zebra')))
+        found = handler.search('zebra', content=True)
+        self.assertEqual(1, found.total)
+        # Both searches hand back the same bookmark with its score updated.
+        score = found[0].score
+
+        # Matching both the metadata and the content adds up the scores.
+        both = handler.search('google zebra', content=True)
+        self.assertEqual(1, both.total)
+        self.assertTrue(both[0].score > score)
+
+    def test_visibility_filters(self):
+        """Private bookmarks are filtered out with cached bitsets"""
+        from bookie.models import fulltext
+        self._get_good_request(is_private=True)
+        handler = get_fulltext_handler("")
+
+        # Nothing is public, which mustn't read as nothing being filtered.
+        self.assertEqual(0, len(handler.search('google')))
+        self.assertEqual(0, len(handler.search('google', content=True)))
+        self.assertEqual([], handler.suggest('goo'))
+        self.assertEqual(0, len(handler.search('google', username='admin')))
+        self.assertEqual(1, len(handler.search(
+            'google', username='admin', requested_by='admin')))
+
+        filters = fulltext.SEARCHERS.filters
+        self.assertEqual(
+            set(['public', 'user:admin']), set(filters._sets.keys()))
+
+    def test_search_timeout(self):
+        """Searches get the timeout for their route"""
+        settings = {
+            'fulltext.search_timeout': '2',
+            'fulltext.search_timeout.api_bmark_search': '0.5',
+            'fulltext.search_timeout.search_results_rest': '0',
+        }
+        self.assertEqual(2.0, search_timeout(settings, 'search_results'))
+        self.assertEqual(0.5, search_timeout(settings, 'api_bmark_search'))
+        self.assertEqual(
+            None, search_timeout(settings, 'search_results_rest'))
+        self.assertEqual(None, search_timeout({}, 'api_bmark_search'))
+
+        self._get_good_request()
+        res = get_fulltext_handler("").search('google', timeout=2.0)
+        self.assertEqual(1, len(res))
+        self.assertFalse(res.truncated)
+
+    def test_suggest(self):
+        """Partly typed words find bookmarks by their prefix"""
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+
+        found = handler.suggest('goo')
+        self.assertEqual(1, len(found))
+        self.assertEqual('This is my google desc SEE', found[0]['description'])
+        self.assertEqual(1, len(handler.suggest('pyth goo')))
+        self.assertEqual(0, len(handler.suggest('pyth zebra')))
+        # Single letters are too short to look up.
+        self.assertEqual([], handler.suggest('g'))
+
+        # The second time around it comes from the cache.
+        from bookie.models import fulltext
+        hits = fulltext.SUGGEST_CACHE.stats()['hits']
+        handler.suggest('goo')
+        self.assertEqual(hits + 1, fulltext.SUGGEST_CACHE.stats()['hits'])
+
+    def test_suggest_api(self):
+        """The suggest api returns the matching descriptions"""
+        self._get_good_request()
+        res = self.testapp.get('/api/v1/bmarks/suggest',
+                               params={'search': 'desc'},
+                               status=200)
+        data = json.loads(res.unicode_body)
+        self.assertEqual(1, len(data['suggestions']))
+        self.assertEqual('http://google.com', data['suggestions'][0]['url'])
+
+        for count in ('0', 'ten'):
+            self.testapp.get('/api/v1/bmarks/suggest',
+                             params={'search': 'desc', 'count': count},
+                             status=400)
+
+    def test_tag_facets(self):
+        """Searches count the tags of all their hits"""
+        self._get_good_request()
+        prms = {
+            'url': 'http://google.com/maps',
+            'description': 'google maps',
+            'tags': 'search maps',
+            'api_key': API_KEY,
+            'username': 'admin',
+        }
+        self.testapp.post(
+            '/api/v1/admin/bmark?',
+            content_type='application/json',
+            params=json.dumps(prms),
+        )
+        transaction.commit()
+        IndexWriter().drain()
+
+        res = get_fulltext_handler("").search('google', ct=1)
+        self.assertEqual(1, len(res))
+        self.assertEqual(
+            [{'name': 'search', 'count': 2},
+             {'name': 'maps', 'count': 1},
+             {'name': 'python', 'count': 1}],
+            res.facets)
+
+    def test_searcher_refresh(self):
+        """The shared searcher only refreshes when the index changes"""
+        handler = get_fulltext_handler("")
+        handler.doc_count()
+        before = handler.stats()
+
+        handler.doc_count()
+        self.assertEqual(before['refreshed'], handler.stats()['refreshed'])
+
+        self._get_good_request()
+        self.assertEqual(1, handler.doc_count())
+        self.assertEqual(
+            before['refreshed'] + 1, handler.stats()['refreshed'])
+
     def test_sqlite_save(self):
         """Verify that if we store a bookmark we get the fulltext storage"""
         # first let's add a bookmark we can search on
@@ -105,6 +488,61 @@ class TestFulltext(TestCase):
             "Extended search should find our description on the page: " +
             search_res.unicode_body)
 
+    def test_search_from_index_fields(self):
+        """Results can be served from the fields stored in the index"""
+        self._get_good_request()
+
+        search_res = self.testapp.get(
+            '/api/v1/admin/bmarks/search/google?hydrate=false')
+        data = json.loads(search_res.unicode_body)
+
+        self.assertEqual(1, data['total_count'])
+        hit = data['search_results'][0]
+        self.assertEqual('http://google.com', hit['url'])
+        self.assertEqual('This is my google desc SEE', hit['description'])
+        self.assertIn({'name': 'python'}, hit['tags'])
+        self.assertTrue(hit['score'] > 0, "Hits should keep their score")
+
+    def test_search_cache(self):
+        """Repeat searches are cached until the index changes"""
+        self._get_good_request()
+        handler = get_fulltext_handler("")
+
+        handler.search('google')
+        before = handler.cache_stats()
+        res = handler.search('  google ')
+        after = handler.cache_stats()
+        self.assertEqual(before['hits'] + 1, after['hits'])
+        self.assertEqual(1, res.total)
+
+        # A new bookmark means a new index version and a fresh search.
+        self._get_good_request(new_tags="google books")
+        handler.search('google')
+        self.assertEqual(after['misses'] + 1, handler.cache_stats()['misses'])
+
+    def test_shared_cache_versions(self):
+        """Processes on other index versions don't wipe the shared cache"""
+        path = os.path.join(tempfile.mkdtemp(), 'search.db')
+        try:
+            older = SearchCache(10, path=path)
+            newer = SearchCache(10, path=path)
+            older.set('google', 'v1', ['older'])
+            newer.set('google', 'v2', ['newer'])
+
+            # A forked process opens its own connection to share with.
+            child = multiprocessing.get_context('fork').Process(
+                target=older.set, args=('python', 'v1', ['forked']))
+            child.start()
+            child.join()
+            self.assertEqual(0, child.exitcode)
+
+            fresh = SearchCache(10, path=path)
+            self.assertEqual(['older'], fresh.get('google', 'v1'))
+            self.assertEqual(['newer'], fresh.get('google', 'v2'))
+            self.assertEqual(['forked'], fresh.get('python', 'v1'))
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
     def test_sqlite_update(self):
         """Verify that if we update a bookmark, fulltext is updated
 
@@ -158,3 +596,31 @@ class TestFulltext(TestCase):
         self.assertTrue(
             'message' in search_res.unicode_body,
             "We should see a message bit in the json: " + search_res.unicode_body)
+
+
+class TestSqlFulltext(TestCase):
+    """Verify the sql engines build their searches safely"""
+
+    def test_sqlite_match(self):
+        """Terms are quoted and limited to the metadata without content"""
+        match, params, parts = SqliteFulltext()._match(
+            ['google', 'say"hi'], False)
+        self.assertEqual('bmarks_fts MATCH :match', match)
+        self.assertEqual(
+            '{description extended tags} : ("google" OR "say""hi")',
+            params['match'])
+
+        match, params, parts = SqliteFulltext()._match(['google'], True)
+        self.assertEqual('"google"', params['match'])
+
+    def test_privacy(self):
+        """Only the owner gets to search their private bookmarks"""
+        clause, params = _sql_privacy(None, None)
+        self.assertEqual('is_private = :public', clause)
+
+        clause, params = _sql_privacy('admin', 'admin')
+        self.assertIn('OR username = :username', clause)
+
+        clause, params = _sql_privacy('admin', 'someone')
+        self.assertIn('AND username = :username', clause)
+        self.assertEqual('admin', params['username'])
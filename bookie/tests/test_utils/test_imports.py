@@ -1,6 +1,8 @@
 """Test that we're meeting delicious API specifications"""
 import logging
 import os
+import shutil
+import tempfile
 import transaction
 import unittest
 
@@ -553,6 +555,17 @@ class ImportFirefoxTest(TestImports):
 class ImportViews(TestViewBase):
     """Test the web import"""
 
+    def setUp(self):
+        """Store the uploads somewhere we can clean up after"""
+        super(ImportViews, self).setUp()
+        self.import_dir = tempfile.mkdtemp()
+        self.app.app.registry.settings['import_files'] = self.import_dir
+
+    def tearDown(self):
+        """Remove the uploaded files"""
+        shutil.rmtree(self.import_dir)
+        super(ImportViews, self).tearDown()
+
     def _upload(self):
         """Make an upload to the importer"""
         loc = os.path.dirname(__file__)
@@ -6,6 +6,8 @@ from mock import patch
 from pyramid import testing
 from unittest import TestCase
 
+from bookie.models.fulltext import SearchResults
+
 
 class TestSearchAttr(TestCase):
 
@@ -17,7 +19,7 @@ class TestSearchAttr(TestCase):
 
         """
         self.attr = [args, kwargs]
-        return []
+        return SearchResults([], 0)
 
     def setUp(self):
         from pyramid.paster import get_app
@@ -1,6 +1,10 @@
 from unittest import TestCase
 
+from mock import patch
+
+from bookie.lib.utils import set_suggest_cache
 from bookie.lib.utils import suggest_tags
+from bookie.lib.utils import suggest_tags_batch
 
 
 class TestSuggestTags(TestCase):
@@ -31,3 +35,43 @@ class TestSuggestTags(TestCase):
         self.assertEqual(
             set(['cars', 'autonomous']),
             suggest_tags(test_value))
+
+    def test_suggestions_cached(self):
+        """Suggestions are remembered, callers get their own copy"""
+        test_value = 'google drives autonomous cars'
+        cache = set_suggest_cache(10)
+        try:
+            first = suggest_tags(test_value)
+            first.add('changed')
+            self.assertEqual(1, len(cache))
+            self.assertEqual(set(['cars', 'autonomous']),
+                             suggest_tags(test_value))
+        finally:
+            set_suggest_cache()
+
+    def test_batch(self):
+        """Many titles at once come back in order"""
+        titles = ['google drives autonomous cars', None,
+                  'http://google.com/drives/autonomous/cars',
+                  'google drives autonomous cars']
+        self.assertEqual(
+            [set(['cars', 'autonomous']), set(),
+             set(['cars', 'autonomous']), set(['cars', 'autonomous'])],
+            suggest_tags_batch(titles))
+
+    @patch('bookie.lib.utils._suggest')
+    def test_batch_one_pass(self, mock_suggest):
+        """The titles the cache doesn't know are worked out together"""
+        mock_suggest.side_effect = lambda items: [
+            set(item.split()[:1]) for item in items]
+        cache = set_suggest_cache(10)
+        try:
+            suggest_tags('known title')
+            mock_suggest.reset_mock()
+            self.assertEqual(
+                [set(['new']), set(['known']), set(), set(['new'])],
+                suggest_tags_batch(['new title', 'known title', None,
+                                    'new title']))
+            mock_suggest.assert_called_once_with(['new title'])
+        finally:
+            set_suggest_cache()
@@ -1,6 +1,7 @@
 """Controllers related to viewing lists of bookmarks"""
 import logging
 
+from collections import OrderedDict
 from datetime import datetime
 from pyramid.settings import asbool
 from pyramid.view import view_config
@@ -12,6 +13,7 @@ from bookie.bcelery import tasks
 from bookie.lib.access import api_auth
 from bookie.lib.applog import AuthLog
 from bookie.lib.applog import BmarkLog
+from bookie.lib.applog import FulltextLog
 from bookie.lib.message import ReactivateMsg
 from bookie.lib.message import ActivationMsg
 from bookie.lib.readable import ReadContent
@@ -19,7 +21,6 @@ from bookie.lib.tagcommands import Commander
 from bookie.lib.utils import suggest_tags
 
 from bookie.models import (
-    bmarks_tags,
     Bmark,
     BmarkMgr,
     DBSession,
@@ -33,9 +34,11 @@ from bookie.models.auth import get_random_word
 from bookie.models.auth import User
 from bookie.models.auth import UserMgr
 from bookie.models.stats import StatBookmarkMgr
+from bookie.models.queue import FetchQueueMgr
 from bookie.models.queue import ImportQueueMgr
 from bookie.models.social import SocialMgr
 from bookie.models.fulltext import get_fulltext_handler
+from bookie.models.fulltext import search_timeout
 
 LOG = logging.getLogger(__name__)
 RESULTS_MAX = 10
@@ -84,7 +87,9 @@ def bookmark_stats(request):
     return _api_response(request, {
         'count': bookmark_count,
         'unique_count': unique_url_count,
-        'in_fulltext': search.doc_count()
+        'in_fulltext': search.doc_count(),
+        'fulltext_searcher': search.stats(),
+        'fulltext_cache': search.cache_stats(),
     })
 
 
@@ -163,19 +168,18 @@ def bmark_get(request):
     if bookmark and not bookmark.has_access(request_username):
         bookmark = None
 
-    # tag_list is a set - no duplicates
-    tag_list = set()
+    tag_list = []
 
     if title or url:
         suggested_tags = suggest_tags(url)
         suggested_tags.update(suggest_tags(title))
-        tag_list.update(suggested_tags)
+        tag_list = sorted(suggested_tags)
 
     if bookmark is None:
         request.response.status_int = 404
         ret = {'error': "Bookmark for hash id {0} not found".format(hash_id)}
         # Pack the response with Suggested Tags.
-        resp_tags = {'tag_suggestions': list(tag_list)}
+        resp_tags = {'tag_suggestions': tag_list}
         ret.update(resp_tags)
         return _api_response(request, ret)
     else:
@@ -185,10 +189,15 @@ def bmark_get(request):
         if 'with_content' in params and params['with_content'] != 'false':
             if bookmark.readable:
                 return_obj['readable'] = dict(bookmark.readable)
+        # And the ones worked out from the page content when it was fetched,
+        # best first and ahead of the rest, with no duplicates.
+        tag_list = list(OrderedDict.fromkeys(
+            TagMgr.suggestions(bmark=bookmark, url=bookmark.hashed.url) +
+            tag_list))
         # Pack the response with Suggested Tags.
         ret = {
             'bmark': return_obj,
-            'tag_suggestions': list(tag_list)
+            'tag_suggestions': tag_list
         }
         return _api_response(request, ret)
 
@@ -313,16 +322,21 @@ def bmark_add(request):
         commander = Commander(mark)
         mark = commander.process()
 
-        # if we have content, stick it on the object here
-        if 'content' in params:
+        # The readable is shared by everyone with this url, so content from
+        # the client only fills it in when we don't have the page yet.
+        client_content = 'content' in params and (
+            not mark.readable or mark.readable.content is None)
+        if client_content:
             content = StringIO(params['content'])
             content.seek(0)
             parsed = ReadContent.parse(content,
                                        content_type="text/html",
                                        url=mark.hashed.url)
 
-            mark.readable = Readable()
+            if not mark.readable:
+                mark.readable = Readable()
             mark.readable.content = parsed.content
+            mark.readable.clean_content = None
             mark.readable.content_type = parsed.content_type
             mark.readable.status_code = parsed.status
             mark.readable.status_message = parsed.status_message
@@ -330,6 +344,12 @@ def bmark_add(request):
         # we need to flush here for new tag ids, etc
         DBSession.flush()
 
+        # Without content from the client go get it, ahead of any imports.
+        if not mark.readable or mark.readable.imported is None:
+            tasks.fetch_bmark_content.delay(mark.bid)
+        elif client_content:
+            tasks.suggest_content_tags.delay([mark.hash_id])
+
         mark_data = dict(mark)
         mark_data['tags'] = [dict(mark.tags[tag]) for tag in mark.tags.keys()]
 
@@ -538,6 +558,11 @@ def search_results(request):
     with_content
         is always GET and specifies if we're searching the fulltext of pages
 
+    hydrate
+        defaults to true, pass false to get results built from the fulltext
+        index alone. They're missing the database only fields like clicks and
+        stored dates but skip loading the bookmarks.
+
     """
     mdict = request.matchdict
     rdict = request.GET
@@ -555,9 +580,12 @@ def search_results(request):
 
     # with content is always in the get string
     search_content = asbool(rdict.get('with_content', False))
+    hydrate = asbool(rdict.get('hydrate', True))
 
     conn_str = request.registry.settings.get('sqlalchemy.url', False)
     searcher = get_fulltext_handler(conn_str)
+    route = request.matched_route.name
+    timeout = search_timeout(request.registry.settings, route)
 
     # check if we have a page count submitted
     page = rdict.get('page', 0)
@@ -570,15 +598,26 @@ def search_results(request):
             username=username,
             requested_by=requested_by,
             ct=count,
-            page=page
+            page=page,
+            hydrate=hydrate,
+            timeout=timeout,
         )
     except ValueError:
         request.response.status_int = 404
         ret = {'error': "Bad Request: Page number out of bound"}
         return _api_response(request, ret)
 
+    FulltextLog.search(route, phrase, res_list, timeout, requested_by)
+
     constructed_results = []
     for res in res_list:
+        if not hydrate:
+            # These were built from the index, they're almost ready to go.
+            return_obj = dict(res)
+            return_obj['tags'] = [{'name': tag} for tag in res['tags']]
+            constructed_results.append(return_obj)
+            continue
+
         return_obj = dict(res)
         return_obj['tags'] = [dict(tag[1]) for tag in res.tags.items()]
 
@@ -586,12 +625,16 @@ def search_results(request):
         # clicks from it as total_clicks
         return_obj['url'] = res.hashed.url
         return_obj['total_clicks'] = res.hashed.clicks
+        return_obj['score'] = res.score
 
         constructed_results.append(return_obj)
 
     return _api_response(request, {
         'search_results': constructed_results,
         'result_count': len(constructed_results),
+        'total_count': res_list.total,
+        'truncated': res_list.truncated,
+        'tag_facets': res_list.facets,
         'phrase': phrase,
         'page': page,
         'with_content': search_content,
@@ -599,6 +642,54 @@ def search_results(request):
     })
 
 
+@view_config(route_name="api_bmark_suggest", renderer="jsonp")
+@view_config(route_name="api_bmark_suggest_user", renderer="jsonp")
+@api_auth('api_key', UserMgr.get, anon=True)
+def bmark_suggest(request):
+    """Suggest bookmarks for a search as it's being typed
+
+    :@param search: GET string, the partly typed search
+    :@param count: GET int, how many suggestions, default 10
+
+    """
+    mdict = request.matchdict
+    rdict = request.GET
+
+    prefix = rdict.get('search', '')
+    username = mdict.get('username', None)
+    if request.user:
+        requested_by = request.user.username
+    else:
+        requested_by = None
+
+    try:
+        count = int(rdict.get('count', 10))
+    except ValueError:
+        count = 0
+    if count < 1:
+        request.response.status_int = 400
+        return _api_response(request, {
+            'error': 'Bad Request: count must be a whole number above 0',
+        })
+
+    conn_str = request.registry.settings.get('sqlalchemy.url', False)
+    searcher = get_fulltext_handler(conn_str)
+    suggestions = searcher.suggest(
+        prefix,
+        username=username,
+        requested_by=requested_by,
+        ct=min(count, 50),
+        timeout=search_timeout(request.registry.settings,
+                               request.matched_route.name),
+    )
+
+    return _api_response(request, {
+        'suggestions': suggestions,
+        'search': prefix,
+        'username': username,
+    })
+
+
 @view_config(route_name="api_tag_complete", renderer="jsonp")
 @view_config(route_name="api_tag_complete_user", renderer="jsonp")
 @api_auth('api_key', UserMgr.get, anon=True)
@@ -1001,7 +1092,7 @@ def social_connections(request):
 @api_auth('api_key', UserMgr.get, admin_only=True)
 def to_readable(request):
     """Get a list of urls, hash_ids we need to readable parse"""
-    url_list = Bmark.query.outerjoin(Readable, Readable.bid == Bmark.bid).\
+    url_list = Bmark.query.outerjoin(Readable, Bmark.readable).\
         join(Bmark.hashed).\
         options(contains_eager(Bmark.hashed)).\
         filter(Readable.imported.is_(None)).all()
@@ -1018,6 +1109,16 @@ def to_readable(request):
     })
 
 
+@view_config(route_name="api_admin_readable_queue", renderer="jsonp")
+@api_auth('api_key', UserMgr.get, admin_only=True)
+def readable_queue(request):
+    """How far behind the content fetch queue is for each user"""
+    return _api_response(request, {
+        'size': FetchQueueMgr.size(),
+        'backlog': FetchQueueMgr.backlog(),
+    })
+
+
 @view_config(route_name="api_admin_twitter_refresh", renderer="jsonp")
 @view_config(route_name="api_admin_twitter_refresh_all", renderer="jsonp")
 @api_auth('api_key', UserMgr.get, admin_only=True)
@@ -1221,15 +1322,9 @@ def del_user(request):
         })
 
     try:
-        # First delete all the tag references for this user's bookmarks.
-        res = DBSession.query(Bmark.bid).filter(Bmark.username == u.username)
-        bids = [b[0] for b in res]
-
-        qry = bmarks_tags.delete(bmarks_tags.c.bmark_id.in_(bids))
-        qry.execute()
-
-        # Delete all of the bmarks for this year.
-        Bmark.query.filter(Bmark.username == u.username).delete()
+        # Delete all of the bmarks and their tag references for this user,
+        # this takes them out of the fulltext index as well.
+        BmarkMgr.delete_all_bookmarks(u.username)
         DBSession.delete(u)
         return _api_response(request, {
             'success': True,
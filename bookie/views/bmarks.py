@@ -1,6 +1,8 @@
 """Controllers related to viewing lists of bookmarks"""
 import logging
 
+from collections import OrderedDict
+
 from pyramid.httpexceptions import HTTPFound
 from pyramid.httpexceptions import HTTPNotFound
 from pyramid.view import view_config
@@ -179,15 +181,17 @@ def edit(request):
                 username=request.user.username
             )
         # tags based on url and title will always be there
-        # order of tags is important so convert set to list
-        tag_suggest.extend(list(base_tags))
+        # order of tags is important, the content ones come best first, so
+        # drop the repeats without losing it
+        tag_suggest = list(OrderedDict.fromkeys(
+            tag_suggest + sorted(base_tags)))
         tag_suggest = (tag_suggest[0:MAX_TAGS],
                        tag_suggest)[len(tag_suggest) < MAX_TAGS]
         return {
             'new': new,
             'bmark': bmark,
             'user': request.user,
-            'tag_suggest': list(set(tag_suggest)),
+            'tag_suggest': tag_suggest,
         }
 
 
@@ -289,8 +293,17 @@ def readable(request):
     if bid:
         found = BmarkMgr.get_by_hash(bid, username=username)
         if found:
+            # The content is only read out of the blob store here, when
+            # someone actually looks at it.
+            content = None
+            if found.readable:
+                try:
+                    content = found.readable.content
+                except (KeyError, IOError):
+                    LOG.error('Missing readable content for ' + bid)
             return {
                 'bmark': found,
+                'content': content,
                 'username': username,
             }
         else:
@@ -9,6 +9,7 @@ from pyramid.view import view_config
 
 from bookie.lib.access import ReqAuthorize
 from bookie.lib.applog import BmarkLog
+from bookie.lib.applog import FulltextLog
 from bookie.lib.importer import store_import_file
 
 from bookie.bcelery import tasks
@@ -19,6 +20,7 @@ from bookie.models import (
     Hashed,
 )
 from bookie.models.fulltext import get_fulltext_handler
+from bookie.models.fulltext import search_timeout
 from bookie.models.queue import (
     NEW,
     ImportQueue,
@@ -146,13 +148,16 @@ class ImportViews(BookieView):
             elif self.request.user and self.request.user.username:
                 username = self.request.user.username
 
+        timeout = search_timeout(self.settings, route_name)
         res_list = searcher.search(
             phrase,
             content=with_content,
             username=username if with_user else None,
             ct=count,
             page=page,
+            timeout=timeout,
         )
+        FulltextLog.search(route_name, phrase, res_list, timeout, username)
 
         # if the route name is search_ajax we want a json response
         # else we just want to return the payload data to the mako template
@@ -163,6 +168,9 @@ class ImportViews(BookieView):
                 'payload': {
                     'search_results': [dict(res) for res in res_list],
                     'result_count': len(res_list),
+                    'total_count': res_list.total,
+                    'truncated': res_list.truncated,
+                    'tag_facets': res_list.facets,
                     'phrase': phrase,
                     'page': page,
                     'username': username,
@@ -172,6 +180,9 @@ class ImportViews(BookieView):
             return {
                 'search_results': res_list,
                 'count': len(res_list),
+                'total_count': res_list.total,
+                'truncated': res_list.truncated,
+                'tag_facets': res_list.facets,
                 'max_count': 50,
                 'phrase': phrase,
                 'page': page,
@@ -0,0 +1,31 @@
+"""adding fulltext_queue for the index writer
+
+Revision ID: 3a1f0c9e7b21
+Revises: dbc7a0f1182
+Create Date: 2026-10-19 09:20:11.418204
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a1f0c9e7b21'
+down_revision = 'dbc7a0f1182'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'fulltext_queue',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('bid', sa.Integer(), nullable=False),
+        sa.Column('content', sa.UnicodeText(), nullable=True),
+        sa.Column('tstamp', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_fulltext_queue_bid', 'fulltext_queue', ['bid'])
+
+
+def downgrade():
+    op.drop_index('ix_fulltext_queue_bid', 'fulltext_queue')
+    op.drop_table('fulltext_queue')
@@ -0,0 +1,64 @@
+"""adding the sql native fulltext tables
+
+Revision ID: 4c2d8e1b9a07
+Revises: 3a1f0c9e7b21
+Create Date: 2026-10-19 10:02:47.551930
+
+The sqlite and pgsql fulltext engines keep their index in the database. Only
+the table for the database we're running against is created. Once the
+fulltext.engine setting is switched fill it with:
+
+    python scripts/admin/fulltext_backfill.py --ini bookie.ini
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c2d8e1b9a07'
+down_revision = '3a1f0c9e7b21'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        op.execute(
+            "CREATE VIRTUAL TABLE bmarks_fts USING fts5("
+            "description, extended, tags, readable, "
+            "username UNINDEXED, is_private UNINDEXED, "
+            "tokenize='porter unicode61')")
+
+    elif dialect == 'postgresql':
+        op.create_table(
+            'bmark_fulltext',
+            sa.Column('bid', sa.Integer(), nullable=False),
+            sa.Column('username', sa.Unicode(255), nullable=True),
+            sa.Column('is_private', sa.Boolean(), nullable=False,
+                      server_default=sa.sql.expression.false()),
+            sa.Column('meta', postgresql.TSVECTOR(), nullable=True),
+            sa.Column('content', postgresql.TSVECTOR(), nullable=True),
+            sa.ForeignKeyConstraint(
+                ['bid'], ['bmarks.bid'],
+                name="bmark_fulltext_bid_fkey",
+                ondelete='CASCADE'),
+            sa.PrimaryKeyConstraint('bid')
+        )
+        op.create_index('ix_bmark_fulltext_meta', 'bmark_fulltext',
+                        ['meta'], postgresql_using='gin')
+        op.create_index('ix_bmark_fulltext_content', 'bmark_fulltext',
+                        ['content'], postgresql_using='gin')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE bmarks_fts")
+
+    elif dialect == 'postgresql':
+        op.drop_index('ix_bmark_fulltext_content', 'bmark_fulltext')
+        op.drop_index('ix_bmark_fulltext_meta', 'bmark_fulltext')
+        op.drop_table('bmark_fulltext')
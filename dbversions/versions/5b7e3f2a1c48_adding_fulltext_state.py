@@ -0,0 +1,27 @@
+"""adding fulltext_state for the reconcile high-water mark
+
+Revision ID: 5b7e3f2a1c48
+Revises: 4c2d8e1b9a07
+Create Date: 2026-10-19 13:02:37.512840
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b7e3f2a1c48'
+down_revision = '4c2d8e1b9a07'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'fulltext_state',
+        sa.Column('name', sa.Unicode(length=255), nullable=False),
+        sa.Column('tstamp', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('fulltext_state')
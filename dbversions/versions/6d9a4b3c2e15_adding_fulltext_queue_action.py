@@ -0,0 +1,25 @@
+"""adding an action to fulltext_queue for deletes and optimizing
+
+Revision ID: 6d9a4b3c2e15
+Revises: 5b7e3f2a1c48
+Create Date: 2026-10-19 14:11:05.203417
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d9a4b3c2e15'
+down_revision = '5b7e3f2a1c48'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'fulltext_queue',
+        sa.Column('action', sa.Integer(), nullable=False,
+                  server_default='0'))
+
+
+def downgrade():
+    op.drop_column('fulltext_queue', 'action')
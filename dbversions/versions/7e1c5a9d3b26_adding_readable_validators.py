@@ -0,0 +1,41 @@
+"""adding validators and a refresh schedule to bmark_readable
+
+Revision ID: 7e1c5a9d3b26
+Revises: 6d9a4b3c2e15
+Create Date: 2026-10-19 16:02:41.518302
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7e1c5a9d3b26'
+down_revision = '6d9a4b3c2e15'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bmark_readable',
+                  sa.Column('etag', sa.Unicode(255), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('last_modified', sa.Unicode(64), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('digest', sa.Unicode(64), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('fetched', sa.DateTime(), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('next_fetch', sa.DateTime(), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('refresh_interval', sa.Integer(), nullable=True))
+    op.create_index('ix_bmark_readable_next_fetch', 'bmark_readable',
+                    ['next_fetch'])
+
+
+def downgrade():
+    op.drop_index('ix_bmark_readable_next_fetch', 'bmark_readable')
+    op.drop_column('bmark_readable', 'refresh_interval')
+    op.drop_column('bmark_readable', 'next_fetch')
+    op.drop_column('bmark_readable', 'fetched')
+    op.drop_column('bmark_readable', 'digest')
+    op.drop_column('bmark_readable', 'last_modified')
+    op.drop_column('bmark_readable', 'etag')
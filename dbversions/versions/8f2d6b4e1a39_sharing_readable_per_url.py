@@ -0,0 +1,91 @@
+"""sharing the readable content between the bookmarks of a url
+
+Revision ID: 8f2d6b4e1a39
+Revises: 7e1c5a9d3b26
+Create Date: 2026-10-19 17:24:08.904131
+
+bmark_readable was keyed by bid, holding a copy of the page for every
+bookmark of it. It's now keyed by the url's hash_id and we keep the most
+recent fetch of each url.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f2d6b4e1a39'
+down_revision = '7e1c5a9d3b26'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+COLUMNS = ('content, clean_content, imported, content_type, status_code, '
+           'status_message, etag, last_modified, digest, fetched, '
+           'next_fetch, refresh_interval')
+SELECTED = ', '.join('r.' + col.strip() for col in COLUMNS.split(','))
+
+
+def _columns():
+    return [
+        sa.Column('content', sa.UnicodeText(), nullable=True),
+        sa.Column('clean_content', sa.UnicodeText(), nullable=True),
+        sa.Column('imported', sa.DateTime(), nullable=True),
+        sa.Column('content_type', sa.Unicode(length=255), nullable=True),
+        sa.Column('status_code', sa.Integer(), nullable=True),
+        sa.Column('status_message', sa.Unicode(length=255), nullable=True),
+        sa.Column('etag', sa.Unicode(255), nullable=True),
+        sa.Column('last_modified', sa.Unicode(64), nullable=True),
+        sa.Column('digest', sa.Unicode(64), nullable=True),
+        sa.Column('fetched', sa.DateTime(), nullable=True),
+        sa.Column('next_fetch', sa.DateTime(), nullable=True),
+        sa.Column('refresh_interval', sa.Integer(), nullable=True),
+    ]
+
+
+def upgrade():
+    op.create_table(
+        'bmark_readable_shared',
+        sa.Column('hash_id', sa.Unicode(length=22), nullable=False),
+        *(_columns() + [
+            sa.ForeignKeyConstraint(['hash_id'], ['url_hash.hash_id'], ),
+            sa.PrimaryKeyConstraint('hash_id'),
+        ])
+    )
+
+    # The hash_id column was never filled in reliably, go through bmarks.
+    op.execute(
+        "INSERT INTO bmark_readable_shared (hash_id, {0}) "
+        "SELECT b.hash_id, {1} FROM bmark_readable r "
+        "JOIN bmarks b ON b.bid = r.bid "
+        "WHERE r.bid = ("
+        "    SELECT MAX(r2.bid) FROM bmark_readable r2 "
+        "    JOIN bmarks b2 ON b2.bid = r2.bid "
+        "    WHERE b2.hash_id = b.hash_id)".format(COLUMNS, SELECTED))
+
+    op.drop_index('ix_bmark_readable_next_fetch', 'bmark_readable')
+    op.drop_table('bmark_readable')
+    op.rename_table('bmark_readable_shared', 'bmark_readable')
+    op.create_index('ix_bmark_readable_next_fetch', 'bmark_readable',
+                    ['next_fetch'])
+
+
+def downgrade():
+    op.create_table(
+        'bmark_readable_bid',
+        sa.Column('bid', sa.Integer(), nullable=False),
+        sa.Column('hash_id', sa.Unicode(length=22), nullable=True),
+        *(_columns() + [
+            sa.ForeignKeyConstraint(['bid'], ['bmarks.bid'], ),
+            sa.PrimaryKeyConstraint('bid'),
+        ])
+    )
+
+    op.execute(
+        "INSERT INTO bmark_readable_bid (bid, hash_id, {0}) "
+        "SELECT b.bid, b.hash_id, {1} FROM bmark_readable r "
+        "JOIN bmarks b ON b.hash_id = r.hash_id".format(COLUMNS, SELECTED))
+
+    op.drop_index('ix_bmark_readable_next_fetch', 'bmark_readable')
+    op.drop_table('bmark_readable')
+    op.rename_table('bmark_readable_bid', 'bmark_readable')
+    op.create_index('ix_bmark_readable_next_fetch', 'bmark_readable',
+                    ['next_fetch'])
@@ -0,0 +1,38 @@
+"""adding blob store digests to bmark_readable
+
+Revision ID: 9a3c7e5f2b40
+Revises: 8f2d6b4e1a39
+Create Date: 2026-10-19 18:40:52.117394
+
+With readable.store_path set the page content and its plain text are kept in
+the blob store and the row only holds their digest and length. Existing rows
+keep their inline content until they're next written, or move them with:
+
+    python scripts/admin/readable_store.py --ini bookie.ini
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9a3c7e5f2b40'
+down_revision = '8f2d6b4e1a39'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('bmark_readable',
+                  sa.Column('content_digest', sa.Unicode(64), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('content_length', sa.Integer(), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('clean_digest', sa.Unicode(64), nullable=True))
+    op.add_column('bmark_readable',
+                  sa.Column('clean_length', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('bmark_readable', 'clean_length')
+    op.drop_column('bmark_readable', 'clean_digest')
+    op.drop_column('bmark_readable', 'content_length')
+    op.drop_column('bmark_readable', 'content_digest')
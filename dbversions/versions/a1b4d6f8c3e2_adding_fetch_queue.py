@@ -0,0 +1,38 @@
+"""adding fetch_queue for the content fetch workers
+
+Revision ID: a1b4d6f8c3e2
+Revises: 9a3c7e5f2b40
+Create Date: 2026-10-19 19:52:30.662018
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a1b4d6f8c3e2'
+down_revision = '9a3c7e5f2b40'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'fetch_queue',
+        sa.Column('hash_id', sa.Unicode(length=22), nullable=False),
+        sa.Column('state', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.Column('lease_owner', sa.Unicode(length=255), nullable=True),
+        sa.Column('lease_expires', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.Column('next_attempt', sa.DateTime(), nullable=True),
+        sa.Column('last_status', sa.Integer(), nullable=True),
+        sa.Column('tstamp', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('hash_id')
+    )
+    op.create_index('ix_fetch_queue_next_attempt', 'fetch_queue',
+                    ['next_attempt'])
+
+
+def downgrade():
+    op.drop_index('ix_fetch_queue_next_attempt', 'fetch_queue')
+    op.drop_table('fetch_queue')
@@ -0,0 +1,38 @@
+"""adding lanes and users to the fetch_queue
+
+Revision ID: b2c5e7a9d4f1
+Revises: a1b4d6f8c3e2
+Create Date: 2026-10-19 21:14:08.391227
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b2c5e7a9d4f1'
+down_revision = 'a1b4d6f8c3e2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('fetch_queue',
+                  sa.Column('lane', sa.Integer(), nullable=False,
+                            server_default='1'))
+    op.add_column('fetch_queue',
+                  sa.Column('username', sa.Unicode(length=255),
+                            nullable=True))
+    op.create_index('ix_fetch_queue_username', 'fetch_queue', ['username'])
+
+    # Queued before there were users to share the bulk lane between, give
+    # them to whoever bookmarked them first.
+    op.execute(
+        "UPDATE fetch_queue SET username = ("
+        "SELECT bmarks.username FROM bmarks WHERE bmarks.bid = ("
+        "SELECT MIN(earliest.bid) FROM bmarks earliest "
+        "WHERE earliest.hash_id = fetch_queue.hash_id))")
+
+
+def downgrade():
+    op.drop_index('ix_fetch_queue_username', 'fetch_queue')
+    op.drop_column('fetch_queue', 'username')
+    op.drop_column('fetch_queue', 'lane')
@@ -0,0 +1,33 @@
+"""adding host_health for the content fetch circuit breaker
+
+Revision ID: c3d6f8b1e5a2
+Revises: b2c5e7a9d4f1
+Create Date: 2026-10-19 22:03:41.118604
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3d6f8b1e5a2'
+down_revision = 'b2c5e7a9d4f1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'host_health',
+        sa.Column('host', sa.Unicode(length=255), nullable=False),
+        sa.Column('failures', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.Column('open_until', sa.DateTime(), nullable=True),
+        sa.Column('cooldown', sa.Integer(), nullable=True),
+        sa.Column('last_status', sa.Integer(), nullable=True),
+        sa.Column('last_failure', sa.DateTime(), nullable=True),
+        sa.Column('last_success', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('host')
+    )
+
+
+def downgrade():
+    op.drop_table('host_health')
@@ -0,0 +1,34 @@
+"""adding tag_suggestions worked out from the readable content
+
+Revision ID: d4e7a9c2f6b3
+Revises: c3d6f8b1e5a2
+Create Date: 2026-10-19 23:12:55.604931
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd4e7a9c2f6b3'
+down_revision = 'c3d6f8b1e5a2'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'tag_suggestions',
+        sa.Column('hash_id', sa.Unicode(length=22), nullable=False),
+        sa.Column('tag', sa.Unicode(length=255), nullable=False),
+        sa.Column('score', sa.Integer(), nullable=False,
+                  server_default='0'),
+        sa.ForeignKeyConstraint(['hash_id'], ['url_hash.hash_id'], ),
+        sa.PrimaryKeyConstraint('hash_id', 'tag')
+    )
+    # Left empty, the suggest_content_tags task fills existing content in.
+    op.add_column('bmark_readable',
+                  sa.Column('suggested', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('bmark_readable', 'suggested')
+    op.drop_table('tag_suggestions')
@@ -0,0 +1,40 @@
+"""rebuilding the whoosh index for the split schema
+
+Revision ID: e8b3f1a6c5d2
+Revises: d4e7a9c2f6b3
+Create Date: 2026-10-20 10:12:44.208517
+
+Nothing changes in the database. The whoosh index now keeps the page content
+and the search suggestions in indexes of their own, and the bookmark index
+gained the updated stamp and tag vectors. An index built before that can't
+be upgraded in place: content searches and suggestions come back empty, and
+reconcile can't spot stale documents, until it's rebuilt with
+
+    python scripts/admin/fulltext_backfill.py --ini bookie.ini --rebuild
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e8b3f1a6c5d2'
+down_revision = 'd4e7a9c2f6b3'
+
+import logging
+
+from bookie.models import fulltext
+
+LOG = logging.getLogger('alembic')
+
+
+def upgrade():
+    if fulltext.INDEX_TYPE in fulltext.SQL_ENGINES or not fulltext.INDEXES:
+        return
+    reasons = fulltext.rebuild_reasons()
+    if reasons:
+        LOG.warning(
+            'Rebuild the fulltext index with '
+            'scripts/admin/fulltext_backfill.py --rebuild: ' +
+            '; '.join(reasons))
+
+
+def downgrade():
+    pass
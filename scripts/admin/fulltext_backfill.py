@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Fill the fulltext index with every bookmark in the system
+
+With the sqlite or pgsql fulltext engines this backfills the index tables in
+the database directly, a chunk of bookmarks at a time. With whoosh every
+bookmark is queued for the index writer process, or with --rebuild a fresh
+index is built by a pool of processes and swapped in for the live one.
+
+    fulltext_backfill.py --ini bookie.ini
+    fulltext_backfill.py --ini bookie.ini --rebuild --processes 4
+
+"""
+import argparse
+import logging
+import os
+
+from configparser import ConfigParser
+from os import path
+
+from bookie.models import initialize_sql
+
+
+def parse_args():
+    """Go through the command line options"""
+    desc = "Backfill the fulltext index for Bookie"
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--ini', dest='ini',
+                        action='store',
+                        default=os.environ.get('BOOKIE_INI', 'bookie.ini'),
+                        help="the ini file with the fulltext settings")
+
+    parser.add_argument('--rebuild', dest='rebuild',
+                        action='store_true',
+                        default=False,
+                        help="build a new whoosh index and swap it in")
+
+    parser.add_argument('--processes', dest='processes',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help="worker processes for --rebuild, defaults to "
+                             "the number of cores")
+
+    parser.add_argument('--chunk', dest='chunk',
+                        action='store',
+                        type=int,
+                        default=1000,
+                        help="bookmark ids per worker job for --rebuild")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ini = ConfigParser()
+    ini_path = path.join(path.dirname(path.dirname(path.dirname(__file__))),
+                         args.ini)
+
+    ini.readfp(open(ini_path))
+    initialize_sql(dict(ini.items("app:main")))
+
+    from bookie.models import fulltext
+    if args.rebuild and fulltext.INDEX_TYPE not in fulltext.SQL_ENGINES:
+        fulltext.rebuild_index(processes=args.processes, chunk=args.chunk)
+    else:
+        fulltext.get_fulltext_handler(None).reindex()
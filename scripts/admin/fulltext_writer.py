@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""Run the fulltext index writer for this Bookie instance
+
+This is the only process that should ever write to the Whoosh index. The web
+app and celery workers queue bookmarks in the fulltext_queue table and this
+picks them up in batches.
+
+    fulltext_writer.py --ini bookie.ini --pidfile fulltext.pid
+
+"""
+import argparse
+import logging
+import os
+
+from configparser import ConfigParser
+from os import path
+
+from bookie.models import initialize_sql
+
+
+def parse_args():
+    """Go through the command line options"""
+    desc = "Run the single fulltext index writer for Bookie"
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--ini', dest='ini',
+                        action='store',
+                        default=os.environ.get('BOOKIE_INI', 'bookie.ini'),
+                        help="the ini file with the fulltext settings")
+
+    parser.add_argument('--pidfile', dest='pidfile',
+                        action='store',
+                        default=None,
+                        help="write the process id out to this file")
+
+    parser.add_argument('--batch', dest='batch',
+                        action='store',
+                        type=int,
+                        default=500,
+                        help="how many queued bookmarks to index at a time")
+
+    parser.add_argument('--poll', dest='poll',
+                        action='store',
+                        type=float,
+                        default=1.0,
+                        help="seconds to wait when the queue is empty")
+
+    parser.add_argument('--drain', dest='drain',
+                        action='store_true',
+                        default=False,
+                        help="empty the queue once and exit")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ini = ConfigParser()
+    ini_path = path.join(path.dirname(path.dirname(path.dirname(__file__))),
+                         args.ini)
+
+    ini.readfp(open(ini_path))
+    initialize_sql(dict(ini.items("app:main")))
+
+    if args.pidfile:
+        with open(args.pidfile, 'w') as pidfile:
+            pidfile.write(str(os.getpid()))
+
+    from bookie.models.fulltext import IndexWriter
+    writer = IndexWriter(batch_size=args.batch, poll_interval=args.poll)
+
+    if args.drain:
+        writer.drain()
+    else:
+        writer.run()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Move readable content stored in the database into the blob store
+
+Once readable.store_path is set new content goes to the blob store, this
+moves over what was saved before, a chunk of urls at a time.
+
+    readable_store.py --ini bookie.ini
+    readable_store.py --ini bookie.ini --rebuild-index
+
+"""
+import argparse
+import logging
+import os
+import transaction
+
+from configparser import ConfigParser
+from os import path
+
+from bookie.models import initialize_sql
+
+
+def parse_args():
+    """Go through the command line options"""
+    desc = "Move Bookie's readable content into the blob store"
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--ini', dest='ini',
+                        action='store',
+                        default=os.environ.get('BOOKIE_INI', 'bookie.ini'),
+                        help="the ini file with the readable.store settings")
+
+    parser.add_argument('--chunk', dest='chunk',
+                        action='store',
+                        type=int,
+                        default=500,
+                        help="how many urls to move per commit")
+
+    parser.add_argument('--rebuild-index', dest='rebuild_index',
+                        action='store_true',
+                        default=False,
+                        help="recreate the store's index from its packs")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ini = ConfigParser()
+    ini_path = path.join(path.dirname(path.dirname(path.dirname(__file__))),
+                         args.ini)
+
+    ini.readfp(open(ini_path))
+    initialize_sql(dict(ini.items("app:main")))
+
+    from bookie.lib.blobstore import get_store
+    from bookie.models import ReadableMgr
+
+    store = get_store()
+    if store is None:
+        raise SystemExit("Set readable.store_path in the ini first")
+
+    if args.rebuild_index:
+        store.rebuild_index()
+    else:
+        last = u''
+        while last is not None:
+            trans = transaction.begin()
+            last = ReadableMgr.move_to_store(after=last, chunk=args.chunk)
+            trans.commit()
+            if last is not None:
+                logging.info("Moved content up to " + last)
+        logging.info("Done moving readable content")
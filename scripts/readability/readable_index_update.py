@@ -1,6 +1,7 @@
 #!/usr/bin/env python
+import transaction
 
-from ConfigParser import ConfigParser
+from configparser import ConfigParser
 from os import path
 from bookie.models import initialize_sql
 
@@ -13,22 +14,15 @@ if __name__ == "__main__":
     ini.readfp(open(ini_path))
     initialize_sql(dict(ini.items("app:bookie")))
 
-    from bookie.models import Readable
     from bookie.models import Bmark
-    from bookie.models.fulltext import get_writer
-
-    writer = get_writer()
-
-    readable_bmarks = Readable.query.all()
-    for bmark in readable_bmarks:
-        b = Bmark.query.get(bmark.bid)
+    from bookie.models import DBSession
+    from bookie.models import Readable
+    from bookie.models.queue import FulltextQueueMgr
 
-        if b:
-            writer.update_document(
-                bid=unicode(b.bid),
-                description=b.description if b.description else u"",
-                extended=b.extended if b.extended else u"",
-                tags=b.tag_str if b.tag_str else u"",
-                readable=b.readable.content,
-            )
-    writer.commit()
+    # The content is shared by every bookmark of the url, queue them all.
+    # The fulltext index writer process picks these up and does the work.
+    readable_bids = DBSession.query(Bmark.bid).\
+        join(Readable, Bmark.hash_id == Readable.hash_id)
+    for (bid,) in readable_bids:
+        FulltextQueueMgr.enqueue(bid)
+    transaction.commit()